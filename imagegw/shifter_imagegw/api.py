@@ -169,6 +169,40 @@ def metrics(system):
     return jsonify(recs)
 
 
+# Get layer cache statistics
+# This will return the hit rate, bytes saved, etc. of the layer cache.
+@app.route('/api/layercache/<system>/', methods=["GET"])
+def layercache(system):
+    """ Return the layer cache statistics for a system """
+    auth = request.headers.get(AUTH_HEADER)
+    memo = 'layercache system=%s auth=%s' % (system, auth)
+    app.logger.debug(memo)
+    try:
+        session = mgr.new_session(auth, system)
+        stats = mgr.get_layer_cache_stats(session, system)
+    except:
+        app.logger.exception('Exception in layercache')
+        return not_found('%s %s' % (sys.exc_type, sys.exc_value))
+    return jsonify(stats)
+
+
+# Get pull statistics
+# This will return how many re-pulls were skipped since the tag had not moved.
+@app.route('/api/pullstats/<system>/', methods=["GET"])
+def pullstats(system):
+    """ Return the re-pull statistics for a system """
+    auth = request.headers.get(AUTH_HEADER)
+    memo = 'pullstats system=%s auth=%s' % (system, auth)
+    app.logger.debug(memo)
+    try:
+        session = mgr.new_session(auth, system)
+        stats = mgr.get_pull_stats(session, system)
+    except:
+        app.logger.exception('Exception in pullstats')
+        return not_found('%s %s' % (sys.exc_type, sys.exc_value))
+    return jsonify(stats)
+
+
 # Pull image
 # This will pull the requested image.
 @app.route('/api/pull/<system>/<imgtype>/<path:tag>/', methods=["POST"])
@@ -24,19 +24,167 @@ format for shifter.
 """
 
 import os
+import random
 import subprocess
 import shutil
+import stat
 import tempfile
-from shifter_imagegw.util import program_exists
+from time import time
+from shifter_imagegw.util import program_exists, which
 
+# tools that build a SquashFS image from a tar stream on stdin
+_TAR_SQUASHFS_TOOLS = ('sqfstar', 'tar2sqfs')
 
-def generate_ext4_image(expand_path, image_path):
+# compressors tried by the 'auto' compressor and their relative
+# decompression speed (fastest first), used to rank them for reads when
+# unsquashfs is not available to measure it
+_AUTO_COMPRESSORS = ('lz4', 'lzo', 'zstd', 'gzip', 'xz')
+_AUTO_OBJECTIVES = ('smallest', 'fastestBuild', 'fastestRead')
+_AUTO_SAMPLE_BYTES = 64 * 1024 * 1024
+
+# ext4 image layout; images are read-only so they need no journal
+_EXT4_BLOCK_SIZE = 4096
+_EXT4_INODE_SIZE = 256
+_EXT4_HEADROOM = 0.1
+_EXT4_OVERHEAD = 16 * 1024 * 1024
+_EXT4_ATTEMPTS = 3
+
+
+def _estimate_ext4_size(expand_path):
+    """
+    Estimate what an ext4 filesystem holding expand_path needs.  Returns
+    (bytes, inodes) before any headroom.
+    """
+    blocks = 0
+    dir_bytes = 0
+    inodes = 1
+    for (dirpath, dirnames, filenames) in os.walk(expand_path):
+        for name in dirnames + filenames:
+            fstat = os.lstat(os.path.join(dirpath, name))
+            inodes += 1
+            # directory entries are 8 bytes plus the name, 4 byte aligned
+            dir_bytes += 8 + (len(name) + 3) // 4 * 4
+            if stat.S_ISREG(fstat.st_mode):
+                blocks += (fstat.st_size + _EXT4_BLOCK_SIZE - 1) // \
+                    _EXT4_BLOCK_SIZE
+            elif stat.S_ISDIR(fstat.st_mode):
+                blocks += 1
+            elif stat.S_ISLNK(fstat.st_mode) and fstat.st_size >= 60:
+                # short symlinks are stored in the inode
+                blocks += 1
+    blocks += (dir_bytes + _EXT4_BLOCK_SIZE - 1) // _EXT4_BLOCK_SIZE
+    return (blocks * _EXT4_BLOCK_SIZE + inodes * _EXT4_INODE_SIZE, inodes)
+
+
+def mke2fs_populates():
+    """
+    Returns True if mke2fs can populate a filesystem from a directory (-d,
+    e2fsprogs 1.43 and newer).
+    """
+    try:
+        proc = subprocess.Popen(['mke2fs'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError:
+        return False
+    (stdout, stderr) = proc.communicate()
+    # the usage message lists the options
+    return '[-d ' in stdout + stderr
+
+
+def _quote_debugfs(path):
+    """Quote a path for a debugfs command line."""
+    return '"%s"' % path.replace('"', '""')
+
+
+def _own_by_root(expand_path, image_path):
+    """
+    Make everything in the ext4 image_path populated from expand_path owned
+    by root, like the -all-root squashfs images.  mke2fs -d copies the
+    ownership of the files, which belong to the gateway if it runs
+    unprivileged.
+    """
+    (script_fd, script_fn) = tempfile.mkstemp(suffix='.debugfs')
+    try:
+        with os.fdopen(script_fd, 'w') as script_fp:
+            for (dirpath, dirnames, filenames) in os.walk(expand_path):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    fstat = os.lstat(path)
+                    if fstat.st_uid == 0 and fstat.st_gid == 0:
+                        continue
+                    target = '/' + os.path.relpath(path, expand_path)
+                    if '\n' in target:
+                        raise OSError('Cannot set the owner of %r' % target)
+                    target = _quote_debugfs(target)
+                    script_fp.write('sif %s uid 0\n' % target)
+                    script_fp.write('sif %s gid 0\n' % target)
+        if os.path.getsize(script_fn) == 0:
+            return
+        program_exists('debugfs')
+        devnull = open(os.devnull, 'w')
+        try:
+            ret = subprocess.call(['debugfs', '-w', '-f', script_fn,
+                                   image_path], stdout=devnull,
+                                  stderr=devnull)
+        finally:
+            devnull.close()
+        if ret != 0:
+            raise OSError('debugfs failed with status %d' % ret)
+    finally:
+        os.unlink(script_fn)
+
+
+def generate_ext4_image(expand_path, image_path, stats=None):
     """
     Creates an ext4 based image
+
+    The image is a sparse file sized from the expanded tree (plus headroom)
+    and populated by mke2fs -d, so no privileges or loop mounts are needed.
+    Everything in it is then made owned by root with debugfs.  If the
+    estimate turns out too small the headroom is doubled and mke2fs run
+    again.  The estimate and number of attempts are added to stats, if
+    given.
     """
-    message = 'ext4 support is note implemented yet %s %s' % \
-              (expand_path, image_path)
-    raise NotImplementedError(message)
+    program_exists('mke2fs')
+    if not mke2fs_populates():
+        raise OSError('mke2fs does not support -d, building ext4 images '
+                      'needs e2fsprogs 1.43 or newer')
+
+    (needed, inodes) = _estimate_ext4_size(expand_path)
+    headroom = _EXT4_HEADROOM
+    devnull = open(os.devnull, 'w')
+    try:
+        for attempt in range(1, _EXT4_ATTEMPTS + 1):
+            size = int(needed * (1 + headroom)) + _EXT4_OVERHEAD
+            size = (size + _EXT4_BLOCK_SIZE - 1) // _EXT4_BLOCK_SIZE * \
+                _EXT4_BLOCK_SIZE
+            ninodes = int(inodes * (1 + headroom)) + 1024
+            with open(image_path, 'w') as image_fp:
+                image_fp.truncate(size)
+            cmd = ['mke2fs', '-q', '-F', '-t', 'ext4',
+                   '-b', str(_EXT4_BLOCK_SIZE), '-I', str(_EXT4_INODE_SIZE),
+                   '-N', str(ninodes), '-m', '0',
+                   '-O', '^has_journal,^resize_inode',
+                   '-E', 'root_owner=0:0', '-d', expand_path, image_path]
+            ret = subprocess.call(cmd, stdout=devnull)
+            if ret == 0:
+                break
+            headroom *= 2
+    finally:
+        devnull.close()
+    if ret != 0:
+        raise OSError('mke2fs failed with status %d' % ret)
+    _own_by_root(expand_path, image_path)
+    if stats is not None:
+        stats['estimated_size'] = size
+        stats['inodes'] = ninodes
+        stats['attempts'] = attempt
+    try:
+        shutil.rmtree(expand_path)
+    except:
+        pass
+
+    return True
 
 
 def generate_cramfs_image(expand_path, image_path):
@@ -58,7 +206,40 @@ def generate_cramfs_image(expand_path, image_path):
     return True
 
 
-def generate_squashfs_image(expand_path, image_path):
+def squashfs_options(profile, tool='mksquashfs'):
+    """
+    Translate a conversion profile into command line options for tool.  A
+    profile may set compressor, blockSize, processors, noFragments and
+    noXattrs, plus a list of extra options that are passed as is.
+    """
+    if profile is None:
+        return []
+    opts = []
+    if tool == 'tar2sqfs':
+        if 'compressor' in profile:
+            opts.extend(['--compressor', profile['compressor']])
+        if 'blockSize' in profile:
+            opts.extend(['--block-size', str(profile['blockSize'])])
+        if 'processors' in profile:
+            opts.extend(['--num-jobs', str(profile['processors'])])
+        if profile.get('noXattrs'):
+            opts.append('--no-xattr')
+    else:
+        if 'compressor' in profile:
+            opts.extend(['-comp', profile['compressor']])
+        if 'blockSize' in profile:
+            opts.extend(['-b', str(profile['blockSize'])])
+        if 'processors' in profile:
+            opts.extend(['-processors', str(profile['processors'])])
+        if profile.get('noFragments'):
+            opts.append('-no-fragments')
+        if profile.get('noXattrs'):
+            opts.append('-no-xattrs')
+    opts.extend(profile.get('options', []))
+    return opts
+
+
+def generate_squashfs_image(expand_path, image_path, profile=None):
     """
     Creates a SquashFS based image
     """
@@ -66,7 +247,9 @@ def generate_squashfs_image(expand_path, image_path):
     # it should be handled by the calling function
     program_exists('mksquashfs')
 
-    ret = subprocess.call(["mksquashfs", expand_path, image_path, "-all-root"])
+    cmd = ["mksquashfs", expand_path, image_path, "-all-root"]
+    cmd.extend(squashfs_options(profile))
+    ret = subprocess.call(cmd)
     if ret != 0:
         # error handling
         pass
@@ -78,25 +261,214 @@ def generate_squashfs_image(expand_path, image_path):
     return True
 
 
-def convert(fmt, expand_path, image_path):
-    """ do the conversion """
+def _sample_tree(expand_path, sample_path, max_bytes):
+    """
+    Fill sample_path with a reproducible random sample of up to max_bytes
+    of the regular files under expand_path.  Files are hard linked where
+    possible so sampling does not copy data.  Returns the sampled bytes.
+    """
+    files = []
+    for (dirpath, _, filenames) in os.walk(expand_path):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(path)
+    files.sort()
+    random.Random(0).shuffle(files)
+
+    nbytes = 0
+    for (idx, path) in enumerate(files):
+        size = os.path.getsize(path)
+        if nbytes + size > max_bytes and nbytes > 0:
+            continue
+        target = os.path.join(sample_path, '%d' % idx)
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+        nbytes += size
+        if nbytes >= max_bytes:
+            break
+    return nbytes
+
+
+def choose_compressor(expand_path, profile, workdir):
+    """
+    Pick a squashfs compressor for an image by building a sample of its
+    tree with each candidate.  The profile may set candidates, objective
+    ('smallest' (default), 'fastestBuild' or 'fastestRead') and sampleBytes;
+    its other settings are used for the sample builds.  Candidates the local
+    mksquashfs does not support are skipped.
+
+    Returns (compressor, report) where report holds the measurements.
+    """
+    program_exists('mksquashfs')
+    objective = profile.get('objective', 'smallest')
+    if objective not in _AUTO_OBJECTIVES:
+        raise ValueError('Unknown compressor objective %s' % objective)
+    candidates = profile.get('candidates', _AUTO_COMPRESSORS)
+    max_bytes = int(profile.get('sampleBytes', _AUTO_SAMPLE_BYTES))
+    can_read = which('unsquashfs') is not None
+
+    bench_path = tempfile.mkdtemp(prefix='compbench', dir=workdir)
+    devnull = open(os.devnull, 'w')
+    try:
+        sample_path = os.path.join(bench_path, 'sample')
+        os.mkdir(sample_path)
+        sample_bytes = _sample_tree(expand_path, sample_path, max_bytes)
+
+        results = {}
+        for compressor in candidates:
+            opts = dict(profile, compressor=compressor)
+            image = os.path.join(bench_path, '%s.squashfs' % compressor)
+            cmd = ['mksquashfs', sample_path, image, '-all-root',
+                   '-noappend', '-no-progress']
+            cmd.extend(squashfs_options(opts))
+            start = time()
+            if subprocess.call(cmd, stdout=devnull, stderr=devnull) != 0 or \
+                    not os.path.exists(image):
+                continue
+            result = {
+                'size': os.path.getsize(image),
+                'build_seconds': round(time() - start, 3),
+                'read_seconds': None
+            }
+            if can_read:
+                unpack = os.path.join(bench_path, '%s.unpack' % compressor)
+                start = time()
+                cmd = ['unsquashfs', '-n', '-d', unpack, image]
+                if subprocess.call(cmd, stdout=devnull,
+                                   stderr=devnull) == 0:
+                    result['read_seconds'] = round(time() - start, 3)
+                shutil.rmtree(unpack, ignore_errors=True)
+            os.unlink(image)
+            results[compressor] = result
+    finally:
+        devnull.close()
+        shutil.rmtree(bench_path, ignore_errors=True)
+
+    if len(results) == 0:
+        raise OSError('none of the candidate compressors %s worked'
+                      % ', '.join(candidates))
+
+    def _rank(compressor):
+        """Sort key for the objective, ties broken by size."""
+        result = results[compressor]
+        if objective == 'fastestBuild':
+            return (result['build_seconds'], result['size'])
+        if objective == 'fastestRead':
+            if result['read_seconds'] is not None:
+                return (result['read_seconds'], result['size'])
+            if compressor in _AUTO_COMPRESSORS:
+                return (_AUTO_COMPRESSORS.index(compressor), result['size'])
+            return (len(_AUTO_COMPRESSORS), result['size'])
+        return (result['size'], result['build_seconds'])
+
+    choice = sorted(results.keys(), key=_rank)[0]
+    report = {
+        'objective': objective,
+        'choice': choice,
+        'sample_bytes': sample_bytes,
+        'results': results
+    }
+    return (choice, report)
+
+
+def _tar_squashfs_tool():
+    """Return the first available tar to squashfs tool or None."""
+    for tool in _TAR_SQUASHFS_TOOLS:
+        if which(tool) is not None:
+            return tool
+    return None
+
+
+def stream_supported(fmt):
+    """
+    Returns True if images of format fmt can be built directly from a tar
+    stream (see convert), i.e., without expanding the image first.
+    """
+    return fmt == 'squashfs' and _tar_squashfs_tool() is not None
+
+
+def generate_squashfs_image_from_stream(write_tar, image_path, profile=None):
+    """
+    Creates a SquashFS based image from a tar stream.  write_tar is called
+    with a file object to write the image tar to.
+    """
+    tool = _tar_squashfs_tool()
+    if tool is None:
+        raise IOError('No tar to squashfs tool (%s) found'
+                      % ', '.join(_TAR_SQUASHFS_TOOLS))
+    cmd = [tool]
+    if tool == 'tar2sqfs':
+        cmd.append('--quiet')
+    cmd.extend(squashfs_options(profile, tool))
+    cmd.append(image_path)
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        write_tar(proc.stdin)
+        proc.stdin.close()
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    ret = proc.wait()
+    if ret != 0:
+        raise OSError('%s failed with status %d' % (tool, ret))
+
+    return True
+
+
+def convert(fmt, expand_path, image_path, layer_stream=None, profile=None,
+            stats=None):
+    """
+    do the conversion
+
+    If layer_stream is given the image is built straight from the tar
+    stream it writes and expand_path is ignored (see stream_supported).
+    profile tunes the squashfs conversion (see squashfs_options); a
+    compressor of 'auto' benchmarks the candidates on a sample of
+    expand_path first (see choose_compressor).  The chosen compressor and
+    the measurements are added to the stats dictionary, if one is given.
+    """
     if os.path.exists(image_path):
         print "file already exists"
         return True
 
     (dirname, fname) = os.path.split(image_path)
+
+    if fmt == 'squashfs' and profile is not None and \
+            profile.get('compressor') == 'auto':
+        if layer_stream is not None:
+            raise ValueError('auto compressor needs an expanded image')
+        (compressor, report) = choose_compressor(expand_path, profile,
+                                                 dirname)
+        profile = dict(profile, compressor=compressor)
+        if stats is not None:
+            stats['compressor'] = compressor
+            stats['benchmark'] = report
+
     (temp_fd, temp_path) = tempfile.mkstemp('.partial', fname, dirname)
     os.close(temp_fd)
     os.unlink(temp_path)
 
     try:
         success = False
-        if fmt == 'squashfs':
-            success = generate_squashfs_image(expand_path, temp_path)
+        if layer_stream is not None:
+            if fmt != 'squashfs':
+                raise NotImplementedError("%s cannot be built from a stream"
+                                          % fmt)
+            success = generate_squashfs_image_from_stream(layer_stream,
+                                                          temp_path,
+                                                          profile)
+        elif fmt == 'squashfs':
+            success = generate_squashfs_image(expand_path, temp_path,
+                                              profile)
         elif fmt == 'cramfs':
             success = generate_cramfs_image(expand_path, temp_path)
         elif fmt == 'ext4':
-            success = generate_ext4_image(expand_path, temp_path)
+            success = generate_ext4_image(expand_path, temp_path, stats)
         elif fmt == 'mock':
             with open(temp_path, 'w') as f:
                 f.write('bogus')
@@ -122,7 +494,7 @@ def convert(fmt, expand_path, image_path):
 def writemeta(fmt, meta, metafile):
     """ write the metadata file """
     with open(metafile, 'w') as meta_fd:
-        # write out ENV, ENTRYPOINT, WORKDIR and format
+        # write out ENV, ENTRYPOINT, WORKDIR, REPLICAS and format
         private = False
         if 'private' in meta:
             private = meta['private']
@@ -144,6 +516,8 @@ def writemeta(fmt, meta, metafile):
         if 'env' in meta and meta['env'] is not None:
             for keyval in meta['env']:
                 meta_fd.write("ENV: %s\n" % (keyval))
+        if 'replicas' in meta and meta['replicas']:
+            meta_fd.write("REPLICAS: %s\n" % (','.join(meta['replicas'])))
         meta_fd.close()
     # Some error must have occurred
     return True
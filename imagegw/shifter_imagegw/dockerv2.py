@@ -23,6 +23,8 @@ includes pulling down the manifest, pulling layers, and unpacking the layers.
 
 import hashlib
 import httplib
+import Queue
+import sys
 import ssl
 import json
 import os
@@ -31,12 +33,52 @@ import re
 from subprocess import Popen, PIPE
 import base64
 import tempfile
+import shutil
 import socket
 import tarfile
+import gzip
+from shifter_imagegw.util import reset_peak_rss, peak_rss_kb, which, \
+    preallocate
+from shifter_imagegw.layercache import layer_path
+import threading
+import errno
+import email.utils
+from time import time, sleep
 
 _EMPTY_TAR_SHA256 = \
     'sha256:a3ed95caeb02ffe68cdd9fd84406680ae93d633cb16422d00e8a7c22955b46d4'
 
+_WHITEOUT_PREFIX = '.wh.'
+_WHITEOUT_OPAQUE = '.wh..wh..opq'
+
+# multi-threaded/accelerated gzip inflaters, in order of preference
+_PARALLEL_INFLATERS = ('pigz', 'igzip')
+_LAYER_INDEX_VERSION = 2
+
+# manifest media types
+_MEDIA_MANIFEST_V1 = 'application/vnd.docker.distribution.manifest.v1+prettyjws'
+_MEDIA_MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+_MEDIA_MANIFEST_LIST = \
+    'application/vnd.docker.distribution.manifest.list.v2+json'
+_MEDIA_OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+_MEDIA_OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+_MANIFEST_ACCEPT = ', '.join((_MEDIA_MANIFEST_V2, _MEDIA_MANIFEST_LIST,
+                              _MEDIA_OCI_MANIFEST, _MEDIA_OCI_INDEX,
+                              _MEDIA_MANIFEST_V1))
+_DEFAULT_PLATFORM = 'linux/amd64'
+
+# seconds between byte progress reports while pulling layers
+_PROGRESS_INTERVAL = 5
+
+# the registry default lifetime of a token that does not state one
+_TOKEN_LIFETIME = 60
+
+# Option to share bearer tokens between workers
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # Option to use a SOCKS proxy
 if 'all_proxy' in os.environ:
     import socks
@@ -88,10 +130,9 @@ def _verify_manifest_signature(manifest, text, digest):
     return True
 
 
-def _setup_http_conn(url, cacert=None):
-    """Prepare http connection object and return it."""
+def _parse_http_url(url):
+    """Split a url into its protocol, server and port."""
     (protocol, url) = url.split('://', 1)
-    conn = None
     if protocol == 'http':
         port = 80
     else:
@@ -103,6 +144,13 @@ def _setup_http_conn(url, cacert=None):
     if ':' in server:
         (server, portstr) = server.split(':', 1)
         port = int(portstr)
+    return (protocol, server, port)
+
+
+def _setup_http_conn(url, cacert=None):
+    """Prepare http connection object and return it."""
+    (protocol, server, port) = _parse_http_url(url)
+    conn = None
     if protocol == 'http':
         conn = httplib.HTTPConnection(server, port=port)
     elif protocol == 'https':
@@ -120,11 +168,542 @@ def _setup_http_conn(url, cacert=None):
     return conn
 
 
-def _construct_image_metadata(manifest):
-    """Perform introspection and analysis of docker manifest."""
+class ConnectionPool(object):
+    """
+    Pool of keep-alive http(s) connections shared by all DockerV2Handle
+    instances in a process.  Connections are keyed by protocol, server, port
+    and cacert so that a connection is only ever reused against the endpoint
+    (and trust settings) it was created for.  Idle connections are evicted
+    once they have not been used for idle_timeout seconds.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict_expired(self, now):
+        """Close idle connections past the idle timeout (lock held)."""
+        for key in self.idle.keys():
+            fresh = []
+            for (conn, released) in self.idle[key]:
+                if now - released > self.idle_timeout:
+                    conn.close()
+                    self.evictions += 1
+                else:
+                    fresh.append((conn, released))
+            if len(fresh) > 0:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+    def get(self, url, cacert=None):
+        """
+        Return a connection for url, reusing an idle one if available.
+        The returned connection has a pool_reused attribute set to True if
+        it came from the pool.
+        """
+        (protocol, server, port) = _parse_http_url(url)
+        key = (protocol, server, port, cacert)
+        with self.lock:
+            self._evict_expired(time())
+            if key in self.idle and len(self.idle[key]) > 0:
+                (conn, _) = self.idle[key].pop()
+                self.hits += 1
+                conn.pool_reused = True
+                return conn
+            self.misses += 1
+        conn = _setup_http_conn(url, cacert)
+        if conn is not None:
+            conn.pool_key = key
+            conn.pool_reused = False
+        return conn
+
+    def release(self, conn, resp=None):
+        """
+        Return a connection to the pool.  The response (if any) must have
+        been fully read, otherwise the connection is closed instead.
+        """
+        if conn is None:
+            return
+        if resp is not None and (resp.will_close or not resp.isclosed()):
+            conn.close()
+            return
+        key = getattr(conn, 'pool_key', None)
+        if key is None:
+            conn.close()
+            return
+        with self.lock:
+            now = time()
+            self._evict_expired(now)
+            conns = self.idle.setdefault(key, [])
+            if len(conns) >= self.max_idle:
+                conn.close()
+                self.evictions += 1
+                return
+            conns.append((conn, now))
+
+    def discard(self, conn):
+        """Close a connection without returning it to the pool."""
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self.lock:
+            for key in self.idle.keys():
+                for (conn, _) in self.idle[key]:
+                    conn.close()
+            self.idle = {}
+
+    def get_stats(self):
+        """Return a dictionary of pool counters."""
+        with self.lock:
+            idle = sum([len(x) for x in self.idle.values()])
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle': idle
+            }
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def _parse_challenge(auth_loc_str):
+    """
+    Parse a WWW-Authenticate bearer challenge into a dictionary of its
+    realm, service and scope.
+    """
+    # TODO, figure out what mode was for
+    (_, auth_data_str) = auth_loc_str.split(' ', 2)
+
+    auth_data = {}
+    for item in auth_data_str.split(','):
+        (key, val) = item.split('=', 2)
+        auth_data[key] = val.replace('"', '')
+    return auth_data
+
+
+def _token_identity(username, password):
+    """
+    Returns the identity credentialed tokens are cached under; None (the
+    public identity) without credentials.
+    """
+    if username is None or password is None:
+        return None
+    return hashlib.sha256('%s:%s' % (username, password)).hexdigest()
+
+
+class TokenCache(object):
+    """
+    Bearer tokens shared by all DockerV2Handle instances in a process, and
+    optionally across processes through a redis server.  Tokens are keyed by
+    realm, service, scope and the identity (a hash of the credentials, or
+    None for anonymous tokens) they were issued to, so public tokens are
+    reused by everyone while credentialed tokens stay with their user.  The
+    last challenge seen for a repository is remembered so a known token can
+    be sent up front instead of waiting for a 401.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.challenges = {}
+        self.lock = threading.Lock()
+        self.shared = None
+        self.shared_url = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def set_shared(self, url):
+        """Share tokens through the redis server at url."""
+        if url == self.shared_url:
+            return True
+        if redis is None or not url.startswith('redis'):
+            return False
+        self.shared = redis.StrictRedis.from_url(url)
+        self.shared_url = url
+        return True
+
+    @staticmethod
+    def _shared_key(key):
+        """Returns the redis key of a cache key."""
+        return 'shifter:token:%s' \
+               % hashlib.sha256(json.dumps(list(key))).hexdigest()
+
+    def get(self, key):
+        """Returns the cached token for key, or None."""
+        now = time()
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+        token = None
+        if self.shared is not None:
+            try:
+                data = self.shared.get(self._shared_key(key))
+                if data is not None:
+                    (token, expires) = json.loads(data)
+            except (redis.RedisError, ValueError):
+                token = None
+        with self.lock:
+            if token is None:
+                self.misses += 1
+                return None
+            self.tokens[key] = (token, expires)
+            self.hits += 1
+        return token
+
+    def put(self, key, token, expires_in=_TOKEN_LIFETIME):
+        """
+        Cache token for key.  It is dropped a little before the registry
+        expires it so it is not used while it runs out.
+        """
+        lifetime = expires_in - min(30, expires_in / 10.0)
+        expires = time() + lifetime
+        with self.lock:
+            self.tokens[key] = (token, expires)
+        if self.shared is not None and lifetime >= 1:
+            try:
+                self.shared.setex(self._shared_key(key), int(lifetime),
+                                  json.dumps([token, expires]))
+            except redis.RedisError:
+                pass
+
+    def invalidate(self, key, token):
+        """Drop token for key, e.g., because the registry refused it."""
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None or entry[0] != token:
+                return
+            del self.tokens[key]
+            self.invalidations += 1
+        if self.shared is not None:
+            try:
+                self.shared.delete(self._shared_key(key))
+            except redis.RedisError:
+                pass
+
+    def note_challenge(self, url, repo, challenge):
+        """Remember the WWW-Authenticate challenge for a repository."""
+        with self.lock:
+            self.challenges[(url, repo)] = challenge
+
+    def get_challenge(self, url, repo):
+        """Returns the last challenge seen for a repository, if any."""
+        with self.lock:
+            return self.challenges.get((url, repo))
+
+    def clear(self):
+        """Forget all tokens and challenges held in this process."""
+        with self.lock:
+            self.tokens = {}
+            self.challenges = {}
+
+    def get_stats(self):
+        """Return a dictionary of cache counters."""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'tokens': len(self.tokens)
+            }
+
+
+TOKEN_CACHE = TokenCache()
+
+
+def _pooled_request(url, method, path, headers, cacert=None, timeout=None):
+    """
+    Issue a request over a pooled connection and return (conn, resp).  If a
+    reused connection turns out to have been closed by the server, the
+    request is retried once on a fresh connection.  The caller is expected to
+    read the response and hand the connection back with
+    CONNECTION_POOL.release().  If timeout is set, it is applied to the
+    socket so that a stalled read raises socket.timeout; otherwise the
+    socket gets the default timeout back, whatever an earlier request on
+    the connection used.
+    """
+    if timeout is None:
+        timeout = socket.getdefaulttimeout()
+    while True:
+        conn = CONNECTION_POOL.get(url, cacert)
+        if conn is None:
+            return (None, None)
+        try:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.request(method, path, None, headers)
+            resp = conn.getresponse()
+            return (conn, resp)
+        except (httplib.HTTPException, socket.error):
+            CONNECTION_POOL.discard(conn)
+            if not conn.pool_reused:
+                raise
+
+
+class RegistryRetryError(Exception):
+    """
+    Raised when the registry asks the client to come back later (e.g., 429 or
+    503).  retry_after holds the delay the registry requested, if any.
+    """
+
+    def __init__(self, status, retry_after=None):
+        Exception.__init__(self, 'Registry returned status %d' % status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+# Statuses that are worth retrying after a delay
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _parse_retry_after(value):
+    """
+    Convert a Retry-After header (delta seconds or an HTTP date) to a number
+    of seconds to wait.  Returns None if the header is missing or invalid.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time())
+
+
+class _DownloadLock(object):
+    """
+    Lock file making sure only one worker (on any host sharing the cache)
+    downloads a layer at a time.  The lock is created with O_EXCL, records
+    its owner and has its mtime refreshed while held.  A lock that has not
+    been refreshed for timeout seconds, or whose owner on this host is gone,
+    is considered stale and broken.
+    """
+
+    def __init__(self, path, timeout=300, poll=1):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self.owner = '%s:%d:%f' % (socket.gethostname(), os.getpid(), time())
+        self.stop = threading.Event()
+        self.heartbeat = None
+
+    def _is_stale(self):
+        """Returns the owner of the current lock if it is stale."""
+        try:
+            with open(self.path) as lock_fp:
+                owner = lock_fp.read()
+            mtime = os.stat(self.path).st_mtime
+        except (IOError, OSError):
+            return None
+        if time() - mtime > self.timeout:
+            return owner
+        parts = owner.split(':')
+        if len(parts) == 3 and parts[0] == socket.gethostname():
+            try:
+                os.kill(int(parts[1]), 0)
+            except OSError as err:
+                if err.errno == errno.ESRCH:
+                    return owner
+            except ValueError:
+                pass
+        return None
+
+    def _break(self, owner):
+        """Remove a stale lock, unless it changed hands meanwhile."""
+        stale_fn = '%s.stale.%s' % (self.path, self.owner)
+        try:
+            os.rename(self.path, stale_fn)
+        except OSError:
+            return
+        with open(stale_fn) as lock_fp:
+            if lock_fp.read() != owner and not os.path.exists(self.path):
+                # we raced with a new owner, give it back
+                os.rename(stale_fn, self.path)
+                return
+        os.unlink(stale_fn)
+
+    def _refresh(self):
+        """Thread body: keep the lock fresh while it is held."""
+        while not self.stop.wait(self.timeout / 4.0):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+    def acquire(self):
+        """
+        Take the lock, waiting for (or breaking) another owner's.  Returns
+        True if another worker held it in the meantime.
+        """
+        waited = False
+        while True:
+            try:
+                fdesc = os.open(self.path,
+                                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+                waited = True
+                owner = self._is_stale()
+                if owner is not None:
+                    self._break(owner)
+                    continue
+                sleep(self.poll)
+                continue
+            os.write(fdesc, self.owner)
+            os.close(fdesc)
+            break
+        self.stop.clear()
+        self.heartbeat = threading.Thread(target=self._refresh)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+        return waited
+
+    def release(self):
+        """Drop the lock."""
+        self.stop.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _verified_marker(filename):
+    """Return the path of the sidecar recording a verified layer digest."""
+    return '%s.verified' % filename
+
+
+def _read_verified_marker(filename, digest):
+    """
+    Return True if filename has a verified marker for digest that still
+    matches the size and mtime of the file.
+    """
+    try:
+        with open(_verified_marker(filename)) as marker_fp:
+            marker = json.load(marker_fp)
+        fstat = os.stat(filename)
+    except (IOError, OSError, ValueError):
+        return False
+    return marker.get('digest') == digest and \
+        marker.get('size') == fstat.st_size and \
+        marker.get('mtime') == fstat.st_mtime
+
+
+def _write_verified_marker(filename, digest):
+    """Record that filename (at its current size/mtime) matches digest."""
+    fstat = os.stat(filename)
+    marker = {
+        'digest': digest,
+        'size': fstat.st_size,
+        'mtime': fstat.st_mtime
+    }
+    marker_fn = _verified_marker(filename)
+    (dirname, fname) = os.path.split(marker_fn)
+    (out_fd, out_fn) = tempfile.mkstemp('.partial', fname, dirname)
+    with os.fdopen(out_fd, 'w') as out_fp:
+        json.dump(marker, out_fp)
+    os.rename(out_fn, marker_fn)
+
+
+def _remove_verified_marker(filename):
+    """Remove the verified marker for filename if there is one."""
+    try:
+        os.unlink(_verified_marker(filename))
+    except OSError:
+        pass
+
+
+def _verify_digest(data, digest):
+    """Check that data (a schema 2 / OCI manifest or blob) matches digest."""
+    (hash_type, value) = digest.split(':', 1)
+    if hashlib.new(hash_type, data).hexdigest() != value:
+        msg = 'Failed to match manifest digest to downloaded content'
+        raise ValueError(msg)
+    return True
+
+
+def _is_manifest_list(manifest):
+    """Returns True for a manifest list / OCI index."""
+    if manifest.get('mediaType') in (_MEDIA_MANIFEST_LIST, _MEDIA_OCI_INDEX):
+        return True
+    return 'manifests' in manifest and 'layers' not in manifest
+
+
+def _select_platform(manifest_list, platform):
+    """
+    Pick the entry of a manifest list for platform (os/architecture with an
+    optional /variant, e.g., linux/arm64/v8).
+    """
+    wanted = platform.split('/')
+    for entry in manifest_list['manifests']:
+        plat = entry.get('platform', {})
+        have = [plat.get('os'), plat.get('architecture')]
+        if len(wanted) > 2:
+            have.append(plat.get('variant'))
+        if have == wanted:
+            return entry
+    raise ValueError('No manifest found for platform %s' % platform)
+
+
+def _construct_image_metadata_v2(manifest, config):
+    """
+    Build the layer list of a schema 2 / OCI manifest.  The youngest layer
+    carries the image id (the config digest) and the image configuration.
+    """
+    if 'layers' not in manifest or 'config' not in manifest:
+        raise ValueError('Manifest in incorrect format')
+    eldest = None
+    youngest = None
+    for layer in manifest['layers']:
+        media_type = layer.get('mediaType', '')
+        if media_type.endswith('+zstd'):
+            raise ValueError('Unsupported layer type %s' % media_type)
+        layer_data = {
+            'id': layer['digest'].split(':', 1)[1],
+            'fsLayer': {'blobSum': layer['digest']},
+            'size': layer.get('size'),
+            'child': None
+        }
+        if youngest is None:
+            eldest = layer_data
+        else:
+            youngest['child'] = layer_data
+        youngest = layer_data
+    if youngest is None:
+        raise ValueError('Manifest has no layers')
+    youngest['id'] = manifest['config']['digest'].split(':', 1)[1]
+    if config is not None and config.get('config') is not None:
+        youngest['config'] = config['config']
+    return (eldest, youngest)
+
+
+def _construct_image_metadata(manifest, config=None):
+    """
+    Perform introspection and analysis of docker manifest.  config is the
+    image configuration blob of a schema 2 / OCI manifest.
+    """
     if manifest is None:
         raise ValueError('Invalid manifest')
 
+    if manifest.get('schemaVersion') == 2:
+        return _construct_image_metadata_v2(manifest, config)
+
     req_keys = ('schemaVersion', 'fsLayers', 'history', 'signatures')
     if any([x for x in req_keys if x not in manifest]):
         raise ValueError('Manifest in incorrect format')
@@ -177,6 +756,336 @@ def _construct_image_metadata(manifest):
     return (no_parent, curr,)
 
 
+def _layer_path(name):
+    """Normalize a tar member name for comparisons between layers."""
+    return os.path.normpath(name)
+
+
+def _parent_paths(path):
+    """Yield each proper ancestor of a normalized relative path."""
+    idx = path.find('/')
+    while idx >= 0:
+        yield path[:idx]
+        idx = path.find('/', idx + 1)
+
+
+def _resolve_decompressor(decompressor):
+    """
+    Work out which program to inflate gzip layers with.  'auto' picks the
+    first available parallel inflater; 'python' (or a program that cannot be
+    found) uses tarfile's built-in zlib support.
+    """
+    if decompressor == 'auto':
+        for program in _PARALLEL_INFLATERS:
+            if which(program) is not None:
+                return program
+        return 'python'
+    if decompressor != 'python' and which(decompressor) is None:
+        return 'python'
+    return decompressor
+
+
+def _final_mode(mode, isdir):
+    """
+    Return the mode an extracted member ends up with in the image, i.e.,
+    the result of chmod a+rX,u+w.
+    """
+    mode |= stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR
+    if isdir or mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+        mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+    return mode
+
+
+def _makedirs(path):
+    """
+    os.makedirs for directories the layers do not list themselves: each
+    one created gets mode 0755 whatever the umask of the worker.
+    """
+    missing = []
+    while path and not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    for dirname in reversed(missing):
+        try:
+            os.mkdir(dirname)
+        except OSError as err:
+            # another extraction thread got there first
+            if err.errno != errno.EEXIST:
+                raise
+            continue
+        os.chmod(dirname, _final_mode(0o755, True))
+
+
+class _LayerTarFile(tarfile.TarFile):
+    """
+    TarFile that gives members their final image permissions as they are
+    extracted, so the tree never needs a recursive chmod afterwards.
+    Keeping everything writeable by the user also lets older layers
+    populate directories that younger layers already created.
+    """
+
+    def _extract_member(self, tarinfo, targetpath):
+        """Create missing parent directories with a fixed mode first."""
+        _makedirs(os.path.dirname(targetpath.rstrip('/')))
+        tarfile.TarFile._extract_member(self, tarinfo, targetpath)
+
+    def chmod(self, tarinfo, targetpath):
+        """Set the final mode of an extracted member."""
+        try:
+            os.chmod(targetpath, _final_mode(tarinfo.mode, tarinfo.isdir()))
+        except EnvironmentError:
+            raise tarfile.ExtractError("could not change mode")
+
+
+class _LayerReader(object):
+    """
+    Sequential reader over a layer tar.  gzip layers are either inflated by
+    tarfile itself or piped through an external inflater (e.g., pigz) so
+    decompression runs on other cores while members are parsed and
+    extracted.  Members are not accumulated as they are read.
+    """
+
+    def __init__(self, tfname, decompressor='python'):
+        self.proc = None
+        with open(tfname, 'rb') as tfp:
+            magic = tfp.read(2)
+        if magic != '\x1f\x8b':
+            self.tar = _LayerTarFile.open(tfname, 'r|')
+        elif decompressor == 'python':
+            self.tar = _LayerTarFile.open(tfname, 'r|gz')
+        else:
+            self.proc = Popen([decompressor, '-d', '-c', tfname], stdout=PIPE)
+            self.tar = _LayerTarFile.open(fileobj=self.proc.stdout,
+                                          mode='r|')
+
+    def __iter__(self):
+        for member in self.tar:
+            self.tar.members = []
+            yield member
+
+    def extract(self, member, path):
+        """Extract the current member to path."""
+        self.tar.extract(member, path)
+
+    def extractfile(self, member):
+        """Return a file object for the current member's data."""
+        return self.tar.extractfile(member)
+
+    def close(self):
+        """Close the tar and reap the inflater, if any."""
+        self.tar.close()
+        if self.proc is not None:
+            self.proc.stdout.close()
+            ret = self.proc.wait()
+            # a negative return is the SIGPIPE from stopping early
+            if ret > 0:
+                raise IOError('decompression failed with status %d' % ret)
+
+
+class _IndexEntry(object):
+    """Lightweight stand-in for a TarInfo in a layer member index."""
+    __slots__ = ('name', 'type', 'mode', 'mtime', 'linkname', 'uid', 'gid')
+
+    def __init__(self, name, type_, mode, mtime, linkname, uid, gid):
+        self.name = name
+        self.type = type_
+        self.mode = mode
+        self.mtime = mtime
+        self.linkname = linkname
+        self.uid = uid
+        self.gid = gid
+
+    def isdir(self):
+        """Same as TarInfo.isdir()"""
+        return self.type == tarfile.DIRTYPE
+
+    def islnk(self):
+        """Same as TarInfo.islnk()"""
+        return self.type == tarfile.LNKTYPE
+
+
+def _layer_index_path(tfname):
+    """Return the path of the cached member index of a layer tar."""
+    return '%s.index' % tfname
+
+
+def _read_layer_index(tfname):
+    """
+    Load the cached member index of a layer tar.  Returns None if there is
+    none or it does not match the tar's current size and mtime.
+    """
+    try:
+        with gzip.open(_layer_index_path(tfname)) as index_fp:
+            index = json.load(index_fp)
+        fstat = os.stat(tfname)
+    except (IOError, OSError, ValueError):
+        return None
+    if index.get('version') != _LAYER_INDEX_VERSION or \
+            index.get('size') != fstat.st_size or \
+            index.get('mtime') != fstat.st_mtime:
+        return None
+    return [_IndexEntry(*x) for x in index['members']]
+
+
+def _write_layer_index(tfname, entries):
+    """Cache the member index of a layer tar next to it."""
+    fstat = os.stat(tfname)
+    index = {
+        'version': _LAYER_INDEX_VERSION,
+        'size': fstat.st_size,
+        'mtime': fstat.st_mtime,
+        'members': [(x.name, x.type, x.mode, x.mtime, x.linkname, x.uid,
+                     x.gid) for x in entries]
+    }
+    (dirname, fname) = os.path.split(_layer_index_path(tfname))
+    (out_fd, out_fn) = tempfile.mkstemp('.partial', fname, dirname)
+    os.close(out_fd)
+    try:
+        index_fp = gzip.open(out_fn, 'wb')
+        json.dump(index, index_fp)
+        index_fp.close()
+        os.rename(out_fn, _layer_index_path(tfname))
+    except:
+        os.unlink(out_fn)
+        raise
+
+
+def _select_layer_members(reader, members):
+    """
+    Yield the members of the layer being read that are listed in members
+    (index entries), in tar order.  Hard links whose target was replaced by
+    a younger layer still need the original data, so the target is yielded
+    under the first link's name and the remaining links point at that.
+    """
+    wanted = set([x.name for x in members])
+    aliases = {}
+    for entry in members:
+        if entry.islnk() and entry.linkname not in wanted and \
+                entry.linkname not in aliases:
+            aliases[entry.linkname] = entry.name
+
+    for member in reader:
+        if member.name in aliases:
+            member.name = aliases[member.name]
+        elif member.name not in wanted:
+            continue
+        elif member.islnk() and member.linkname in aliases:
+            if aliases[member.linkname] == member.name:
+                continue
+            member.linkname = aliases[member.linkname]
+        yield member
+
+
+def _path_key(path):
+    """
+    Compact fixed-size key for a normalized path, used to index the paths
+    of very large images without keeping every path string in memory.
+    """
+    return hashlib.md5(path).digest()
+
+
+def _classify_member(name):
+    """
+    Classify a layer member by name.  Returns (kind, path) where kind is one
+    of 'illegal' (anything under dev/, absolute paths and paths with a '..'
+    component), 'whiteout', 'opaque' or 'member', and path is the normalized
+    path the member (or the whiteout) refers to.
+    """
+    if name.startswith('dev/') or name.startswith('/') or \
+            '..' in name.split('/'):
+        return ('illegal', None)
+    if name.find('/' + _WHITEOUT_PREFIX) < 0 and \
+            not name.startswith(_WHITEOUT_PREFIX):
+        return ('member', _layer_path(name))
+    (dirname, basename) = os.path.split(name)
+    if basename == _WHITEOUT_OPAQUE:
+        return ('opaque', _layer_path(dirname or '.'))
+    elif basename.startswith(_WHITEOUT_PREFIX):
+        target = os.path.join(dirname, basename[len(_WHITEOUT_PREFIX):])
+        return ('whiteout', _layer_path(target))
+    # something inside a whiteout, drop it along with the whiteout
+    return ('illegal', None)
+
+
+def _filter_layer_members(members):
+    """
+    Remove illegal members from a layer and split out its whiteout entries.
+
+    Returns (members, whiteouts, opaques): the remaining members, the set of
+    paths whited out by this layer and the set of directories this layer
+    marks as opaque.
+    """
+    kept = []
+    whiteouts = set()
+    opaques = set()
+    for member in members:
+        (kind, path) = _classify_member(member.name)
+        if kind == 'member':
+            kept.append(member)
+        elif kind == 'whiteout':
+            whiteouts.add(path)
+        elif kind == 'opaque':
+            opaques.add(path)
+    return (kept, whiteouts, opaques)
+
+
+def _plan_layer_merge(layers):
+    """
+    Work out which members of each layer survive in the merged image.
+
+    layers is a list, eldest first, of (members, whiteouts, opaques) tuples
+    as returned by _filter_layer_members.  Layers are visited youngest first
+    while building an index of the paths younger layers have claimed, so
+    each member is checked in time proportional to its depth rather than
+    the size of the other layers.  An older member is dropped if:
+      - a younger layer provides a non-directory at the same path
+      - it, or one of its parents, was whited out by a younger layer
+      - one of its parents is opaque or a non-directory in a younger layer
+
+    Returns a list, eldest first, of the members to extract per layer.
+    """
+    # paths (and their subtrees) removed by younger whiteouts
+    hidden = set()
+    # directories whose contents in older layers are hidden
+    opaque = set()
+    # non-directories provided by younger layers
+    replaced = set()
+    # directories provided by younger layers
+    younger_dirs = set()
+
+    plan = [None] * len(layers)
+    for idx in reversed(range(len(layers))):
+        (members, whiteouts, opaques) = layers[idx]
+        keep = []
+        if '.' in opaque:
+            # a younger layer made the root opaque
+            members = []
+        for member in members:
+            path = _layer_path(member.name)
+            if path in replaced or path in hidden:
+                continue
+            if path in younger_dirs and not member.isdir():
+                continue
+            masked = False
+            for parent in _parent_paths(path):
+                if parent in hidden or parent in opaque or \
+                        parent in replaced:
+                    masked = True
+                    break
+            if not masked:
+                keep.append(member)
+        plan[idx] = keep
+
+        hidden.update(whiteouts)
+        opaque.update(opaques)
+        for member in members:
+            if member.isdir():
+                younger_dirs.add(_layer_path(member.name))
+            else:
+                replaced.add(_layer_path(member.name))
+    return plan
+
+
 class DockerV2Handle(object):
     """
     A class for fetching and unpacking docker registry (and dockerhub) images.
@@ -192,6 +1101,7 @@ class DockerV2Handle(object):
     username = None
     password = None
     token = None
+    token_key = None
     allow_authenticated = True
     check_layer_checksums = True
 
@@ -207,6 +1117,31 @@ class DockerV2Handle(object):
             baseUrl to specify a URL other than dockerhub
             cacert to specify an approved signing authority
             username/password to specify a login
+            maxConcurrentDownloads to download up to that many layers at
+                once (default 1)
+            readTimeout seconds without data before a layer download is
+                considered stalled (default 60)
+            maxRetries to retry a failed layer download (default 5)
+            retryBackoff initial delay in seconds between retries, doubled
+                after each attempt (default 1)
+            maxRetryDelay longest delay in seconds between retries, also
+                when the registry asks for more with Retry-After (default
+                300)
+            mergeMode 'planned' (default) to index every layer before
+                extracting, or 'streaming' to extract youngest first in
+                bounded memory
+            decompressor to inflate gzip layers with: 'python' (default),
+                'auto' or the name of a gzip compatible inflater like pigz
+            extractWorkers number of layers to extract concurrently in the
+                planned merge mode (default 1)
+            shardedCache store layers in the sharded layout of a managed
+                layer cache (see layercache) instead of flat in cachedir
+            platform to pick from manifest lists, as os/architecture with an
+                optional /variant (default linux/amd64)
+            downloadLockTimeout seconds after which another worker's lock
+                on a layer download is considered stale (default 300)
+            requestTimeout seconds to wait on the registry and its token
+                service when checking a manifest digest (default no limit)
         """
         # attempt to parse image identifier
         try:
@@ -290,8 +1225,67 @@ class DockerV2Handle(object):
         self.auth_method = 'token'
         if 'authMethod' in options:
             self.auth_method = options['authMethod']
+        self.auth_lock = threading.Lock()
+
+        self.max_concurrent_downloads = 1
+        if 'maxConcurrentDownloads' in options:
+            self.max_concurrent_downloads = \
+                int(options['maxConcurrentDownloads'])
+            if self.max_concurrent_downloads < 1:
+                raise ValueError('maxConcurrentDownloads must be at least 1')
+        self.read_timeout = 60
+        if 'readTimeout' in options:
+            self.read_timeout = float(options['readTimeout'])
+        self.max_retries = 5
+        if 'maxRetries' in options:
+            self.max_retries = int(options['maxRetries'])
+        self.retry_backoff = 1
+        if 'retryBackoff' in options:
+            self.retry_backoff = float(options['retryBackoff'])
+        self.max_retry_delay = 300
+        if 'maxRetryDelay' in options:
+            self.max_retry_delay = float(options['maxRetryDelay'])
+        self.merge_mode = 'planned'
+        if 'mergeMode' in options:
+            self.merge_mode = options['mergeMode']
+            if self.merge_mode not in ('planned', 'streaming'):
+                raise ValueError('Unknown mergeMode %s' % self.merge_mode)
+        self.decompressor = 'python'
+        if 'decompressor' in options:
+            self.decompressor = _resolve_decompressor(options['decompressor'])
+        self.extract_workers = 1
+        if 'extractWorkers' in options:
+            self.extract_workers = int(options['extractWorkers'])
+            if self.extract_workers < 1:
+                raise ValueError('extractWorkers must be at least 1')
+        self.download_lock_timeout = 300
+        if 'downloadLockTimeout' in options:
+            self.download_lock_timeout = float(options['downloadLockTimeout'])
+        self.request_timeout = None
+        if 'requestTimeout' in options:
+            self.request_timeout = float(options['requestTimeout'])
+        self.platform = _DEFAULT_PLATFORM
+        if 'platform' in options:
+            self.platform = options['platform']
+        self.sharded_cache = False
+        if 'shardedCache' in options:
+            self.sharded_cache = bool(options['shardedCache'])
+        # layers found in the cache vs downloaded by this handle
+        self.layer_stats = {'hits': 0, 'misses': 0, 'bytes_hit': 0,
+                            'bytes_downloaded': 0, 'duplicates_avoided': 0}
+        self.stats_lock = threading.Lock()
         self.eldest = None
         self.youngest = None
+        # Docker-Content-Digest of the last manifest fetched
+        self.manifest_digest = None
+        # compressed size of each layer, if the manifest lists them
+        self.layer_sizes = {}
+        # bytes of each layer on disk while pulling, and when (and from
+        # which thread) progress is reported
+        self.layer_progress = {}
+        self.progress_total = None
+        self.progress_reported = 0
+        self.progress_thread = None
 
     def get_eldest_layer(self):
         """Return base layer"""
@@ -309,6 +1303,40 @@ class DockerV2Handle(object):
         if blobsum not in self.excludeBlobSums:
             self.excludeBlobSums.append(blobsum)
 
+    def _token_key(self, auth_data, creds):
+        """Returns the TOKEN_CACHE key of a token for auth_data."""
+        identity = None
+        if creds:
+            identity = _token_identity(self.username, self.password)
+        return (auth_data['realm'], auth_data.get('service'),
+                auth_data.get('scope'), identity)
+
+    def _use_cached_token(self):
+        """
+        Pick up a cached token for the repository, if the registry asked
+        for one before, so the first request does not have to fail with a
+        401 first.  Credentialed tokens are preferred when there are
+        credentials.
+        """
+        if self.auth_method != 'token' or self.token is not None:
+            return False
+        challenge = TOKEN_CACHE.get_challenge(self.url, self.repo)
+        if challenge is None:
+            return False
+        auth_data = _parse_challenge(challenge)
+        for creds in (True, False):
+            if creds and (self.username is None or self.password is None):
+                continue
+            key = self._token_key(auth_data, creds)
+            token = TOKEN_CACHE.get(key)
+            if token is not None:
+                self.token = token
+                self.token_key = key
+                if creds:
+                    self.private = True
+                return True
+        return False
+
     def do_token_auth(self, auth_loc_str, creds=False):
         """
         Perform token authorization as in Docker registry v2 specification.
@@ -319,27 +1347,40 @@ class DockerV2Handle(object):
             and capabilities being requested respectively.  For shifter, the
             scope will only be pull.
 
+        Tokens are taken from (and added to) TOKEN_CACHE; the token the
+        handle holds is assumed to have just been refused and is dropped
+        from the cache when it was obtained for the same identity.  A
+        public token refused to a handle with credentials is left alone
+        (the repository is likely private) and the credentials are used
+        instead.
         """
-        auth_data_str = None
         if self.allow_authenticated is False and self.username is not None:
             raise ValueError('authentication not allowed with the current ' +
                              'settings (make sure you are using https)')
 
-        # TODO, figure out what mode was for
-        (_, auth_data_str) = auth_loc_str.split(' ', 2)
-
-        auth_data = {}
-        for item in auth_data_str.split(','):
-            (key, val) = item.split('=', 2)
-            auth_data[key] = val.replace('"', '')
-
-        auth_conn = _setup_http_conn(auth_data['realm'], self.cacert)
-        if auth_conn is None:
-            raise ValueError('Bad response from registry, ' +
-                             'failed to get auth connection')
+        auth_data = _parse_challenge(auth_loc_str)
+        TOKEN_CACHE.note_challenge(self.url, self.repo, auth_loc_str)
+        has_creds = self.username is not None and self.password is not None
+        creds = creds and has_creds
+        key = self._token_key(auth_data, creds)
+        if has_creds and not creds and self.token is not None and \
+                self.token_key == key:
+            creds = True
+            key = self._token_key(auth_data, creds)
+        token = TOKEN_CACHE.get(key)
+        if token is not None and token == self.token and \
+                self.token_key == key:
+            TOKEN_CACHE.invalidate(key, token)
+            token = None
+        if token is not None:
+            if creds:
+                self.private = True
+            self.token = token
+            self.token_key = key
+            return
 
         headers = {}
-        if creds and self.username is not None and self.password is not None:
+        if creds:
             print "\nUsing Usernmae/Password: private set to True\n"
             self.private = True
             auth = '%s:%s' % (self.username, self.password)
@@ -352,25 +1393,32 @@ class DockerV2Handle(object):
         path = match_obj.groups()[2]
         path = '%s?service=%s&scope=%s' \
                % (path, auth_data['service'], auth_data['scope'])
-        auth_conn.request("GET", path, None, headers)
-        resp = auth_conn.getresponse()
+        (auth_conn, resp) = _pooled_request(auth_data['realm'], "GET", path,
+                                            headers, self.cacert,
+                                            timeout=self.request_timeout)
+        if auth_conn is None:
+            raise ValueError('Bad response from registry, ' +
+                             'failed to get auth connection')
+        data = resp.read()
+        CONNECTION_POOL.release(auth_conn, resp)
 
         if resp.status != 200:
             raise ValueError('Bad response getting token: %d', resp.status)
         if resp.getheader('content-type') != 'application/json':
             raise ValueError('Invalid response getting token, not json')
 
-        auth_resp = json.loads(resp.read())
-        self.token = auth_resp['token']
+        auth_resp = json.loads(data)
+        self.token = auth_resp.get('token', auth_resp.get('access_token'))
+        self.token_key = key
+        TOKEN_CACHE.put(key, self.token,
+                        int(auth_resp.get('expires_in', _TOKEN_LIFETIME)))
 
-    def get_image_manifest(self, retrying=False):
+    def _get_manifest_data(self, reference, retrying=False):
         """
-        Get the image manifest returns a dictionary object of the manifest.
+        Fetch the manifest reference (a tag or digest) in any of the formats
+        shifter understands.  Returns the raw manifest and its
+        Docker-Content-Digest.
         """
-        conn = _setup_http_conn(self.url, self.cacert)
-        if conn is None:
-            return None
-
         #headers = {}
         #if self.auth_method == 'token' and self.token is not None:
         #    headers = {'Authorization': 'Bearer %s' % self.token}
@@ -378,18 +1426,25 @@ class DockerV2Handle(object):
         #    auth = '%s:%s' % (self.username, self.password)
         #    headers['Authorization'] = 'Basic %s' % base64.b64encode(auth)
         # Todo: first try unauthenticated then authenticated
+        self._use_cached_token()
         self._get_auth_header()
+        headers = dict(self.headers)
+        headers['Accept'] = _MANIFEST_ACCEPT
 
-        req_path = "/v2/%s/manifests/%s" % (self.repo, self.tag)
-        conn.request("GET", req_path, None, self.headers)
-        resp1 = conn.getresponse()
+        req_path = "/v2/%s/manifests/%s" % (self.repo, reference)
+        (conn, resp1) = _pooled_request(self.url, "GET", req_path,
+                                        headers, self.cacert)
+        if conn is None:
+            return (None, None)
+        data = resp1.read()
+        CONNECTION_POOL.release(conn, resp1)
 
         if resp1.status == 401 and not retrying and \
                 self.auth_method == 'token':
             # First try authenticating as public (no creds)
             self.do_token_auth(resp1.getheader('WWW-Authenticate'))
             try:
-                return self.get_image_manifest(retrying=True)
+                return self._get_manifest_data(reference, retrying=True)
             except:
                 # Likely failed because it needs a cred, continue
                 pass
@@ -400,34 +1455,115 @@ class DockerV2Handle(object):
             # attempt
             self.do_token_auth(resp1.getheader('WWW-Authenticate'),
                                creds=True)
-            return self.get_image_manifest(retrying=True)
+            return self._get_manifest_data(reference, retrying=True)
         if resp1.status != 200:
             msg = "Bad response from registry status=%d" % (resp1.status)
             raise ValueError(msg)
-        expected_hash = resp1.getheader('docker-content-digest')
+        digest = resp1.getheader('docker-content-digest')
         content_len = int(resp1.getheader('content-length'))
-        if expected_hash is None or len(expected_hash) == 0:
+        if digest is None or len(digest) == 0:
             raise ValueError("No docker-content-digest header found")
-        expected_hash = expected_hash.split(':', 1)[1]
-        data = resp1.read()
         if len(data) != content_len:
             memo = "Failed to read manifest: %d/%d bytes read" \
                    % (len(data), content_len)
             raise ValueError(memo)
-        jdata = json.loads(data)
+        return (data, digest)
 
-        # throws exceptions upon failure only
-        _verify_manifest_signature(jdata, data, expected_hash)
+    def get_image_manifest(self, retrying=False):
+        """
+        Get the image manifest returns a dictionary object of the manifest.
+        Schema 1, schema 2 and OCI manifests are supported; for manifest
+        lists the manifest of the configured platform is returned.
+        """
+        (data, digest) = self._get_manifest_data(self.tag, retrying)
+        if data is None:
+            return None
+        self.manifest_digest = digest
+        jdata = json.loads(data)
+        if jdata.get('schemaVersion', 1) == 1:
+            # throws exceptions upon failure only
+            _verify_manifest_signature(jdata, data, digest.split(':', 1)[1])
+            return jdata
+
+        _verify_digest(data, digest)
+        if _is_manifest_list(jdata):
+            entry = _select_platform(jdata, self.platform)
+            self.log("PULLING", 'Selected manifest %s for %s'
+                     % (entry['digest'], self.platform))
+            (data, _) = self._get_manifest_data(entry['digest'], True)
+            _verify_digest(data, entry['digest'])
+            jdata = json.loads(data)
         return jdata
 
+    def get_image_config(self, manifest):
+        """
+        Fetch the image configuration blob of a schema 2 / OCI manifest.
+        """
+        digest = manifest['config']['digest']
+        tmpdir = tempfile.mkdtemp(prefix='config')
+        try:
+            filename = os.path.join(tmpdir, 'config.json')
+            if not self._download_layer(digest, filename):
+                raise ValueError('Failed to fetch image config %s' % digest)
+            with open(filename) as config_fp:
+                return json.load(config_fp)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def head_manifest_digest(self, retrying=False):
+        """
+        Returns the Docker-Content-Digest the registry currently serves for
+        the tag, using a HEAD request so the manifest is not transferred.
+        Returns None if the registry does not tell.
+        """
+        self._use_cached_token()
+        self._get_auth_header()
+        headers = dict(self.headers)
+        headers['Accept'] = _MANIFEST_ACCEPT
+
+        req_path = "/v2/%s/manifests/%s" % (self.repo, self.tag)
+        (conn, resp1) = _pooled_request(self.url, "HEAD", req_path,
+                                        headers, self.cacert,
+                                        timeout=self.request_timeout)
+        if conn is None:
+            return None
+        resp1.read()
+        CONNECTION_POOL.release(conn, resp1)
+
+        if resp1.status == 401 and not retrying and \
+                self.auth_method == 'token':
+            self.do_token_auth(resp1.getheader('WWW-Authenticate'))
+            try:
+                return self.head_manifest_digest(retrying=True)
+            except ValueError:
+                pass
+            self.do_token_auth(resp1.getheader('WWW-Authenticate'),
+                               creds=True)
+            return self.head_manifest_digest(retrying=True)
+        if resp1.status != 200:
+            msg = "Bad response from registry status=%d" % (resp1.status)
+            raise ValueError(msg)
+        digest = resp1.getheader('docker-content-digest')
+        if digest is None or len(digest) == 0:
+            return None
+        return digest
+
     def examine_manifest(self, manifest):
         """Extract metadata from manifest."""
         self.log("PULLING", 'Constructing manifest')
-        (eldest, youngest) = _construct_image_metadata(manifest)
+        config = None
+        if manifest is not None and manifest.get('schemaVersion') == 2:
+            config = self.get_image_config(manifest)
+        (eldest, youngest) = _construct_image_metadata(manifest, config)
 
         self.eldest = eldest
         self.youngest = youngest
         meta = youngest
+        layer = eldest
+        while layer is not None:
+            if layer.get('size') is not None:
+                self.layer_sizes[layer['fsLayer']['blobSum']] = layer['size']
+            layer = layer['child']
 
         resp = {'id': meta['id']}
         if 'config' in meta:
@@ -436,26 +1572,156 @@ class DockerV2Handle(object):
                 resp['env'] = config['Env']
             if 'Entrypoint' in config:
                 resp['entrypoint'] = config['Entrypoint']
+            if config.get('WorkingDir'):
+                resp['workdir'] = config['WorkingDir']
         resp['private'] = self.private
         return resp
 
+    def layer_blobsums(self):
+        """
+        Returns the blobsums of the layers to pull, eldest first.  Requires
+        examine_manifest to have run.
+        """
+        blobsums = []
+        layer = self.eldest
+        while layer is not None:
+            blobsum = layer['fsLayer']['blobSum']
+            if blobsum not in self.excludeBlobSums and \
+                    blobsum not in blobsums:
+                blobsums.append(blobsum)
+            layer = layer['child']
+        return blobsums
+
+    def check_disk_space(self, blobsums, cachedir):
+        """
+        Make sure cachedir has room for the layers still to be downloaded,
+        as far as the manifest tells their sizes, before any is pulled.
+        """
+        needed = 0
+        for blobsum in blobsums:
+            filename = self.layer_filename(blobsum, cachedir)
+            if blobsum not in self.layer_sizes or os.path.exists(filename):
+                continue
+            needed += self.layer_sizes[blobsum]
+            if os.path.exists('%s.partial' % filename):
+                needed -= os.path.getsize('%s.partial' % filename)
+        if needed <= 0:
+            return True
+        fsstat = os.statvfs(cachedir)
+        available = fsstat.f_bavail * fsstat.f_frsize
+        if needed > available:
+            raise OSError(errno.ENOSPC, 'Not enough space in %s to pull '
+                          'layers: %d bytes needed, %d available'
+                          % (cachedir, needed, available))
+        return True
+
+    def _note_progress(self, layer, nbytes):
+        """
+        Record that nbytes of layer are on disk, reporting the progress if
+        this is the thread reporting it and it has not done so lately.
+        """
+        with self.stats_lock:
+            self.layer_progress[layer] = nbytes
+        if threading.current_thread() is self.progress_thread and \
+                time() - self.progress_reported >= _PROGRESS_INTERVAL:
+            self._report_progress()
+
+    def _report_progress(self):
+        """Report how many bytes of the image were pulled so far."""
+        self.progress_reported = time()
+        if not self.progress_total:
+            return
+        with self.stats_lock:
+            done = sum(self.layer_progress.values())
+        memo = "Pulled %.1f of %.1f MB (%d%%)" \
+               % (done / 1048576.0, self.progress_total / 1048576.0,
+                  min(100, 100 * done / self.progress_total))
+        self.log("PULLING", memo)
+
     def pull_layers(self, manifest, cachedir):
         """Download layers to cachedir if they do not exist."""
         # TODO: don't rely on self.eldest to demonstrate that
         # examine_manifest has run
         if self.eldest is None:
             self.examine_manifest(manifest)
-        layer = self.eldest
-        while layer is not None:
-            if layer['fsLayer']['blobSum'] in self.excludeBlobSums:
-                layer = layer['child']
-                continue
+        blobsums = self.layer_blobsums()
+        self.check_disk_space(blobsums, cachedir)
+
+        self.layer_progress = {}
+        self.progress_total = None
+        if all([x in self.layer_sizes for x in blobsums]):
+            self.progress_total = sum([self.layer_sizes[x] for x in blobsums])
+        self.progress_reported = time()
+        self.progress_thread = threading.current_thread()
+
+        if self.max_concurrent_downloads > 1 and len(blobsums) > 1:
+            ret = self._pull_layers_concurrent(blobsums, cachedir)
+            self._report_progress()
+            return ret
+
+        for blobsum in blobsums:
+            memo = "Pulling layer %s" % blobsum
+            self.log("PULLING", memo)
+
+            self.save_layer(blobsum, cachedir)
+        self._report_progress()
+        return True
 
-            memo = "Pulling layer %s" % layer['fsLayer']['blobSum']
+    def _pull_layers_concurrent(self, blobsums, cachedir):
+        """
+        Download blobsums with up to max_concurrent_downloads threads.  Each
+        layer is still verified and renamed into place by save_layer; progress
+        is reported from the calling thread as downloads complete.
+        """
+        pending = Queue.Queue()
+        for blobsum in blobsums:
+            pending.put(blobsum)
+        finished = Queue.Queue()
+        abort = threading.Event()
+
+        def _download():
+            """Thread body: download layers until none are left."""
+            while not abort.is_set():
+                try:
+                    blobsum = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.save_layer(blobsum, cachedir)
+                    finished.put((blobsum, None))
+                except:
+                    finished.put((blobsum, sys.exc_info()))
+
+        nthreads = min(self.max_concurrent_downloads, len(blobsums))
+        self.log("PULLING", "Pulling %d layers (%d at a time)"
+                 % (len(blobsums), nthreads))
+        threads = []
+        for _ in range(nthreads):
+            thread = threading.Thread(target=_download)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        failure = None
+        count = 0
+        while count < len(blobsums):
+            try:
+                (blobsum, exc_info) = finished.get(timeout=_PROGRESS_INTERVAL)
+            except Queue.Empty:
+                self._report_progress()
+                continue
+            count += 1
+            if exc_info is not None:
+                failure = exc_info
+                abort.set()
+                break
+            memo = "Pulled layer %s (%d/%d)" % (blobsum, count, len(blobsums))
             self.log("PULLING", memo)
 
-            self.save_layer(layer['fsLayer']['blobSum'], cachedir)
-            layer = layer['child']
+        for thread in threads:
+            thread.join()
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
         return True
 
     def _get_auth_header(self):
@@ -470,36 +1736,150 @@ class DockerV2Handle(object):
             self.headers['Authorization'] = 'Basic %s' % base64.b64encode(auth)
         return self.headers
 
+    def layer_filename(self, layer, cachedir='./'):
+        """Return where the tar of layer is kept in cachedir."""
+        if self.sharded_cache:
+            return layer_path(cachedir, layer)
+        return '%s/%s.tar' % (cachedir, layer)
+
+    def _count_layer(self, kind, nbytes, layer=None):
+        """
+        Account a layer found in the cache ('hit'), downloaded by another
+        worker while this one waited ('shared') or downloaded.
+        """
+        if layer is not None:
+            self._note_progress(layer, nbytes)
+        with self.stats_lock:
+            if kind == 'shared':
+                self.layer_stats['duplicates_avoided'] += 1
+            if kind in ('hit', 'shared'):
+                self.layer_stats['hits'] += 1
+                self.layer_stats['bytes_hit'] += nbytes
+            else:
+                self.layer_stats['misses'] += 1
+                self.layer_stats['bytes_downloaded'] += nbytes
+
     def save_layer(self, layer, cachedir='./'):
         """
-        Save a layer and verify with the digest
+        Save a layer and verify with the digest.  Interrupted downloads are
+        retried with exponential backoff (or the registry's Retry-After) and
+        resume from the existing partial file using a Range request.
+        """
+        filename = self.layer_filename(layer, cachedir)
+
+        if os.path.exists(filename):
+            try:
+                ret = self.check_layer_checksum(layer, filename)
+                self._count_layer('hit', os.path.getsize(filename),
+                                  layer)
+                return ret
+            except ValueError:
+                # there was a checksum mismatch, nuke the file
+                os.unlink(filename)
+                _remove_verified_marker(filename)
+
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # another download created it first
+                if not os.path.isdir(dirname):
+                    raise
+
+        # only one worker downloads a layer, the others wait and reuse it
+        lock = _DownloadLock('%s.lock' % filename,
+                             self.download_lock_timeout)
+        waited = lock.acquire()
+        try:
+            if waited and os.path.exists(filename):
+                try:
+                    ret = self.check_layer_checksum(layer, filename)
+                    self._count_layer('shared', os.path.getsize(filename),
+                                      layer)
+                    return ret
+                except ValueError:
+                    os.unlink(filename)
+                    _remove_verified_marker(filename)
+            return self._save_layer_retry(layer, filename)
+        finally:
+            lock.release()
+
+    def _save_layer_retry(self, layer, filename):
+        """Download a layer, retrying (and resuming) on failures."""
+        attempt = 0
+        while True:
+            try:
+                ret = self._download_layer(layer, filename)
+                self._count_layer('miss', os.path.getsize(filename), layer)
+                return ret
+            except (socket.error, httplib.HTTPException,
+                    RegistryRetryError) as err:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                if isinstance(err, RegistryRetryError) and \
+                        err.retry_after is not None:
+                    delay = err.retry_after
+                # a Retry-After must not park the worker for hours
+                delay = min(delay, self.max_retry_delay)
+                memo = "Retrying layer %s in %d seconds (%s)" \
+                       % (layer, delay, str(err) or type(err).__name__)
+                self.log("PULLING", memo)
+                sleep(delay)
+
+    def _download_layer(self, layer, filename):
+        """
+        Download a layer into filename, resuming from filename.partial if a
+        previous attempt left one behind.
         """
         path = "/v2/%s/blobs/%s" % (self.repo, layer)
         url = self.url
+        partial_fn = '%s.partial' % filename
+        offset = 0
+        if os.path.exists(partial_fn):
+            offset = os.path.getsize(partial_fn)
+        with self.auth_lock:
+            if self._use_cached_token():
+                self._get_auth_header()
         while True:
-            conn = _setup_http_conn(url, self.cacert)
+            #headers = self._get_auth_header()
+            headers = dict(self.headers)
+            token_used = self.token
+            if offset > 0:
+                headers['Range'] = 'bytes=%d-' % offset
+
+            (conn, resp1) = _pooled_request(url, "GET", path, headers,
+                                            self.cacert,
+                                            timeout=self.read_timeout)
             if conn is None:
                 return None
-
-            #headers = self._get_auth_header()
-            filename = '%s/%s.tar' % (cachedir, layer)
-
-            if os.path.exists(filename):
-                try:
-                    return self.check_layer_checksum(layer, filename)
-                except ValueError:
-                    # there was a checksum mismatch, nuke the file
-                    os.unlink(filename)
-
-            conn.request("GET", path, None, self.headers)
-            resp1 = conn.getresponse()
             location = resp1.getheader('location')
-            if resp1.status == 200:
+            if resp1.status == 200 or resp1.status == 206:
                 break
 
-            elif resp1.status == 401 and self.auth_method == 'token':
-                self.do_token_auth(resp1.getheader('WWW-Authenticate'))
+            # drain the response so the connection can be reused
+            resp1.read()
+            CONNECTION_POOL.release(conn, resp1)
+            if resp1.status == 401 and self.auth_method == 'token':
+                with self.auth_lock:
+                    # another download may have renewed the token already
+                    if self.token == token_used:
+                        self.do_token_auth(
+                            resp1.getheader('WWW-Authenticate'),
+                            creds=self.private)
+                    self._get_auth_header()
+                continue
+            elif resp1.status == 416 and offset > 0:
+                # the partial file doesn't fit the blob, start over
+                os.unlink(partial_fn)
+                offset = 0
                 continue
+            elif resp1.status in _RETRY_STATUSES:
+                retry_after = resp1.getheader('retry-after')
+                raise RegistryRetryError(resp1.status,
+                                         _parse_retry_after(retry_after))
             elif location is not None:
                 url = location
                 match_obj = re.match(r'(https?)://(.*?)(/.*)', location)
@@ -509,140 +1889,448 @@ class DockerV2Handle(object):
             else:
                 print 'ERROR: Getting layer recieved status: %d' % resp1.status
                 return False
-        maxlen = int(resp1.getheader('content-length'))
+
+        if resp1.status == 206:
+            content_range = resp1.getheader('content-range', '')
+            match_obj = re.match(r'bytes (\d+)-', content_range)
+            if match_obj is None or int(match_obj.group(1)) != offset:
+                CONNECTION_POOL.discard(conn)
+                os.unlink(partial_fn)
+                raise httplib.HTTPException('Unexpected Content-Range: %s'
+                                            % content_range)
+        else:
+            # the registry ignored (or was not sent) a Range request
+            offset = 0
+
+        maxlen = resp1.getheader('content-length')
+        if maxlen is not None:
+            maxlen = int(maxlen)
         nread = 0
-        (out_fd, out_fn) = tempfile.mkstemp('.partial', layer, cachedir)
-        out_fp = os.fdopen(out_fd, 'w')
+        (hash_type, value) = layer.split(':', 1)
+        hasher = hashlib.new(hash_type)
+        readsz = 4 * 1024 * 1024  # read 4MB chunks
+
+        if offset > 0:
+            if self.check_layer_checksums:
+                with open(partial_fn, 'rb') as in_fp:
+                    while True:
+                        buff = in_fp.read(readsz)
+                        if len(buff) == 0:
+                            break
+                        hasher.update(buff)
+            out_fp = open(partial_fn, 'ab')
+        else:
+            out_fp = open(partial_fn, 'wb')
 
         try:
-            readsz = 4 * 1024 * 1024  # read 4MB chunks
-            while nread < maxlen:
-                # TODO find a way to timeout a failed read
+            if maxlen is not None:
+                preallocate(out_fp.fileno(), offset + maxlen)
+            while maxlen is None or nread < maxlen:
+                # reads raise socket.timeout once read_timeout passes
+                # without data
                 buff = resp1.read(readsz)
-                if buff is None:
+                if buff is None or len(buff) == 0:
                     break
 
                 out_fp.write(buff)
+                hasher.update(buff)
                 nread += len(buff)
-            out_fp.close()
-            self.check_layer_checksum(layer, out_fn)
+                self._note_progress(layer, offset + nread)
         except:
-            os.unlink(out_fn)
+            # keep what was written so the next attempt can resume
+            CONNECTION_POOL.discard(conn)
             out_fp.close()
             raise
+        out_fp.close()
 
-        os.rename(out_fn, filename)
+        if maxlen is not None and nread < maxlen:
+            CONNECTION_POOL.discard(conn)
+            raise httplib.IncompleteRead('%d bytes' % nread, maxlen - nread)
+        CONNECTION_POOL.release(conn, resp1)
+
+        if self.check_layer_checksums and hasher.hexdigest() != value:
+            os.unlink(partial_fn)
+            raise ValueError("checksum mismatch, failure")
+
+        os.rename(partial_fn, filename)
+        if self.check_layer_checksums:
+            _write_verified_marker(filename, layer)
         return True
 
     def check_layer_checksum(self, layer, filename):
-        """Perform checksum calculation to exhaustively validate download."""
+        """
+        Perform checksum calculation to exhaustively validate download.
+        Layers that were already verified (and have not changed size or mtime
+        since) are not hashed again.
+        """
         if self.check_layer_checksums is False:
             return True
 
-        (hash_type, value) = layer.split(':', 1)
-        exec_name = '%s%s' % (hash_type, 'sum')
-        process = Popen([exec_name, filename], stdout=PIPE)
+        if _read_verified_marker(filename, layer):
+            return True
 
-        stdout = process.communicate()[0]
-        checksum = stdout.split(' ', 1)[0]
-        if checksum != value:
+        (hash_type, value) = layer.split(':', 1)
+        hasher = hashlib.new(hash_type)
+        with open(filename, 'rb') as in_fp:
+            while True:
+                buff = in_fp.read(4 * 1024 * 1024)
+                if len(buff) == 0:
+                    break
+                hasher.update(buff)
+        if hasher.hexdigest() != value:
             raise ValueError("checksum mismatch, failure")
+        _write_verified_marker(filename, layer)
         return True
 
+    def _layer_tar_files(self, base_layer, cachedir):
+        """Return the cached tar of each layer, eldest first."""
+        tar_files = []
+        layer = base_layer
+        while layer is not None:
+            if layer['fsLayer']['blobSum'] not in self.excludeBlobSums:
+                tar_files.append(self.layer_filename(
+                    layer['fsLayer']['blobSum'], cachedir))
+            layer = layer['child']
+        return tar_files
+
     def extract_docker_layers(self, base_path, base_layer, cachedir='./'):
         """Analyze files in docker layers and extract minimal set to base_path.
         """
-        def filter_layer(layer_members, to_remove):
-            """Remove members and members starting with to_remove from layer"""
-            trailing = '/' if not to_remove.endswith('/') else ''
-            prefix_to_remove = to_remove + trailing
+        tar_files = self._layer_tar_files(base_layer, cachedir)
 
-            return [x for x in layer_members
-                    if (not x.name == to_remove and
-                        not x.name.startswith(prefix_to_remove))]
-
-        layer_paths = []
-        tar_file_refs = []
-        layer = base_layer
-        while layer is not None:
-            if layer['fsLayer']['blobSum'] in self.excludeBlobSums:
-                layer = layer['child']
-                continue
+        reset_peak_rss()
+        if self.merge_mode == 'streaming':
+            nmembers = self._extract_layers_streaming(base_path, tar_files)
+        else:
+            nmembers = self._extract_layers_planned(base_path, tar_files)
+        self.extract_stats = {
+            'mode': self.merge_mode,
+            'workers': self.extract_workers,
+            'layers': len(tar_files),
+            'members': nmembers,
+            'peak_rss_kb': peak_rss_kb()
+        }
+        memo = "Extracted %d files from %d layers (%s, peak RSS %d MB)" \
+               % (nmembers, len(tar_files), self.merge_mode,
+                  self.extract_stats['peak_rss_kb'] / 1024)
+        self.log("PULLING", memo)
+
+        # members got their final modes while being extracted, only the
+        # top-level directory is left
+        mode = stat.S_IMODE(os.stat(base_path).st_mode)
+        os.chmod(base_path, _final_mode(mode, True))
+
+    def write_merged_tar(self, fileobj, base_layer, cachedir='./'):
+        """
+        Write the merged image as a single tar stream to fileobj instead of
+        extracting it, e.g., to feed a tar to squashfs converter.  Members
+        get the same final modes as extracted ones, are owned by root and
+        each directory is written once with its youngest attributes.
+        Returns the number of members written.
+        """
+        tar_files = self._layer_tar_files(base_layer, cachedir)
+        reset_peak_rss()
+        layer_paths = self._plan_layers(tar_files)
+
+        final_dirs = {}
+        for members in layer_paths:
+            for member in members:
+                if member.isdir():
+                    final_dirs[_layer_path(member.name)] = member
+
+        out = tarfile.open(fileobj=fileobj, mode='w|',
+                           format=tarfile.PAX_FORMAT)
+        nmembers = 0
+        for (tfname, members) in zip(tar_files, layer_paths):
+            reader = _LayerReader(tfname, self.decompressor)
+            try:
+                for member in _select_layer_members(reader, members):
+                    if member.isdir():
+                        final = final_dirs.pop(_layer_path(member.name),
+                                               None)
+                        if final is None:
+                            # already written for an older layer
+                            continue
+                        member.mode = final.mode
+                        member.mtime = final.mtime
+                    if not member.issym():
+                        member.mode = _final_mode(member.mode,
+                                                  member.isdir())
+                    member.uid = 0
+                    member.gid = 0
+                    member.uname = 'root'
+                    member.gname = 'root'
+                    data = None
+                    if member.isreg():
+                        data = reader.extractfile(member)
+                    out.addfile(member, data)
+                    nmembers += 1
+            finally:
+                reader.close()
+        out.close()
+
+        self.extract_stats = {
+            'mode': 'stream',
+            'workers': 1,
+            'layers': len(tar_files),
+            'members': nmembers,
+            'peak_rss_kb': peak_rss_kb()
+        }
+        memo = "Streamed %d files from %d layers (peak RSS %d MB)" \
+               % (nmembers, len(tar_files),
+                  self.extract_stats['peak_rss_kb'] / 1024)
+        self.log("PULLING", memo)
+        return nmembers
+
+    def _layer_index(self, tfname):
+        """
+        Return the member index of a layer tar, reading the layer once to
+        build (and cache) it if needed.
+        """
+        index = _read_layer_index(tfname)
+        if index is not None:
+            return index
+        index = []
+        reader = _LayerReader(tfname, self.decompressor)
+        try:
+            for member in reader:
+                index.append(_IndexEntry(member.name, member.type,
+                                         member.mode, member.mtime,
+                                         member.linkname, member.uid,
+                                         member.gid))
+        finally:
+            reader.close()
+        _write_layer_index(tfname, index)
+        return index
+
+    def _plan_layers(self, tar_files):
+        """
+        Index the members of every layer and plan the merge.  Returns the
+        surviving members (index entries) of each layer.
+        """
+        # get directory of tar contents, without illegal files and with
+        # the whiteouts split out
+        layers = []
+        for tfname in tar_files:
+            layers.append(_filter_layer_members(self._layer_index(tfname)))
 
-            tfname = '%s.tar' % layer['fsLayer']['blobSum']
-            tfname = os.path.join(cachedir, tfname)
-            tfp = tarfile.open(tfname, 'r:gz')
-            tar_file_refs.append(tfp)
-
-            # get directory of tar contents
-            members = tfp.getmembers()
-
-            # remove all illegal files
-            members = filter_layer(members, 'dev/')
-            members = filter_layer(members, '/')
-            members = [x for x in members if not x.name.find('..') >= 0]
-
-            # find all whiteouts
-            whiteouts = [x for x in members
-                         if x.name.find('/.wh.') >= 0 or
-                         x.name.startswith('.wh.')]
-
-            # remove the whiteout tags from this layer
-            for wh_ in whiteouts:
-                members.remove(wh_)
-
-            # remove the whiteout targets from all ancestral layers
-            for idx, ancs_layer in enumerate(layer_paths):
-                for wh_ in whiteouts:
-                    path = wh_.name.replace('/.wh.', '/')
-                    if path.startswith('.wh.'):
-                        path = path[4:]
-                    ancs_layer_iter = (x for x in ancs_layer if x.name == path)
-                    ancs_member = next(ancs_layer_iter, None)
-                    if ancs_member:
-                        ancs_layer = filter_layer(ancs_layer, path)
-                layer_paths[idx] = ancs_layer
-
-            # remove identical paths (not dirs) from all ancestral layers
-            notdirs = [x.name for x in members if not x.isdir()]
-            for idx, ancs_layer in enumerate(layer_paths):
-                ancs_layer = [x for x in ancs_layer if x.name not in notdirs]
-                layer_paths[idx] = ancs_layer
-
-            # push this layer into the collection
-            layer_paths.append(members)
+        # resolve whiteouts and overwrites across all layers
+        return _plan_layer_merge(layers)
 
-            layer = layer['child']
+    def _extract_layers_planned(self, base_path, tar_files):
+        """
+        Index the members of every layer, plan the merge and then extract
+        each layer's surviving members.  Returns the number extracted.
+        """
+        layer_paths = self._plan_layers(tar_files)
 
         # extract the selected files
-        layer_idx = 0
-        layer = base_layer
-        while layer is not None:
-            if layer['fsLayer']['blobSum'] in self.excludeBlobSums:
-                layer = layer['child']
+        if self.extract_workers > 1 and len(tar_files) > 1:
+            return self._extract_layers_concurrent(base_path, tar_files,
+                                                   layer_paths)
+        nmembers = 0
+        for (tfname, members) in zip(tar_files, layer_paths):
+            nmembers += self._extract_layer_members(base_path, tfname,
+                                                    members)
+        return nmembers
+
+    def _extract_layers_concurrent(self, base_path, tar_files, layer_paths):
+        """
+        Extract the planned members of every layer with up to
+        extract_workers threads.  Only directories can be kept from more
+        than one layer, so the directory skeleton is created first, each
+        layer's remaining members are extracted independently and the
+        directory attributes (from the youngest layer defining each) are
+        applied last.  Returns the number of members extracted.
+        """
+        dirs = {}
+        layer_files = []
+        for members in layer_paths:
+            files = []
+            for member in members:
+                path = _layer_path(member.name)
+                if member.isdir():
+                    dirs[path] = member
+                    continue
+                files.append(member)
+                for parent in _parent_paths(path):
+                    if parent not in dirs:
+                        dirs[parent] = None
+            layer_files.append(files)
+
+        for path in sorted(dirs):
+            _makedirs(os.path.join(base_path, path))
+
+        # start the biggest layers first
+        pending = Queue.Queue()
+        for idx in sorted(range(len(tar_files)),
+                          key=lambda x: len(layer_files[x]), reverse=True):
+            pending.put(idx)
+        counts = [0] * len(tar_files)
+        failures = []
+        abort = threading.Event()
+
+        def _extract():
+            """Thread body: extract layers until none are left."""
+            while not abort.is_set():
+                try:
+                    idx = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    counts[idx] = self._extract_layer_members(
+                        base_path, tar_files[idx], layer_files[idx])
+                except:
+                    failures.append(sys.exc_info())
+                    abort.set()
+
+        nthreads = min(self.extract_workers, len(tar_files))
+        threads = []
+        for _ in range(nthreads):
+            thread = threading.Thread(target=_extract)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if len(failures) > 0:
+            failure = failures[0]
+            raise failure[0], failure[1], failure[2]
+
+        # children first, so setting a mode cannot block later updates
+        is_root = os.geteuid() == 0
+        for path in sorted(dirs, reverse=True):
+            member = dirs[path]
+            if member is None:
                 continue
-
-            tfp = tar_file_refs[layer_idx]
-            members = layer_paths[layer_idx]
-            tfp.extractall(path=base_path, members=members)
-            # We need to make sure everything is writeable by the user so
-            # subsequent layers can do overwrites
-            for f in members:
-                path = base_path + '/' + f.name
-                mode = f.mode
-                if not stat.S_ISLNK(mode) and (f.mode & stat.S_IWUSR) == 0:
-                    os.chmod(path, mode | stat.S_IWUSR)
-
-            layer_idx += 1
-            layer = layer['child']
-
-        for tfp in tar_file_refs:
+            dirname = os.path.join(base_path, path)
+            if is_root:
+                os.chown(dirname, member.uid, member.gid)
+            os.chmod(dirname, _final_mode(member.mode, True))
+            os.utime(dirname, (member.mtime, member.mtime))
+        ndirs = len([x for x in dirs.values() if x is not None])
+        return sum(counts) + ndirs
+
+    def _extract_layer_members(self, base_path, tfname, members):
+        """
+        Extract the members (index entries) of a layer in a single
+        sequential pass over the tar.  Returns the number extracted.
+        """
+        count = 0
+        reader = _LayerReader(tfname, self.decompressor)
+        try:
+            for member in _select_layer_members(reader, members):
+                reader.extract(member, base_path)
+                count += 1
+        finally:
+            reader.close()
+        return count
+
+    def _extract_layers_streaming(self, base_path, tar_files):
+        """
+        Extract layers youngest first in a single streaming pass over each
+        tar.  Only compact keys of the paths claimed by younger layers are
+        kept in memory, never the TarInfo lists of the layers, so memory use
+        is bounded by the number of distinct paths rather than the total
+        size of all the layer indexes.  Returns the number extracted.
+
+        Hard links whose target was replaced or removed by a younger layer
+        still need the original data; as in _select_layer_members, the
+        target is extracted under the first link's name (in a second pass
+        over that layer) and the remaining links point at that.
+        """
+        # same rules as _plan_layer_merge, keyed by _path_key
+        hidden = set()
+        opaque = set()
+        replaced = set()
+        younger_dirs = set()
+
+        def _dropped(path):
+            """Returns True if younger layers provide or remove path."""
+            key = _path_key(path)
+            if key in replaced or key in hidden or key in younger_dirs:
+                return True
+            for parent in _parent_paths(path):
+                pkey = _path_key(parent)
+                if pkey in hidden or pkey in opaque or pkey in replaced:
+                    return True
+            return False
+
+        nmembers = 0
+        for tfname in reversed(tar_files):
+            if _path_key('.') in opaque:
+                break
+            new_hidden = set()
+            new_opaque = set()
+            new_replaced = set()
+            new_dirs = set()
+            # links to dropped targets, by target name
+            orphans = {}
+            tfp = _LayerReader(tfname, self.decompressor)
+            try:
+                for member in tfp:
+                    (kind, path) = _classify_member(member.name)
+                    if kind == 'whiteout':
+                        new_hidden.add(_path_key(path))
+                    elif kind == 'opaque':
+                        new_opaque.add(_path_key(path))
+                    if kind != 'member':
+                        continue
+                    if member.isdir():
+                        new_dirs.add(_path_key(path))
+                    else:
+                        new_replaced.add(_path_key(path))
+
+                    if _dropped(path):
+                        # younger layers already provided (or removed) it
+                        continue
+                    if member.islnk():
+                        (kind, target) = _classify_member(member.linkname)
+                        if kind == 'member' and _dropped(target):
+                            orphans.setdefault(member.linkname,
+                                               []).append(member)
+                            continue
+                    tfp.extract(member, base_path)
+                    nmembers += 1
+            finally:
+                tfp.close()
+            if len(orphans) > 0:
+                nmembers += self._extract_link_targets(base_path, tfname,
+                                                       orphans)
+            hidden.update(new_hidden)
+            opaque.update(new_opaque)
+            replaced.update(new_replaced)
+            younger_dirs.update(new_dirs)
+        return nmembers
+
+    def _extract_link_targets(self, base_path, tfname, orphans):
+        """
+        Extract the targets of the hard links in orphans (link members by
+        target name) of a layer under the first link's name, then the other
+        links to it.  Returns the number extracted.
+        """
+        count = 0
+        tfp = _LayerReader(tfname, self.decompressor)
+        try:
+            for member in tfp:
+                links = orphans.pop(member.name, None)
+                if links is None:
+                    continue
+                member.name = links[0].name
+                tfp.extract(member, base_path)
+                count += 1
+                for link in links[1:]:
+                    link.linkname = member.name
+                    tfp.extract(link, base_path)
+                    count += 1
+                if len(orphans) == 0:
+                    break
+        finally:
             tfp.close()
-
-        # fix permissions on the extracted files
-        cmd = ['chmod', '-R', 'a+rX,u+w', base_path]
-        pfp = Popen(cmd)
-        pfp.communicate()
+        if len(orphans) > 0:
+            raise ValueError('%s has hard links to missing members: %s'
+                             % (tfname, ', '.join(sorted(orphans.keys()))))
+        return count
 
 
 # Deprecated: Just use the object above
@@ -662,7 +2350,10 @@ def pull_image(options, repo, tag, cachedir='./', expanddir='./'):
     handle = DockerV2Handle(imageident, options)
 
     manifest = handle.get_image_manifest()
-    (eldest, youngest) = _construct_image_metadata(manifest)
+    config = None
+    if manifest.get('schemaVersion') == 2:
+        config = handle.get_image_config(manifest)
+    (eldest, youngest) = _construct_image_metadata(manifest, config)
     layer = eldest
     while layer is not None:
         handle.save_layer(layer['fsLayer']['blobSum'], cachedir)
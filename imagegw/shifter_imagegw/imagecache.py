@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# Shifter, Copyright (c) 2015, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Cache of converted images on the gateway.
+
+Finished images are kept under a key derived from the image id, format and
+conversion profile so re-transferring an image does not need another pull,
+extraction and conversion.  The cache is shared by every worker on the node,
+capped in size and evicted least recently used first.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from time import time
+from shifter_imagegw.util import flocked, read_counters, bump_counters
+
+_STATS_FILE = 'stats.json'
+_LOCK_FILE = '.lock'
+_COUNTERS = ('hits', 'misses', 'stores', 'evictions')
+
+
+def _link_or_copy(src, dst):
+    """Hard link src to dst, copying if they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ImageCache(object):
+    """
+    Size capped, least recently used store of converted images.  Entries
+    are files named by their key, their mtime records the last use.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    @staticmethod
+    def key(image_id, fmt, profile=None):
+        """
+        Returns the cache key of an image converted to fmt with the
+        conversion profile.
+        """
+        ident = json.dumps({'id': image_id, 'format': fmt,
+                            'profile': profile or {}}, sort_keys=True)
+        return '%s.%s' % (hashlib.sha256(ident).hexdigest(), fmt)
+
+    def _entry(self, key):
+        """Returns the path of the entry for key."""
+        return os.path.join(self.path, key[:2], key)
+
+    def _locked(self):
+        """Serialize changes to the cache across workers."""
+        return flocked(os.path.join(self.path, _LOCK_FILE))
+
+    def _count(self, counter, amount=1):
+        """Bump a counter; call with the lock held."""
+        bump_counters(os.path.join(self.path, _STATS_FILE), _COUNTERS,
+                      {counter: amount})
+
+    def _entries(self):
+        """Returns (mtime, size, path) of every entry."""
+        entries = []
+        for shard in os.listdir(self.path):
+            shard_path = os.path.join(self.path, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                if name.endswith('.partial'):
+                    continue
+                path = os.path.join(shard_path, name)
+                try:
+                    fstat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((fstat.st_mtime, fstat.st_size, path))
+        return entries
+
+    def fetch(self, key, dest):
+        """
+        Place the cached image for key at dest.  Returns True on a hit and
+        False on a miss.
+        """
+        entry = self._entry(key)
+        with self._locked():
+            if not os.path.exists(entry):
+                self._count('misses')
+                return False
+            now = time()
+            os.utime(entry, (now, now))
+            if os.path.exists(dest):
+                os.unlink(dest)
+            _link_or_copy(entry, dest)
+            self._count('hits')
+        return True
+
+    def store(self, key, src):
+        """
+        Add the image at src to the cache under key and evict the least
+        recently used entries if the cache grew over its size cap.
+        """
+        entry = self._entry(key)
+        shard = os.path.dirname(entry)
+        if not os.path.exists(shard):
+            try:
+                os.makedirs(shard)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        (temp_fd, temp_path) = tempfile.mkstemp('.partial', key, shard)
+        os.close(temp_fd)
+        os.unlink(temp_path)
+        try:
+            _link_or_copy(src, temp_path)
+            now = time()
+            os.utime(temp_path, (now, now))
+            with self._locked():
+                os.rename(temp_path, entry)
+                self._count('stores')
+                self._evict()
+        except:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return True
+
+    def _evict(self):
+        """Trim the cache to max_bytes; call with the lock held."""
+        entries = self._entries()
+        total = sum([x[1] for x in entries])
+        evicted = 0
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(path)
+            total -= size
+            evicted += 1
+        if evicted > 0:
+            self._count('evictions', evicted)
+        return evicted
+
+    def get_stats(self):
+        """Returns the counters plus the current number and size of entries."""
+        with self._locked():
+            stats = read_counters(os.path.join(self.path, _STATS_FILE),
+                                  _COUNTERS)
+            entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum([x[1] for x in entries])
+        stats['max_bytes'] = self.max_bytes
+        return stats
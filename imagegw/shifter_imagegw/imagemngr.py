@@ -32,7 +32,8 @@ from time import time, sleep
 from pymongo import MongoClient
 import pymongo.errors
 from shifter_imagegw.auth import Authentication
-from shifter_imagegw.imageworker import dopull, initqueue, doexpire
+from shifter_imagegw.imageworker import dopull, initqueue, doexpire, \
+    dotransfer, get_manifest_digest
 import bson
 import celery
 
@@ -84,6 +85,13 @@ class ImageMngr(object):
         self.tasks = []
         self.expire_requests = dict()
         self.task_image_id = dict()
+        # Pulls other systems can share the image of, by _fanout_key, and
+        # the queue and pull records waiting on each
+        self.fanout_leaders = dict()
+        self.fanout_followers = dict()
+        # Re-pulls of READY images first check the tag's manifest digest
+        # with a HEAD request and are skipped if it did not move
+        self.manifest_check = self.config.get('ManifestHeadCheck', True)
         # Time before another pull can be attempted
         self.pullupdatetimeout = 300
         if 'PullUpdateTime' in self.config:
@@ -105,6 +113,9 @@ class ImageMngr(object):
             client = MongoClient(self.config['MongoDBURI'])
             db_ = self.config['MongoDB']
             self.images = client[db_].images
+            # counters shared by every API process, see get_pull_stats and
+            # get_layer_cache_stats
+            self.counters = client[db_].counters
         else:
             raise NameError('MongoDBURI not defined')
         self.metrics = None
@@ -257,6 +268,40 @@ class ImageMngr(object):
             recs.append(r)
         return recs
 
+    def get_layer_cache_stats(self, session, system):
+        """
+        Return the layer cache statistics last reported by a worker of
+        system to any API process.
+        """
+        if not self._isadmin(session, system):
+            return {}
+        rec = self._counters_find_one({'_id': 'layer_cache:%s' % system})
+        if rec is None:
+            return {}
+        return rec.get('stats', {})
+
+    def get_pull_stats(self, session, system):
+        """
+        Return how many re-pulls were checked against the registry and how
+        many of those were skipped because the tag had not moved.
+        """
+        if not self._isadmin(session, system):
+            return {}
+        return self._pull_stats()
+
+    def _pull_stats(self):
+        """Returns the pull counters of all API processes."""
+        rec = self._counters_find_one({'_id': 'pull_stats'}) or {}
+        stats = dict()
+        for counter in ('manifest_checks', 'short_circuited'):
+            stats[counter] = rec.get(counter, 0)
+        return stats
+
+    def _count_pull(self, counter):
+        """Bump one of the pull counters."""
+        self._counters_update({'_id': 'pull_stats'}, {'$inc': {counter: 1}},
+                              upsert=True)
+
     def new_session(self, auth_string, system):
         """
         Creates a session context that can be used for multiple transactions.
@@ -393,6 +438,21 @@ class ImageMngr(object):
 
         return False
 
+    def _tag_unchanged(self, session, request, rec):
+        """
+        Check whether a READY image is still what the registry serves for
+        its tag, comparing the manifest digest recorded at pull time with
+        the one returned by a HEAD request.
+        """
+        if not self.manifest_check or rec is None or \
+                rec.get('status') != 'READY' or \
+                not rec.get('manifest_digest'):
+            return False
+        self._count_pull('manifest_checks')
+        check = dict(request, tag=request['pulltag'], session=session)
+        digest = get_manifest_digest(check)
+        return digest is not None and digest == rec['manifest_digest']
+
     def new_pull_record(self, image):
         """
         Creates a new image in mongo.  If the pull already exist it removes
@@ -410,7 +470,7 @@ class ImageMngr(object):
             'os': 'linux',  # <linux|...>
             'location': '',  # urlencoded location
             'remotetype': 'dockerv2',  # <file|dockerv2|amazonec2>
-            'ostcount': '0',  # integer, number of OSTs (future)
+            'ostcount': '0',  # integer, number of OSTs the image is striped on
             'replication': '1',  # integer, number of copies to deploy
             'userACL': [],
             'groupACL': [],
@@ -427,6 +487,67 @@ class ImageMngr(object):
         self._images_insert(newimage)
         return newimage
 
+    def _fanout_key(self, request):
+        """
+        Returns the key under which pulls of the same image for different
+        systems can share one conversion, or None if fan-out is disabled.
+        Systems share when they get the same format and conversion profile.
+        Fan-out transfers come out of the workers' image cache, so it has
+        to be configured too.
+        """
+        if not self.config.get('FanOutTransfers', False) or \
+                'ImageCacheDirectory' not in self.config:
+            return None
+        sysconf = self.platforms.get(request['system'], {})
+        if sysconf.get('fanOut', True) is False:
+            return None
+        fmt = self.config.get('DefaultImageFormat')
+        profile = json.dumps(sysconf.get('conversionProfile', {}),
+                             sort_keys=True)
+        return (request['itype'], request['pulltag'], fmt, profile)
+
+    def _join_fanout(self, ident, request, testmode):
+        """
+        Attach a pull record to an in-flight pull of the same image for
+        another system.  Returns False if there is none to join.
+        """
+        key = self._fanout_key(request)
+        if key is None or key not in self.fanout_leaders:
+            return False
+        leader = self.fanout_leaders[key]
+        self.fanout_followers[leader][1].append((ident, request, testmode))
+        memo = "pull request s=%s t=%s joined an in-flight pull" \
+            % (request['system'], request['tag'])
+        self.logger.info(memo)
+        return True
+
+    def _fan_out(self, leader, response):
+        """
+        A pull other systems were waiting on finished.  Dispatch a transfer
+        of the converted image to each of them, on the queue of the worker
+        holding the image.  If the pull failed (response is None), they
+        pull on their own.
+        """
+        for (key, task) in self.fanout_leaders.items():
+            if task == leader:
+                self.fanout_leaders.pop(key)
+        (queue, followers) = self.fanout_followers.pop(leader)
+        for (ident, request, testmode) in followers:
+            if response is None:
+                self.logger.info("Fan-out source failed, pulling %s for %s",
+                                 request['tag'], request['system'])
+                req = dopull.apply_async([request], queue=request['system'],
+                                         kwargs={'testmode': testmode})
+            else:
+                request['id'] = response['id']
+                request['meta'] = dict(response)
+                self.logger.info("Fanning out %s to %s",
+                                 request['tag'], request['system'])
+                req = dotransfer.apply_async([request], queue=queue,
+                                             kwargs={'testmode': testmode})
+            self.task_image_id[req] = ident
+            self.tasks.append(req)
+
     def pull(self, session, image, testmode=0):
         """
         pull the image
@@ -496,6 +617,11 @@ class ImageMngr(object):
             update = True
 
         if self._pullable(rec):
+            if not update and self._tag_unchanged(session, request, rec):
+                self.logger.debug("Tag unchanged, skipping re-pull")
+                self._count_pull('short_circuited')
+                self.update_mongo(rec['_id'], {'last_pull': time()})
+                return rec
             self.logger.debug("Pullable image")
             update = True
 
@@ -507,6 +633,9 @@ class ImageMngr(object):
             self.update_mongo_state(ident, 'ENQUEUED')
             request['tag'] = request['pulltag']
             request['session'] = session
+            self.update_mongo(ident, {'last_pull': time()})
+            if self._join_fanout(ident, request, testmode):
+                return rec
             self.logger.debug("Calling do pull with queue=%s",
                               request['system'])
             pullreq = dopull.apply_async([request], queue=request['system'],
@@ -516,9 +645,12 @@ class ImageMngr(object):
                 % (request['system'], request['tag'])
             self.logger.info(memo)
 
-            self.update_mongo(ident, {'last_pull': time()})
             self.task_image_id[pullreq] = ident
             self.tasks.append(pullreq)
+            key = self._fanout_key(request)
+            if key is not None:
+                self.fanout_leaders[key] = pullreq
+                self.fanout_followers[pullreq] = (request['system'], [])
 
         return rec
 
@@ -589,6 +721,8 @@ class ImageMngr(object):
                 'private': response['private'],
                 'last_pull': time()
             }
+            if 'manifest_digest' in response:
+                updates['manifest_digest'] = response['manifest_digest']
             self.logger.debug("Doing ACLs update")
             self.update_mongo(rec['_id'], updates)
             self._images_remove({'_id': ident})
@@ -615,6 +749,8 @@ class ImageMngr(object):
             update_rec = {
                 'last_pull': time()
             }
+            if 'manifest_digest' in response:
+                update_rec['manifest_digest'] = response['manifest_digest']
             self.update_mongo(rec['_id'], update_rec)
 
             self._images_remove({'_id': ident})
@@ -644,7 +780,12 @@ class ImageMngr(object):
             'last_pull': 'last_pull',
             'userACL': 'userACL',
             'groupACL': 'groupACL',
-            'private': 'private'
+            'private': 'private',
+            'conversion': 'conversion',
+            'manifest_digest': 'manifest_digest',
+            'ostcount': 'ostcount',
+            'replication': 'replication',
+            'stripe_size': 'stripe_size'
         }
         if 'private' in resp and resp['private'] is False:
             resp['userACL'] = []
@@ -708,17 +849,33 @@ class ImageMngr(object):
                 continue
             elif state == "FAILURE":
                 self.logger.warn("Pull failed for %s", req)
+                if req in self.fanout_followers:
+                    self._fan_out(req, None)
 
             self.update_mongo_state(self.task_image_id[req], state, info)
             if state == "READY" or state == "SUCCESS":
                 self.logger.debug("Completing pull request %d", i)
                 response = req.get()
                 self.logger.debug(response)
+                if 'layer_cache' in response:
+                    pullrec = self._images_find_one(
+                        {'_id': self.task_image_id[req]})
+                    if pullrec is not None:
+                        self._counters_update(
+                            {'_id': 'layer_cache:%s' % pullrec['system']},
+                            {'$set': {'stats': response.pop('layer_cache')}},
+                            upsert=True)
                 if 'meta_only' in response:
                     self.logger.debug('Updating ACLs')
                     self.update_acls(self.task_image_id[req], response)
                 else:
                     self.complete_pull(self.task_image_id[req], response)
+                if req in self.fanout_followers:
+                    # an ACL only update did not produce an image to share
+                    if 'meta_only' in response:
+                        self._fan_out(req, None)
+                    else:
+                        self._fan_out(req, response)
                 self.logger.debug('meta=%s', str(response))
                 # Now save the response
                 self.tasks.remove(req)
@@ -834,6 +991,16 @@ class ImageMngr(object):
         """ Decorated function to insert an image in mongo """
         return self.images.insert(*args, **kwargs)
 
+    @mongo_reconnect_reattempt
+    def _counters_update(self, *args, **kwargs):
+        """ Decorated function to update counters in mongo """
+        return self.counters.update(*args, **kwargs)
+
+    @mongo_reconnect_reattempt
+    def _counters_find_one(self, *args, **kwargs):
+        """ Decorated function to find counters in mongo """
+        return self.counters.find_one(*args, **kwargs)
+
     @mongo_reconnect_reattempt
     def _metrics_insert(self, *args, **kwargs):
         """ Decorated function to insert an image in mongo """
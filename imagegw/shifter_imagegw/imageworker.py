@@ -24,13 +24,15 @@ import json
 import os
 import shutil
 import sys
-import subprocess
 import logging
 import tempfile
 from time import time, sleep
 from random import randint
 from celery import Celery
 from shifter_imagegw import CONFIG_PATH, dockerv2, converters, transfer
+from shifter_imagegw.imagecache import ImageCache
+from shifter_imagegw.layercache import LayerCache
+from shifter_imagegw.util import rmtree, CpuBudget
 
 
 QUEUE = None
@@ -107,45 +109,105 @@ def _get_cacert(location):
     return cacert
 
 
-def _pull_dockerv2(request, location, repo, tag, updater):
-    """ Private method to pull a docker images. """
-    cdir = CONFIG['CacheDirectory']
-    edir = CONFIG['ExpandDirectory']
+def _dockerv2_options(request, location):
+    """
+    Returns the DockerV2Handle options to reach the registry at location
+    with the credentials of the request's session.
+    """
+    if CONFIG.get('SharedTokenCache', False):
+        # registry tokens are shared with the other workers via the broker
+        if not dockerv2.TOKEN_CACHE.set_shared(CONFIG['Broker']):
+            logging.warning("SharedTokenCache requires a redis broker and "
+                            "the redis module")
     params = CONFIG['Locations'][location]
     cacert = _get_cacert(location)
 
     url = 'https://%s' % location
     if 'url' in params:
         url = params['url']
+    options = {}
+    if cacert is not None:
+        options['cacert'] = cacert
+    options['baseUrl'] = url
+    if 'authMethod' in params:
+        options['authMethod'] = params['authMethod']
+    for key in ('maxConcurrentDownloads', 'readTimeout', 'maxRetries',
+                'retryBackoff', 'maxRetryDelay'):
+        if key in params:
+            options[key] = params[key]
+
+    if ('session' in request and 'tokens' in request['session'] and
+            request['session']['tokens']):
+        if location in request['session']['tokens']:
+            userpass = request['session']['tokens'][location]
+            options['username'] = userpass.split(':')[0]
+            options['password'] = ''.join(userpass.split(':')[1:])
+        elif ('default' in request['session']['tokens']):
+            userpass = request['session']['tokens']['default']
+            options['username'] = userpass.split(':')[0]
+            options['password'] = ''.join(userpass.split(':')[1:])
+    return options
+
+
+def _pull_dockerv2(request, location, repo, tag, updater):
+    """ Private method to pull a docker images. """
+    cdir = CONFIG['CacheDirectory']
+    edir = CONFIG['ExpandDirectory']
     try:
-        options = {}
-        if cacert is not None:
-            options['cacert'] = cacert
-        options['baseUrl'] = url
-        if 'authMethod' in params:
-            options['authMethod'] = params['authMethod']
-
-        if ('session' in request and 'tokens' in request['session'] and
-                request['session']['tokens']):
-            if location in request['session']['tokens']:
-                userpass = request['session']['tokens'][location]
-                options['username'] = userpass.split(':')[0]
-                options['password'] = ''.join(userpass.split(':')[1:])
-            elif ('default' in request['session']['tokens']):
-                userpass = request['session']['tokens']['default']
-                options['username'] = userpass.split(':')[0]
-                options['password'] = ''.join(userpass.split(':')[1:])
+        options = _dockerv2_options(request, location)
+        if 'LayerMergeMode' in CONFIG:
+            options['mergeMode'] = CONFIG['LayerMergeMode']
+        if 'LayerDecompressor' in CONFIG:
+            options['decompressor'] = CONFIG['LayerDecompressor']
+        if 'LayerExtractWorkers' in CONFIG:
+            options['extractWorkers'] = CONFIG['LayerExtractWorkers']
+        sysconf = CONFIG['Platforms'].get(request['system'], {})
+        if 'imagePlatform' in sysconf:
+            options['platform'] = sysconf['imagePlatform']
+        layer_cache = _layer_cache()
+        if layer_cache is not None:
+            options['shardedCache'] = True
+
         imageident = '%s:%s' % (repo, tag)
         dock = dockerv2.DockerV2Handle(imageident, options, updater=updater)
         updater.update_status("PULLING", 'Getting manifest')
         manifest = dock.get_image_manifest()
         request['meta'] = dock.examine_manifest(manifest)
+        request['meta']['manifest_digest'] = dock.manifest_digest
         request['id'] = str(request['meta']['id'])
 
         if check_image(request):
             return True
 
+        if fetch_cached_image(request):
+            return True
+
+        blobsums = dock.layer_blobsums()
+        if layer_cache is not None:
+            # keep the layers until conversion is done (cleanup_temporary)
+            request['layer_pin'] = layer_cache.pin(blobsums)
         dock.pull_layers(manifest, cdir)
+        logging.info("Registry connection pool stats: %s",
+                     dockerv2.CONNECTION_POOL.get_stats())
+        logging.info("Registry token cache stats: %s",
+                     dockerv2.TOKEN_CACHE.get_stats())
+        if layer_cache is not None:
+            layer_cache.record(dock.layer_stats)
+            layer_cache.add_refs(_layer_ref(request), blobsums)
+            request['meta']['layer_cache'] = layer_cache.get_stats()
+
+        # the auto compressor benchmarks a sample of the expanded image
+        auto = _conversion_profile(request).get('compressor') == 'auto'
+        if CONFIG.get('ConversionMode') == 'stream' and not auto and \
+                converters.stream_supported(get_image_format(request)):
+            # the converter consumes the merged layers directly, nothing is
+            # expanded on disk
+            def _write_layers(fileobj):
+                """Write the merged image tar to fileobj."""
+                dock.write_merged_tar(fileobj, dock.get_eldest_layer(),
+                                      cachedir=cdir)
+            request['layer_stream'] = _write_layers
+            return True
 
         expandedpath = tempfile.mkdtemp(suffix='extract',
                                         prefix=request['id'], dir=edir)
@@ -162,15 +224,11 @@ def _pull_dockerv2(request, location, repo, tag, updater):
     return False
 
 
-def pull_image(request, updater=DEFAULT_UPDATER):
+def _parse_tag(request):
     """
-    pull the image down and extract the contents
-
-    Returns True on success
+    Split the requested tag into the location, repo and tag to pull.
+    Returns (location, repo, tag, remotetype).
     """
-    params = None
-    rtype = None
-
     # See if there is a location specified
     location = CONFIG['DefaultImageLocation']
     tag = request['tag']
@@ -186,7 +244,7 @@ def pull_image(request, updater=DEFAULT_UPDATER):
         (repo, tag) = parts
     else:
         raise OSError('Unable to parse tag %s' % request['tag'])
-    logging.debug("doing image pull for loc=%s repo=%s tag=%s", location,
+    logging.debug("resolved image loc=%s repo=%s tag=%s", location,
                   repo, tag)
 
     if location in CONFIG['Locations']:
@@ -194,7 +252,16 @@ def pull_image(request, updater=DEFAULT_UPDATER):
         rtype = params['remotetype']
     else:
         raise KeyError('%s not found in configuration' % location)
+    return (location, repo, tag, rtype)
+
+
+def pull_image(request, updater=DEFAULT_UPDATER):
+    """
+    pull the image down and extract the contents
 
+    Returns True on success
+    """
+    (location, repo, tag, rtype) = _parse_tag(request)
     if rtype == 'dockerv2':
         return _pull_dockerv2(request, location, repo, tag, updater)
     elif rtype == 'dockerhub':
@@ -205,6 +272,29 @@ def pull_image(request, updater=DEFAULT_UPDATER):
     return False
 
 
+def get_manifest_digest(request):
+    """
+    Returns the manifest digest the registry currently serves for the
+    request's tag, or None if it cannot be determined.  This only issues a
+    HEAD request for the manifest, so it is cheap enough to decide whether a
+    re-pull is needed at all.  As it runs in the API request, each registry
+    call is given ManifestHeadTimeout seconds and any error just skips the
+    check.
+    """
+    try:
+        (location, repo, tag, rtype) = _parse_tag(request)
+        if rtype != 'dockerv2':
+            return None
+        options = _dockerv2_options(request, location)
+        options['requestTimeout'] = CONFIG.get('ManifestHeadTimeout', 2)
+        dock = dockerv2.DockerV2Handle('%s:%s' % (repo, tag), options)
+        return dock.head_manifest_digest()
+    except:
+        logging.warn("Manifest check failed for %s: %s", request['tag'],
+                     sys.exc_value)
+        return None
+
+
 def examine_image(request):
     """
     examine the image
@@ -226,6 +316,84 @@ def get_image_format(request):
     return fmt
 
 
+def _layer_ref(request):
+    """
+    Returns the name the layer cache knows the blobs of the request's image
+    on its system by.
+    """
+    return '%s_%s' % (request['system'], request['id'])
+
+
+def _layer_cache():
+    """
+    Returns the managed LayerCache of CacheDirectory, or None if
+    LayerCacheMaxBytes is not configured (unmanaged flat cache).
+    """
+    if 'LayerCacheMaxBytes' not in CONFIG:
+        return None
+    return LayerCache(CONFIG['CacheDirectory'],
+                      int(CONFIG['LayerCacheMaxBytes']))
+
+
+def _image_cache():
+    """
+    Returns the ImageCache of converted images, or None if
+    ImageCacheDirectory is not configured.
+    """
+    if 'ImageCacheDirectory' not in CONFIG:
+        return None
+    max_bytes = int(CONFIG.get('ImageCacheMaxBytes', 100 * 1024 ** 3))
+    return ImageCache(CONFIG['ImageCacheDirectory'], max_bytes)
+
+
+def _image_cache_key(request):
+    """Returns the image cache key for the request."""
+    return ImageCache.key(request['id'], get_image_format(request),
+                          _conversion_profile(request))
+
+
+def fetch_cached_image(request):
+    """
+    Look for an already converted copy of the image in the image cache and
+    put it in place of the conversion output.
+
+    Returns True on a hit
+    """
+    cache = _image_cache()
+    if cache is None:
+        return False
+    fmt = get_image_format(request)
+    imagefile = os.path.join(CONFIG['ExpandDirectory'],
+                             '%s.%s' % (request['id'], fmt))
+    if not cache.fetch(_image_cache_key(request), imagefile):
+        return False
+    logging.info("Worker: using cached image for %s", request['id'])
+    request['imagefile'] = imagefile
+    request['cached'] = True
+    return True
+
+
+def _conversion_profile(request):
+    """
+    Returns (a copy of) the conversionProfile of the request's platform.
+    """
+    sysconf = CONFIG['Platforms'].get(request['system'], {})
+    return dict(sysconf.get('conversionProfile', {}))
+
+
+def _cpu_budget():
+    """
+    Returns the node-wide CpuBudget conversions share, or None if
+    ConversionCpuBudget is not configured.
+    """
+    if 'ConversionCpuBudget' not in CONFIG:
+        return None
+    lockdir = os.path.join(CONFIG['ExpandDirectory'], '.cpubudget')
+    if 'ConversionLockDirectory' in CONFIG:
+        lockdir = CONFIG['ConversionLockDirectory']
+    return CpuBudget(lockdir, int(CONFIG['ConversionCpuBudget']))
+
+
 def convert_image(request):
     """
     Convert the image to the required format for the target system
@@ -240,10 +408,65 @@ def convert_image(request):
     imagefile = os.path.join(edir, '%s.%s' % (request['id'], fmt))
     request['imagefile'] = imagefile
 
-    status = converters.convert(fmt, request['expandedpath'], imagefile)
+    if request.get('cached'):
+        # fetch_cached_image already put the image in place
+        return True
+
+    # per-platform tuning of the conversion
+    profile = _conversion_profile(request)
+
+    budget = None
+    if fmt == 'squashfs':
+        budget = _cpu_budget()
+    wait_start = time()
+    if budget is not None:
+        profile['processors'] = budget.acquire(
+            int(profile.get('processors', budget.cores)))
+    stats = {
+        'format': fmt,
+        'size': 0,
+        'processors': profile.get('processors'),
+        'compressor': profile.get('compressor'),
+        'blockSize': profile.get('blockSize')
+    }
+    start = time()
+    try:
+        status = converters.convert(fmt, request.get('expandedpath'),
+                                    imagefile,
+                                    layer_stream=request.get('layer_stream'),
+                                    profile=profile, stats=stats)
+    finally:
+        if budget is not None:
+            budget.release()
+    stats['seconds'] = round(time() - start, 3)
+    stats['wait_seconds'] = round(start - wait_start, 3)
+    if os.path.exists(imagefile):
+        fstat = os.stat(imagefile)
+        stats['size'] = fstat.st_size
+        # what the (possibly sparse) image really occupies
+        stats['allocated'] = fstat.st_blocks * 512
+    request['meta']['conversion'] = stats
+    logging.info("Worker: converted %s in %.1fs to %d bytes (%s processors)",
+                 request['id'], stats['seconds'], stats['size'],
+                 stats['processors'])
+
+    cache = _image_cache()
+    if status and cache is not None:
+        cache.store(_image_cache_key(request), imagefile)
+        logging.info("Worker: image cache stats: %s", cache.get_stats())
     return status
 
 
+def _replica_dirs(system):
+    """
+    Returns the directories holding the extra copies of images on the
+    system.
+    """
+    sysconf = CONFIG['Platforms'].get(system, {})
+    return transfer.replica_dirs(sysconf, CONFIG.get('DefaultReplication', 1),
+                                 logging)
+
+
 def write_metadata(request):
     """
     Write out the metadata file
@@ -256,6 +479,16 @@ def write_metadata(request):
         meta['userACL'] = request['userACL']
     if 'groupACL' in request:
         meta['groupACL'] = request['groupACL']
+    # the placement is per system, drop what a fan-out source recorded
+    for key in ('replicas', 'ostcount', 'stripe_size'):
+        meta.pop(key, None)
+    # the runtime picks the image in imageBasePath or one of the replicas
+    # by node
+    replicas = _replica_dirs(request['system'])
+    meta['replication'] = str(len(replicas) + 1)
+    if len(replicas) > 0:
+        sysconf = CONFIG['Platforms'][request['system']]
+        meta['replicas'] = transfer.replica_base_paths(sysconf, replicas)
 
     edir = CONFIG['ExpandDirectory']
 
@@ -291,7 +524,7 @@ def check_image(request):
     image_metadata = "%s.meta" % (request['id'])
 
     return transfer.imagevalid(sysconf, image_filename, image_metadata,
-                               logging)
+                               logging, replicas=_replica_dirs(system))
 
 
 def transfer_image(request, meta_only=False):
@@ -310,8 +543,14 @@ def transfer_image(request, meta_only=False):
     if meta_only:
         request['meta']['meta_only'] = True
         return transfer.transfer(sysconf, None, meta, logging)
-    else:
-        return transfer.transfer(sysconf, request['imagefile'], meta, logging)
+    layout = {}
+    status = transfer.transfer(sysconf, request['imagefile'], meta, logging,
+                               ostcount=CONFIG.get('DefaultOstCount', 0),
+                               layout=layout,
+                               replicas=_replica_dirs(system))
+    # record the Lustre layout the image was placed with
+    request['meta'].update(layout)
+    return status
 
 
 def remove_image(request):
@@ -328,13 +567,29 @@ def remove_image(request):
     meta = request['id'] + '.meta'
     if 'metafile' in request:
         meta = request['metafile']
-    return transfer.remove(sysconf, imagefile, meta, logging)
+    status = transfer.remove(sysconf, imagefile, meta, logging,
+                             replicas=_replica_dirs(system))
+    layer_cache = _layer_cache()
+    if layer_cache is not None:
+        # its layers are evicted first unless another image uses them
+        layer_cache.remove_refs(_layer_ref(request))
+    return status
 
 
 def cleanup_temporary(request):
     """
     Helper function to cleanup any temporary files or directories.
     """
+    pin = request.pop('layer_pin', None)
+    if pin is not None:
+        pin.release()
+        try:
+            evicted = _layer_cache().evict()
+            if evicted > 0:
+                logging.info("Worker: evicted %d layers", evicted)
+        except:
+            logging.error("Worker: layer cache eviction failed: %s",
+                          sys.exc_value)
     items = ('expandedpath', 'imagefile', 'metafile')
     for item in items:
         if item not in request or request[item] is None:
@@ -353,9 +608,8 @@ def cleanup_temporary(request):
         if os.path.exists(cleanitem):
             logging.info("Worker: removing %s", cleanitem)
             try:
-                subprocess.call(['chmod', '-R', 'u+w', cleanitem])
                 if os.path.isdir(cleanitem):
-                    shutil.rmtree(cleanitem, ignore_errors=True)
+                    rmtree(cleanitem)
                 else:
                     os.unlink(cleanitem)
             except:
@@ -451,6 +705,51 @@ def dopull(self, request, testmode=0):
     return pull(request, updater, testmode=testmode)
 
 
+def transfer_cached(request, updater, testmode=0):
+    """
+    Celery task to transfer an image that was converted for another
+    platform (see fan-out in the image manager) out of the image cache.  If
+    it is no longer cached this falls back to the full pull workflow.
+    """
+    logging.debug("dotransfer system=%s tag=%s", request['system'],
+                  request['tag'])
+    if testmode == 1:
+        for state in ('TRANSFER', 'READY'):
+            updater.update_status(state, state)
+            sleep(1)
+        return request['meta']
+    elif testmode == 2:
+        raise OSError('task failed')
+    if not fetch_cached_image(request):
+        logging.info("Worker: %s not cached, pulling it", request['id'])
+        return pull(request, updater)
+    try:
+        request['format'] = get_image_format(request)
+        if not write_metadata(request):
+            raise OSError('Metadata creation failed')
+        updater.update_status('TRANSFER', 'Transferring image')
+        if not transfer_image(request):
+            raise OSError('Transfer failed')
+        updater.update_status('READY', 'Image ready')
+        cleanup_temporary(request)
+        return request['meta']
+    except:
+        logging.error("ERROR: dotransfer failed system=%s tag=%s",
+                      request['system'], request['tag'])
+        updater.update_state('FAILURE', 'FAILED')
+        cleanup_temporary(request)
+        raise
+
+
+@QUEUE.task(bind=True)
+def dotransfer(self, request, testmode=0):
+    """
+    Celery task to transfer an already converted image to another platform
+    """
+    updater = Updater(self.update_state)
+    return transfer_cached(request, updater, testmode=testmode)
+
+
 @QUEUE.task(bind=True)
 def doexpire(self, request, testmode=0):
     """
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# Shifter, Copyright (c) 2015, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Managed cache of downloaded layer blobs.
+
+Blobs are stored in a two level sharded layout under the cache directory
+(<cachedir>/ab/cd/sha256:abcd....tar) together with their sidecar files.
+The cache tracks when each blob was last used and which images reference
+it, and evicts least recently used blobs once it grows over a byte quota.
+Blobs pinned by in-flight pulls are never evicted.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+from time import time
+from shifter_imagegw.util import flocked, read_counters, bump_counters
+
+_STATS_FILE = 'stats.json'
+_LOCK_FILE = '.lock'
+_PINS_DIR = 'pins'
+_REFS_DIR = 'refs'
+_COUNTERS = ('hits', 'misses', 'bytes_saved', 'bytes_downloaded',
+             'duplicates_avoided', 'evictions', 'bytes_evicted')
+# files kept next to a blob (checksum marker, member index)
+_SIDECARS = ('.verified', '.index')
+
+
+def _makedirs(path):
+    """os.makedirs that tolerates a concurrent creation."""
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+
+def layer_path(cachedir, digest):
+    """Returns the sharded path of the blob digest in cachedir."""
+    value = digest.split(':', 1)[-1]
+    return os.path.join(cachedir, value[0:2], value[2:4], '%s.tar' % digest)
+
+
+class LayerPin(object):
+    """
+    Keeps a set of blobs from being evicted until released.  The pin is a
+    file in the pins directory holding a shared flock, so pins left by a
+    worker that died are recognized (and dropped) by the evictor.
+    """
+
+    def __init__(self, pins_dir, digests):
+        (pin_fd, pin_fn) = tempfile.mkstemp('.tmp', 'pin', pins_dir)
+        fcntl.flock(pin_fd, fcntl.LOCK_SH)
+        os.write(pin_fd, json.dumps(list(digests)))
+        self.fdesc = pin_fd
+        self.path = pin_fn[:-len('.tmp')]
+        # only publish the pin once it is locked
+        os.rename(pin_fn, self.path)
+
+    def release(self):
+        """Unpin the blobs."""
+        if self.fdesc is None:
+            return
+        os.unlink(self.path)
+        os.close(self.fdesc)
+        self.fdesc = None
+
+
+class LayerCache(object):
+    """
+    Quota managed, sharded store of layer blobs.  A blob's atime records its
+    last use; mtimes are left alone since the sidecars are validated
+    against them.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pins_dir = os.path.join(path, _PINS_DIR)
+        self.refs_dir = os.path.join(path, _REFS_DIR)
+        _makedirs(self.pins_dir)
+        _makedirs(self.refs_dir)
+
+    def _locked(self):
+        """Serialize changes to the cache across workers."""
+        return flocked(os.path.join(self.path, _LOCK_FILE))
+
+    def _stats_file(self):
+        """Returns the path of the counters file."""
+        return os.path.join(self.path, _STATS_FILE)
+
+    def _migrate(self, digest):
+        """Move a blob stored by older versions (flat layout) into place."""
+        flat = os.path.join(self.path, '%s.tar' % digest)
+        sharded = layer_path(self.path, digest)
+        if not os.path.exists(flat) or os.path.exists(sharded):
+            return
+        _makedirs(os.path.dirname(sharded))
+        for suffix in _SIDECARS:
+            if os.path.exists(flat + suffix):
+                os.rename(flat + suffix, sharded + suffix)
+        os.rename(flat, sharded)
+
+    def pin(self, digests):
+        """
+        Pin the blobs of a pull and mark them used.  Returns a LayerPin to
+        release once the pull no longer needs them.
+        """
+        digests = set(digests)
+        pin = LayerPin(self.pins_dir, digests)
+        now = time()
+        for digest in digests:
+            self._migrate(digest)
+            path = layer_path(self.path, digest)
+            try:
+                os.utime(path, (now, os.stat(path).st_mtime))
+            except OSError:
+                pass
+        return pin
+
+    def add_refs(self, image_id, digests):
+        """Record that image_id is made of the blobs digests."""
+        (ref_fd, ref_fn) = tempfile.mkstemp('.partial', image_id,
+                                            self.refs_dir)
+        with os.fdopen(ref_fd, 'w') as ref_fp:
+            json.dump(sorted(set(digests)), ref_fp)
+        os.rename(ref_fn, os.path.join(self.refs_dir, image_id))
+
+    def remove_refs(self, image_id):
+        """Forget the blobs of image_id once the image is gone."""
+        try:
+            os.unlink(os.path.join(self.refs_dir, image_id))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _refcounts(self):
+        """Returns how many images reference each blob."""
+        counts = {}
+        for name in os.listdir(self.refs_dir):
+            if name.endswith('.partial'):
+                continue
+            try:
+                with open(os.path.join(self.refs_dir, name)) as ref_fp:
+                    digests = json.load(ref_fp)
+            except (IOError, ValueError):
+                continue
+            for digest in digests:
+                counts[digest] = counts.get(digest, 0) + 1
+        return counts
+
+    def _pinned(self):
+        """Returns the blobs pinned by live pins, dropping stale pins."""
+        pinned = set()
+        for name in os.listdir(self.pins_dir):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.pins_dir, name)
+            try:
+                pin_fp = open(path)
+            except IOError:
+                continue
+            try:
+                try:
+                    fcntl.flock(pin_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # nobody holds it anymore
+                    os.unlink(path)
+                    continue
+                except IOError:
+                    pass
+                try:
+                    pinned.update(json.load(pin_fp))
+                except ValueError:
+                    pass
+            finally:
+                pin_fp.close()
+        return pinned
+
+    def _blobs(self):
+        """Returns (digest, atime, size, path) of every blob."""
+        blobs = []
+        for (dirpath, _, filenames) in os.walk(self.path):
+            if dirpath == self.path:
+                continue
+            for name in filenames:
+                if not name.endswith('.tar'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    fstat = os.stat(path)
+                except OSError:
+                    continue
+                size = fstat.st_size
+                for suffix in _SIDECARS:
+                    if os.path.exists(path + suffix):
+                        size += os.path.getsize(path + suffix)
+                blobs.append((name[:-len('.tar')], fstat.st_atime, size,
+                              path))
+        return blobs
+
+    def record(self, layer_stats):
+        """
+        Add the hit/miss counts of a pull (see DockerV2Handle.layer_stats)
+        to the cache statistics.
+        """
+        amounts = {
+            'hits': layer_stats['hits'],
+            'misses': layer_stats['misses'],
+            'bytes_saved': layer_stats['bytes_hit'],
+            'bytes_downloaded': layer_stats['bytes_downloaded'],
+            'duplicates_avoided': layer_stats.get('duplicates_avoided', 0)
+        }
+        with self._locked():
+            bump_counters(self._stats_file(), _COUNTERS, amounts)
+
+    def evict(self):
+        """
+        Evict blobs until the cache fits its quota.  Blobs no image
+        references go first, then the least recently used; pinned blobs are
+        kept.  Returns the number evicted.
+        """
+        with self._locked():
+            blobs = self._blobs()
+            total = sum([x[2] for x in blobs])
+            if total <= self.max_bytes:
+                return 0
+            pinned = self._pinned()
+            refcounts = self._refcounts()
+            blobs.sort(key=lambda x: (refcounts.get(x[0], 0) > 0, x[1]))
+            evicted = 0
+            evicted_bytes = 0
+            for (digest, _, size, path) in blobs:
+                if total <= self.max_bytes:
+                    break
+                if digest in pinned:
+                    continue
+                for suffix in _SIDECARS:
+                    if os.path.exists(path + suffix):
+                        os.unlink(path + suffix)
+                os.unlink(path)
+                total -= size
+                evicted += 1
+                evicted_bytes += size
+            if evicted > 0:
+                bump_counters(self._stats_file(), _COUNTERS,
+                              {'evictions': evicted,
+                               'bytes_evicted': evicted_bytes})
+        return evicted
+
+    def get_stats(self):
+        """
+        Returns the cache counters along with the hit rate and the current
+        number and size of blobs.
+        """
+        with self._locked():
+            stats = read_counters(self._stats_file(), _COUNTERS)
+            blobs = self._blobs()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = 0.0
+        if lookups > 0:
+            stats['hit_rate'] = float(stats['hits']) / lookups
+        stats['blobs'] = len(blobs)
+        stats['bytes'] = sum([x[2] for x in blobs])
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -24,9 +24,272 @@ Will use local shell/copy commands to perform needed actions if the system has
 filesystems locally available.  Uses ssh for remote access to platforms.
 """
 
+import hashlib
 import os
+import tempfile
+import threading
+from functools import partial
+from time import time
 from subprocess import Popen, PIPE
 
+# striped transfers split files in multiples of this many bytes
+_STRIPE_BLOCK = 1024 * 1024
+# files smaller than this are sent in one piece unless stripeMinBytes says
+_STRIPE_MIN_BYTES = 256 * 1024 * 1024
+# images get a Lustre stripe for every this many bytes, up to the OST count
+_BYTES_PER_OST = 1024 * 1024 * 1024
+_LUSTRE_STRIPE_SIZE = '1M'
+# ssh and scp exit with this status if they could not reach the host
+_UNREACHABLE = 255
+
+
+class _HostUnreachable(OSError):
+    """A remote command could not reach its host."""
+
+
+class SshSessions(object):
+    """
+    Book keeping for multiplexed ssh connections.  When a system sets
+    multiplex in its ssh configuration, every ssh and scp to a host runs
+    over one OpenSSH master connection (ControlMaster) per user and host,
+    which outlives the commands by controlPersist seconds and is shared by
+    all transfers, checks and removals of the worker (and of the other
+    workers using the same controlDir).  A master older than controlMaxAge
+    seconds is closed so the next command opens a fresh one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    @staticmethod
+    def enabled(system):
+        """Returns True if ssh connections to system are multiplexed."""
+        return system.get('ssh', {}).get('multiplex', False) is True
+
+    @staticmethod
+    def control_path(system, hostname):
+        """Returns the control socket of the master for system's user."""
+        sshconf = system['ssh']
+        control_dir = sshconf.get('controlDir',
+                                  os.path.join(tempfile.gettempdir(),
+                                               'shifter-ssh'))
+        target = '%s@%s' % (sshconf['username'], hostname)
+        # sockets paths are limited to ~100 characters, keep them short
+        return os.path.join(control_dir,
+                            hashlib.sha1(target).hexdigest()[0:16])
+
+    def options(self, system, hostname):
+        """
+        Returns the ssh options to run a command over the master connection
+        to hostname and accounts for the command.  Masters are counted as
+        opened once their control socket shows up, commands that find one
+        as reusing it.
+        """
+        sshconf = system['ssh']
+        path = self.control_path(system, hostname)
+        control_dir = os.path.dirname(path)
+        if not os.path.exists(control_dir):
+            try:
+                os.makedirs(control_dir, 0700)
+            except OSError:
+                pass
+        max_age = sshconf.get('controlMaxAge', 3600)
+        target = '%s@%s' % (sshconf['username'], hostname)
+        recycle = False
+        with self.lock:
+            stats = self.stats.setdefault(target, {'opened': 0, 'reused': 0,
+                                                   'recycled': 0,
+                                                   'path': path,
+                                                   'started': None,
+                                                   'retired': None})
+            stats['max_age'] = max_age
+            started = self._note_master(stats)
+            if self._expired(stats, started):
+                # only one command closes it
+                recycle = started != stats['retired']
+                if recycle:
+                    stats['recycled'] += 1
+                    stats['retired'] = started
+                stats['started'] = None
+            elif started is not None:
+                stats['reused'] += 1
+        if recycle:
+            self.close(system, hostname)
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % path,
+                '-o', 'ControlPersist=%d' % sshconf.get('controlPersist', 300)]
+
+    @staticmethod
+    def _note_master(stats):
+        """
+        Returns the start time of the master behind stats' control socket,
+        counting it as opened when it was not seen before (and is not
+        about to be recycled).
+        """
+        try:
+            started = os.stat(stats['path']).st_mtime
+        except OSError:
+            stats['started'] = None
+            return None
+        if started != stats['started'] and started != stats['retired'] and \
+                not SshSessions._expired(stats, started):
+            stats['opened'] += 1
+            stats['started'] = started
+        return started
+
+    @staticmethod
+    def _expired(stats, started):
+        """Returns True if a master started then is due to be recycled."""
+        return started is not None and stats['max_age'] is not None and \
+            time() - started > stats['max_age']
+
+    def close(self, system, hostname):
+        """Ask the master connection to hostname to exit."""
+        path = self.control_path(system, hostname)
+        cmd = ['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit',
+               '%s@%s' % (system['ssh']['username'], hostname)]
+        try:
+            _exec_and_log(cmd, None)
+        except OSError:
+            pass
+
+    def get_stats(self):
+        """
+        Returns, by user@host, how many master connections were opened,
+        reused and recycled and the age of the current one.
+        """
+        now = time()
+        stats = {}
+        with self.lock:
+            for (target, counters) in self.stats.items():
+                self._note_master(counters)
+                stats[target] = dict(counters)
+                del stats[target]['path']
+                del stats[target]['retired']
+                del stats[target]['max_age']
+                started = stats[target].pop('started')
+                stats[target]['age'] = 0
+                if started is not None:
+                    stats[target]['age'] = int(now - started)
+        return stats
+
+
+SSH_SESSIONS = SshSessions()
+
+
+class HostPool(object):
+    """
+    Spreads remote operations over all the hosts of a system (e.g., its
+    data transfer nodes) and fails over between them.  Hosts are ordered
+    per the system's hostSelection: 'leastLoaded' (default) prefers the
+    host with the fewest transfers in flight from this worker, 'roundRobin'
+    rotates through them and 'first' keeps the configured order.  A host an
+    operation failed on is skipped for hostRetryInterval seconds and probed
+    before it is used again.  Per-host throughput is recorded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.turns = {}
+
+    def _host(self, hostname):
+        """Returns the state of hostname (lock held)."""
+        return self.hosts.setdefault(hostname, {
+            'active': 0, 'transfers': 0, 'failures': 0, 'bytes': 0,
+            'seconds': 0.0, 'down_until': 0
+        })
+
+    def candidates(self, system, logger=None):
+        """
+        Returns the hosts of system to try, in order.  Hosts that are down
+        come last; those due for a retry are probed first.
+        """
+        hosts = list(system['host'])
+        policy = system['ssh'].get('hostSelection', 'leastLoaded')
+        now = time()
+        with self.lock:
+            if policy != 'first':
+                turn = self.turns.get(tuple(hosts), 0)
+                self.turns[tuple(hosts)] = turn + 1
+                turn = turn % len(hosts)
+                hosts = hosts[turn:] + hosts[:turn]
+            if policy == 'leastLoaded':
+                hosts.sort(key=lambda x: self._host(x)['active'])
+            down = [x for x in hosts if self._host(x)['down_until'] > now]
+            due = [x for x in hosts if x not in down and
+                   self._host(x)['down_until'] > 0]
+        for hostname in due:
+            if not self.probe(system, hostname, logger):
+                down.append(hostname)
+        up = [x for x in hosts if x not in down]
+        return up + sorted(down, key=lambda x: self.hosts[x]['down_until'])
+
+    def probe(self, system, hostname, logger=None):
+        """Check that hostname accepts ssh again after it failed."""
+        ret = _exec_and_log(_ssh_cmd(system, 'true', hostname=hostname),
+                            logger)
+        if ret == 0:
+            with self.lock:
+                self._host(hostname)['down_until'] = 0
+            return True
+        self.failed(system, hostname)
+        return False
+
+    def is_up(self, hostname):
+        """Returns False while hostname is skipped after a failure."""
+        with self.lock:
+            return self._host(hostname)['down_until'] <= time()
+
+    def start(self, hostname):
+        """Account a transfer starting on hostname."""
+        with self.lock:
+            self._host(hostname)['active'] += 1
+
+    def finish(self, hostname, nbytes, seconds):
+        """Account a transfer to hostname ending (nbytes is 0 on failure)."""
+        with self.lock:
+            host = self._host(hostname)
+            host['active'] -= 1
+            if nbytes > 0:
+                host['transfers'] += 1
+                host['bytes'] += nbytes
+                host['seconds'] += seconds
+
+    def failed(self, system, hostname):
+        """Skip hostname for a while."""
+        interval = system['ssh'].get('hostRetryInterval', 60)
+        with self.lock:
+            host = self._host(hostname)
+            host['failures'] += 1
+            host['down_until'] = time() + interval
+
+    def get_stats(self):
+        """
+        Returns, by host, the transfers done and in flight, failures,
+        bytes moved and the throughput in bytes per second.
+        """
+        now = time()
+        stats = {}
+        with self.lock:
+            for (hostname, host) in self.hosts.items():
+                stats[hostname] = {
+                    'active': host['active'],
+                    'transfers': host['transfers'],
+                    'failures': host['failures'],
+                    'bytes': host['bytes'],
+                    'throughput': 0,
+                    'up': host['down_until'] <= now
+                }
+                if host['seconds'] > 0:
+                    stats[hostname]['throughput'] = \
+                        int(host['bytes'] / host['seconds'])
+        return stats
+
+
+HOST_POOL = HostPool()
+
 
 def _sh_cmd(system, *args):
     """
@@ -44,21 +307,22 @@ def _cp_cmd(system, localfile, targetfile):
     return ['cp', localfile, targetfile]
 
 
-def _ssh_cmd(system, *args):
+def _ssh_cmd(system, *args, **kwargs):
     """
-    Helper function to build a remote shell command
+    Helper function to build a remote shell command, run on the hostname
+    keyword argument (or the first host of the system)
     """
     if len(args) == 0:
         return None
 
     ssh = ['ssh']
 
-    # TODO think about if the host selection needs to be smarter
-    # also, is this guaranteed to be an iterable object?
-    hostname = system['host'][0]
+    hostname = kwargs.get('hostname', system['host'][0])
     username = system['ssh']['username']
     if 'key' in system['ssh']:
         ssh.extend(['-i', '%s' % system['ssh']['key']])
+    if SSH_SESSIONS.enabled(system):
+        ssh.extend(SSH_SESSIONS.options(system, hostname))
     if 'sshCmdOptions' in system['ssh']:
         ssh.extend(system['ssh']['sshCmdOptions'])
     ssh.extend(['%s@%s' % (username, hostname)])
@@ -66,18 +330,19 @@ def _ssh_cmd(system, *args):
     return ssh
 
 
-def _scp_cmd(system, localfile, remotefile):
+def _scp_cmd(system, localfile, remotefile, hostname=None):
     """
     Helper function to build a remote copy command
     """
     ssh = ['scp']
 
-    # TODO think about if the host selection needs to be smarter
-    # also, is this guaranteed to be an iterable object?
-    hostname = system['host'][0]
+    if hostname is None:
+        hostname = system['host'][0]
     username = system['ssh']['username']
     if 'key' in system['ssh']:
         ssh.extend(['-i', '%s' % system['ssh']['key']])
+    if SSH_SESSIONS.enabled(system):
+        ssh.extend(SSH_SESSIONS.options(system, hostname))
     if 'scpCmdOptions' in system['ssh']:
         ssh.extend(system['ssh']['scpCmdOptions'])
     ssh.extend([localfile, '%s@%s:%s' % (username, hostname, remotefile)])
@@ -104,12 +369,187 @@ def _exec_and_log(cmd, logger):
     return proc.returncode
 
 
+def _stripe_ranges(size, stripes):
+    """
+    Split size bytes into up to stripes (offset, length) ranges starting on
+    _STRIPE_BLOCK boundaries.
+    """
+    blocks = (size + _STRIPE_BLOCK - 1) / _STRIPE_BLOCK
+    per_stripe = max(1, (blocks + stripes - 1) / stripes) * _STRIPE_BLOCK
+    return [(offset, min(per_stripe, size - offset))
+            for offset in range(0, size, per_stripe)]
+
+
+def _send_stripe(filename, offset, length, cmd, logger=None):
+    """
+    Stream length bytes of filename from offset into cmd.  Returns the exit
+    status of cmd.
+    """
+    if logger is not None:
+        logger.info("about to exec: %s" % ' '.join(cmd))
+    # other stripes' pipes must not leak into this child
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
+    try:
+        with open(filename, 'rb') as in_fp:
+            in_fp.seek(offset)
+            remaining = length
+            while remaining > 0:
+                buff = in_fp.read(min(remaining, 4 * _STRIPE_BLOCK))
+                if len(buff) == 0:
+                    break
+                proc.stdin.write(buff)
+                remaining -= len(buff)
+    except IOError:
+        # the remote end went away, its status tells why
+        pass
+    stderr = proc.communicate()[1]
+    if proc.returncode != 0 and logger is not None:
+        logger.error("%s stderr: %s" % (cmd[0], stderr.strip()))
+    return proc.returncode
+
+
+def _striped_copy(filename, temp_fn, system, hosts, logger=None):
+    """
+    Copy filename into the pre-created temp_fn on the system in
+    transferStripes concurrent ranges, each streamed over its own ssh
+    channel into dd at its offset and spread over hosts.  The sha256 of
+    the whole file is verified afterwards.  Returns 0 on success, like the
+    copy commands.
+    """
+    stripes = _stripe_ranges(os.path.getsize(filename),
+                             int(system['ssh']['transferStripes']))
+    results = [None] * len(stripes)
+    local_sum = hashlib.sha256()
+
+    def _checksum():
+        """Thread body: hash the local file."""
+        with open(filename, 'rb') as in_fp:
+            while True:
+                buff = in_fp.read(4 * _STRIPE_BLOCK)
+                if len(buff) == 0:
+                    break
+                local_sum.update(buff)
+
+    def _stripe(idx):
+        """Thread body: send one stripe."""
+        (offset, length) = stripes[idx]
+        cmd = _ssh_cmd(system, 'dd', 'of=%s' % temp_fn,
+                       'bs=%d' % _STRIPE_BLOCK,
+                       'seek=%d' % (offset / _STRIPE_BLOCK), 'conv=notrunc',
+                       hostname=hosts[idx % len(hosts)])
+        try:
+            results[idx] = _send_stripe(filename, offset, length, cmd, logger)
+        except OSError:
+            results[idx] = _UNREACHABLE
+
+    threads = [threading.Thread(target=_checksum)]
+    for idx in range(len(stripes)):
+        threads.append(threading.Thread(target=_stripe, args=(idx,)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if any([x != 0 for x in results]):
+        if logger is not None:
+            logger.error("Striped copy of %s failed: %s"
+                         % (filename, str(results)))
+        if _UNREACHABLE in results:
+            return _UNREACHABLE
+        return 1
+
+    cmd = _ssh_cmd(system, 'sha256sum', temp_fn, hostname=hosts[0])
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    stdout = proc.communicate()[0]
+    if proc.returncode == _UNREACHABLE:
+        return _UNREACHABLE
+    remote_sum = None
+    if proc.returncode == 0 and len(stdout.split()) > 0:
+        remote_sum = stdout.split()[0]
+    if remote_sum != local_sum.hexdigest():
+        if logger is not None:
+            logger.error("Checksum mismatch after striped copy of %s"
+                         % filename)
+        return 1
+    return 0
+
+
+def stripe_layout(system, nbytes, ostcount):
+    """
+    Returns the Lustre layout (stripe count, stripe size) to place a file of
+    nbytes on the system with, or None to keep the filesystem default.  The
+    file gets a stripe per lustreBytesPerOst bytes, up to ostcount OSTs (or
+    the ostCount of the system).
+    """
+    ostcount = int(system.get('ostCount', ostcount or 0))
+    if ostcount <= 0:
+        return None
+    per_ost = int(system.get('lustreBytesPerOst', _BYTES_PER_OST))
+    count = min(ostcount, max(1, (nbytes + per_ost - 1) / per_ost))
+    return (count, str(system.get('lustreStripeSize', _LUSTRE_STRIPE_SIZE)))
+
+
+def replica_dirs(system, replication, logger=None):
+    """
+    Returns the directories holding the extra copies of images placed on
+    the system replication times (or the replication of the system).  The
+    first copy is in imageDir, the others in the leading replicaDirs.
+    """
+    replication = int(system.get('replication', replication or 1))
+    dirs = system.get('replicaDirs', [])
+    if replication - 1 > len(dirs) and logger is not None:
+        logger.warning("Only %d replicaDirs for %d replicas"
+                       % (len(dirs), replication))
+    return dirs[:max(0, replication - 1)]
+
+
+def replica_base_paths(system, replicas):
+    """
+    Returns where the compute nodes find the replicas directories, for the
+    REPLICAS line of the metadata: the matching entries of the system's
+    replicaBasePaths (the replicaDirs as mounted on the nodes, like
+    imageBasePath in udiRoot.conf), or the replicaDirs themselves.
+    """
+    base_paths = system.get('replicaBasePaths', system.get('replicaDirs', []))
+    if len(base_paths) < len(replicas):
+        raise ValueError('replicaBasePaths needs an entry for every '
+                         'replicaDirs entry')
+    return base_paths[:len(replicas)]
+
+
+def _set_stripe(temp_fn, stripe, sh_cmd, system, logger=None):
+    """
+    Replace the pre-created temp_fn with a file laid out with the Lustre
+    layout stripe.  Returns False if the target is not on Lustre (or has no
+    lfs), in which case temp_fn is kept and the copy fills it with the
+    default layout.
+    """
+    # lfs can only set the layout of a file it creates, so it creates one
+    # next to temp_fn (whose name is ours) which then takes its place
+    striped_fn = '%s.lfs' % temp_fn
+    cmd = sh_cmd(system, 'lfs', 'setstripe', '-c', str(stripe[0]),
+                  '-S', stripe[1], striped_fn)
+    try:
+        ret = _exec_and_log(cmd, logger)
+        if ret == 0:
+            ret = _exec_and_log(sh_cmd(system, 'mv', '-f', striped_fn,
+                                       temp_fn), logger)
+        if ret != 0:
+            _exec_and_log(sh_cmd(system, 'rm', '-f', striped_fn), logger)
+    except OSError:
+        ret = None
+    if ret == 0:
+        return True
+    if logger is not None:
+        logger.warning("Could not stripe %s, using the default layout"
+                       % temp_fn)
+    return False
+
+
 def pre_create_tempfile(basepath, filename, sh_cmd, system, logger=None):
     """
     Generate a tempfile for filename on the system
     """
 
-    # TODO: Add command to setup the file with the right striping
     partial_fn = '%s.XXXXXX.partial' % filename
     temp_fn = os.path.join(basepath, partial_fn)
 
@@ -125,31 +565,91 @@ def pre_create_tempfile(basepath, filename, sh_cmd, system, logger=None):
         else:
             memo = 'Failed to precreate transfer file, %s (%d)' \
                    % (stderr, proc.returncode)
+            if proc.returncode == _UNREACHABLE:
+                raise _HostUnreachable(memo)
             raise OSError(memo)
         if len(stderr) > 0 and logger is not None:
             logger.error("%s stderr: %s" % (cmd[0], stderr.strip()))
     return temp_fn
 
 
-def copy_file(filename, system, logger=None):
+def copy_file(filename, system, logger=None, ostcount=0, layout=None,
+              basepath=None):
     """
-    Copy a file to the specified system
+    Copy a file to the specified system, into basepath instead of its
+    imageDir if set.  If ostcount is set the file is striped over up to
+    that many Lustre OSTs (see stripe_layout) and the layout used is
+    recorded in the layout dictionary, if one is given.  Remote copies
+    fail over to the next host only if a host cannot be reached.
     """
-    sh_cmd = None
-    cp_cmd = None
-    basepath = None
+    nbytes = os.path.getsize(filename)
+    stripe = stripe_layout(system, nbytes, ostcount)
     if system['accesstype'] == 'local':
-        sh_cmd = _sh_cmd
-        cp_cmd = _cp_cmd
-        basepath = system['local']['imageDir']
-    elif system['accesstype'] == 'remote':
-        sh_cmd = _ssh_cmd
-        cp_cmd = _scp_cmd
-        basepath = system['ssh']['imageDir']
-    else:
+        if basepath is None:
+            basepath = system['local']['imageDir']
+        return _copy_file(filename, basepath, _sh_cmd,
+                          _cp_cmd, system, logger, stripe=stripe,
+                          layout=layout)
+    elif system['accesstype'] != 'remote':
         memo = '%s is not supported as a transfer type' % system['accesstype']
         raise NotImplementedError(memo)
 
+    # try the hosts in turn until one that can be reached takes the file;
+    # other failures fail the copy without holding them against the host
+    sshconf = system['ssh']
+    if basepath is None:
+        basepath = sshconf['imageDir']
+    striped = int(sshconf.get('transferStripes', 1)) > 1 and \
+        nbytes >= int(sshconf.get('stripeMinBytes', _STRIPE_MIN_BYTES))
+    error = None
+    candidates = HOST_POOL.candidates(system, logger)
+    for hostname in candidates:
+        copier = None
+        if striped:
+            hosts = [hostname]
+            if sshconf.get('stripeAcrossHosts', False):
+                hosts.extend([x for x in candidates
+                              if x != hostname and HOST_POOL.is_up(x)])
+            copier = partial(_striped_copy, system=system, hosts=hosts,
+                             logger=logger)
+        HOST_POOL.start(hostname)
+        start = time()
+        copied = False
+        try:
+            copied = _copy_file(filename, basepath,
+                                partial(_ssh_cmd, hostname=hostname),
+                                partial(_scp_cmd, hostname=hostname),
+                                system, logger, copier, stripe, layout)
+        except _HostUnreachable as err:
+            error = err
+        except OSError as err:
+            # raised with an errno when ssh or scp could not be run at all
+            if err.errno is None:
+                raise
+            error = err
+        finally:
+            HOST_POOL.finish(hostname, nbytes if copied else 0,
+                             time() - start)
+        if copied:
+            return True
+        if error is None:
+            return False
+        HOST_POOL.failed(system, hostname)
+        if logger is not None:
+            logger.warning("Copy of %s to %s failed, trying the next host"
+                           % (filename, hostname))
+    if error is not None:
+        raise error
+    return False
+
+
+def _copy_file(filename, basepath, sh_cmd, cp_cmd, system, logger=None,
+               copier=None, stripe=None, layout=None):
+    """
+    Copy a file into basepath with the given shell and copy commands, or
+    with copier(filename, temp_fn) if set.  The file is placed with the
+    Lustre layout stripe, falling back to the default layout.
+    """
     image_fn = os.path.split(filename)[1]
     target_fn = os.path.join(basepath, image_fn)
 
@@ -164,10 +664,20 @@ def copy_file(filename, system, logger=None):
                % temp_fn
         raise OSError(memo)
 
+    if stripe is not None and \
+            not _set_stripe(temp_fn, stripe, sh_cmd, system, logger):
+        stripe = None
+
     copyret = None
     try:
-        copy = cp_cmd(system, filename, temp_fn)
-        copyret = _exec_and_log(copy, logger)
+        if copier is not None:
+            copyret = copier(filename, temp_fn)
+        else:
+            copy = cp_cmd(system, filename, temp_fn)
+            copyret = _exec_and_log(copy, logger)
+        if copyret == _UNREACHABLE:
+            raise _HostUnreachable('Failed to copy %s to %s'
+                                   % (filename, temp_fn))
     except:
         rm_cmd = sh_cmd(system, 'rm', temp_fn)
         _exec_and_log(rm_cmd, logger)
@@ -177,6 +687,14 @@ def copy_file(filename, system, logger=None):
         try:
             mv_cmd = sh_cmd(system, 'mv', temp_fn, target_fn)
             ret = _exec_and_log(mv_cmd, logger)
+            if ret == _UNREACHABLE:
+                raise _HostUnreachable('Failed to move %s to %s'
+                                       % (temp_fn, target_fn))
+            if ret == 0 and layout is not None:
+                layout['ostcount'] = '0'
+                if stripe is not None:
+                    layout['ostcount'] = str(stripe[0])
+                    layout['stripe_size'] = stripe[1]
             return ret == 0
         except:
             # TODO we might also need to remove target_fn in this case
@@ -186,68 +704,101 @@ def copy_file(filename, system, logger=None):
     return False
 
 
-def remove_file(filename, system, logger=None):
+def _remote_exec(system, logger, *args):
     """
-    Remove the specified file from the system
+    Run a command on the first host of the system that can be reached,
+    failing over to the others.  Returns the exit status.
     """
-    sh_cmd = None
-    basepath = None
-    if system['accesstype'] == 'local':
-        sh_cmd = _sh_cmd
+    ret = None
+    for hostname in HOST_POOL.candidates(system, logger):
+        ret = _exec_and_log(_ssh_cmd(system, *args, hostname=hostname),
+                            logger)
+        if ret != _UNREACHABLE:
+            return ret
+        HOST_POOL.failed(system, hostname)
+    return ret
+
+
+def remove_file(filename, system, logger=None, basepath=None):
+    """
+    Remove the specified file from the system (from basepath if set)
+    """
+    if basepath is None and system['accesstype'] == 'local':
         basepath = system['local']['imageDir']
-    elif system['accesstype'] == 'remote':
-        sh_cmd = _ssh_cmd
+    elif basepath is None and system['accesstype'] == 'remote':
         basepath = system['ssh']['imageDir']
     image_fn = os.path.split(filename)[1]
     target_fn = os.path.join(basepath, image_fn)
-    rm_cmd = sh_cmd(system, 'rm', '-f', target_fn)
-    _exec_and_log(rm_cmd, logger)
+    if system['accesstype'] == 'remote':
+        _remote_exec(system, logger, 'rm', '-f', target_fn)
+    else:
+        _exec_and_log(_sh_cmd(system, 'rm', '-f', target_fn), logger)
     return True
 
 
-def check_file(filename, system, logger=None):
+def check_file(filename, system, logger=None, basepath=None):
     """
-    check the validatity of a file on the system
+    check the validatity of a file on the system (in basepath if set)
     """
-    sh_cmd = None
-    basepath = None
-    if system['accesstype'] == 'local':
-        sh_cmd = _sh_cmd
+    if basepath is None and system['accesstype'] == 'local':
         basepath = system['local']['imageDir']
-    elif system['accesstype'] == 'remote':
-        sh_cmd = _ssh_cmd
+    elif basepath is None and system['accesstype'] == 'remote':
         basepath = system['ssh']['imageDir']
     image_fn = os.path.split(filename)[1]
     target_fn = os.path.join(basepath, image_fn)
-    ls_cmd = sh_cmd(system, 'ls', target_fn)
-    ret = _exec_and_log(ls_cmd, logger)
+    if system['accesstype'] == 'remote':
+        ret = _remote_exec(system, logger, 'ls', target_fn)
+    else:
+        ret = _exec_and_log(_sh_cmd(system, 'ls', target_fn), logger)
 
     if ret == 0:
         return True
     return False
 
 
-def transfer(system, image_path, metadata_path=None, logger=None):
+def transfer(system, image_path, metadata_path=None, logger=None,
+             ostcount=0, layout=None, replicas=None):
     """
-    transfer an image and its metadata to the system
+    transfer an image and its metadata to the system, striping the image
+    over up to ostcount Lustre OSTs (see copy_file).  Extra copies of the
+    image are placed in the replicas directories.
     """
     # TODO: Catch copy_file fail here
     if metadata_path is not None:
         copy_file(metadata_path, system, logger)
+    # place the replicas first so the image in imageDir always has them
+    for basepath in replicas or []:
+        if image_path is None:
+            break
+        if not copy_file(image_path, system, logger, ostcount,
+                         basepath=basepath):
+            if logger is not None:
+                logger.error("Transfer of %s to %s failed"
+                             % (image_path, basepath))
+            return False
     # If image path is None then we are just transferring the meatfile
-    if image_path is None or copy_file(image_path, system, logger):
+    if image_path is None or copy_file(image_path, system, logger,
+                                       ostcount, layout):
+        if logger is not None and system['accesstype'] == 'remote':
+            logger.info("transfer host stats: %s" % HOST_POOL.get_stats())
+            if SSH_SESSIONS.enabled(system):
+                logger.info("ssh session stats: %s"
+                            % SSH_SESSIONS.get_stats())
         return True
     if logger is not None:
         logger.error("Transfer of %s failed" % image_path)
     return False
 
 
-def remove(system, image_path, metadata_path=None, logger=None):
+def remove(system, image_path, metadata_path=None, logger=None,
+           replicas=None):
     """
-    remove an image and its metadata from the system
+    remove an image, its replicas and its metadata from the system
     """
     if metadata_path is not None:
         remove_file(metadata_path, system, logger)
+    for basepath in replicas or []:
+        remove_file(image_path, system, logger, basepath)
     if remove_file(image_path, system, logger):
         return True
     if logger is not None:
@@ -255,13 +806,18 @@ def remove(system, image_path, metadata_path=None, logger=None):
     return False
 
 
-def imagevalid(system, image_path, metadata_path=None, logger=None):
+def imagevalid(system, image_path, metadata_path=None, logger=None,
+               replicas=None):
     """
-    check if image exists on the system
+    check if image and its replicas exist on the system
     """
     metadata_ok = True
     if metadata_path is not None:
         metadata_ok = check_file(metadata_path, system, logger)
     image_ok = check_file(image_path, system, logger)
+    for basepath in replicas or []:
+        if not image_ok:
+            break
+        image_ok = check_file(image_path, system, logger, basepath)
 
     return metadata_ok and image_ok
@@ -27,7 +27,24 @@
 
 """
 
+import ctypes
+import errno
+import fcntl
+import json
 import os
+import resource
+import shutil
+import stat
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    _LIBC = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _LIBC = None
+# fallocate(2) flag reserving blocks without changing the file size
+_FALLOC_FL_KEEP_SIZE = 1
 
 def program_exists(program):
     """
@@ -68,3 +85,163 @@ def which(program):
                     return candidate
 
     return None
+
+def reset_peak_rss():
+    """
+    Reset the kernel's peak resident set size counter for this process so a
+    subsequent peak_rss_kb() reflects only what happened since.  Returns
+    False if the kernel does not support it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss_kb():
+    """
+    Returns the peak resident set size of this process in kilobytes.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def rmtree(path):
+    """
+    Remove a directory tree.  Permissions that get in the way are fixed up
+    as they are encountered rather than with a chmod walk of the whole tree
+    beforehand.
+    """
+    def _onerror(func, failed, exc_info):
+        """Make the failed path removable and try again."""
+        err = exc_info[1]
+        if isinstance(err, OSError) and err.errno == errno.ENOENT:
+            return
+        if not isinstance(err, OSError) or \
+                err.errno not in (errno.EACCES, errno.EPERM):
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if func is os.listdir:
+            # unreadable directory, open it up and remove it on its own
+            os.chmod(failed, stat.S_IRWXU)
+            shutil.rmtree(failed, onerror=_onerror)
+            return
+        os.chmod(os.path.dirname(failed), stat.S_IRWXU)
+        func(failed)
+
+    shutil.rmtree(path, onerror=_onerror)
+
+class CpuBudget(object):
+    """
+    Node-wide budget of cores shared by every process (e.g., each Celery
+    worker) that uses the same lock directory.  Each core is a lock file and
+    holding its flock is what claims the core, so cores held by a process
+    that dies are released by the kernel.
+    """
+
+    def __init__(self, lockdir, cores, poll=1):
+        if cores < 1:
+            raise ValueError('a cpu budget needs at least one core')
+        if not os.path.exists(lockdir):
+            try:
+                os.makedirs(lockdir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self.lockdir = lockdir
+        self.cores = cores
+        self.poll = poll
+        self.held = []
+
+    def acquire(self, wanted):
+        """
+        Claim up to wanted cores, waiting until at least one is free.
+        Returns the number of cores claimed.
+        """
+        wanted = max(1, min(wanted, self.cores))
+        while True:
+            for idx in range(self.cores):
+                if len(self.held) >= wanted:
+                    break
+                path = os.path.join(self.lockdir, 'cpu.%d.lock' % idx)
+                fdesc = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+                try:
+                    fcntl.flock(fdesc, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    os.close(fdesc)
+                    continue
+                self.held.append(fdesc)
+            if len(self.held) > 0:
+                return len(self.held)
+            time.sleep(self.poll)
+
+    def release(self):
+        """Give back every claimed core."""
+        for fdesc in self.held:
+            os.close(fdesc)
+        self.held = []
+
+@contextmanager
+def flocked(path):
+    """
+    Hold an exclusive flock on path (created if needed) for the duration of
+    a with block.
+    """
+    lock_fp = open(path, 'a')
+    try:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock_fp.close()
+
+def read_counters(path, names):
+    """
+    Returns the counters stored as JSON in path, with any of names that
+    are missing set to 0.
+    """
+    counters = dict((x, 0) for x in names)
+    try:
+        with open(path) as counters_fp:
+            counters.update(json.load(counters_fp))
+    except (IOError, ValueError):
+        pass
+    return counters
+
+def bump_counters(path, names, amounts):
+    """
+    Add amounts (a dictionary) to the JSON counters in path.  Callers
+    sharing path must serialize this, e.g., with flocked.
+    """
+    counters = read_counters(path, names)
+    for (name, amount) in amounts.items():
+        counters[name] = counters.get(name, 0) + amount
+    (dirname, fname) = os.path.split(path)
+    (out_fd, out_fn) = tempfile.mkstemp('.partial', fname, dirname)
+    with os.fdopen(out_fd, 'w') as counters_fp:
+        json.dump(counters, counters_fp)
+    os.rename(out_fn, path)
+    return counters
+
+def preallocate(fdesc, size):
+    """
+    Reserve size bytes of disk for the open file fdesc without changing its
+    apparent size, so a download filling it in is laid out contiguously and
+    a full disk is noticed up front.  Returns False where the platform or
+    filesystem does not support it; raises OSError if the space is not
+    available.
+    """
+    if size <= 0 or _LIBC is None or not hasattr(_LIBC, 'fallocate'):
+        return False
+    ret = _LIBC.fallocate(fdesc, _FALLOC_FL_KEEP_SIZE, ctypes.c_longlong(0),
+                          ctypes.c_longlong(size))
+    if ret == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EDQUOT):
+        raise OSError(err, os.strerror(err))
+    return False
@@ -17,6 +17,9 @@
 # See LICENSE for full text.
 
 import os
+import re
+import subprocess
+import tempfile
 import unittest
 from shifter_imagegw import converters
 
@@ -60,12 +63,134 @@ class ConvertersTestCase(unittest.TestCase):
         resp = converters.convert('cramfs', path, '/tmp/blah.cramfs')
         self.assertTrue(resp)
 
-        with self.assertRaises(NotImplementedError):
-            resp = converters.convert('ext4', path, '/tmp/blah.ext4')
+        if converters.mke2fs_populates():
+            ext4 = '%s/blah.ext4' % (self.outdir)
+            if os.path.exists(ext4):
+                os.unlink(ext4)
+            resp = converters.convert('ext4', path, ext4)
+            self.assertTrue(resp)
+            os.unlink(ext4)
+            path = self.make_fake()
 
         resp = converters.convert('squashfs', path, output)
         self.assertTrue(resp)
 
+    def test_convert_stream(self):
+        """
+        Test converting straight from a tar stream (mock sqfstar)
+        """
+        output = '%s/stream.squashfs' % (self.outdir)
+        if os.path.exists(output):
+            os.unlink(output)
+        self.assertTrue(converters.stream_supported('squashfs'))
+        self.assertFalse(converters.stream_supported('cramfs'))
+
+        def _write(fileobj):
+            fileobj.write('tarstream')
+
+        resp = converters.convert('squashfs', None, output,
+                                  layer_stream=_write)
+        self.assertTrue(resp)
+        with open(output) as fp:
+            self.assertEquals(fp.read(), 'tarstream')
+        os.unlink(output)
+
+        with self.assertRaises(NotImplementedError):
+            converters.convert('cramfs', None, output, layer_stream=_write)
+        self.assertFalse(os.path.exists(output))
+
+    def test_squashfs_options(self):
+        """
+        Test translating conversion profiles to tool options
+        """
+        profile = {'compressor': 'zstd', 'blockSize': 1048576,
+                   'processors': 4, 'noFragments': True, 'noXattrs': True,
+                   'options': ['-Xcompression-level', '19']}
+        self.assertEquals(converters.squashfs_options(None), [])
+        self.assertEquals(converters.squashfs_options(profile),
+                          ['-comp', 'zstd', '-b', '1048576', '-processors',
+                           '4', '-no-fragments', '-no-xattrs',
+                           '-Xcompression-level', '19'])
+        self.assertEquals(converters.squashfs_options(profile, 'tar2sqfs'),
+                          ['--compressor', 'zstd', '--block-size', '1048576',
+                           '--num-jobs', '4', '--no-xattr',
+                           '-Xcompression-level', '19'])
+
+    def test_choose_compressor(self):
+        """
+        Test benchmarking compressors on a sample (mock mksquashfs)
+        """
+        # images of an explicit size per compressor, xz reads slowly
+        bindir = tempfile.mkdtemp(dir=self.outdir)
+        with open(bindir + '/mksquashfs', 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'image=$2\n'
+                    'while [ $# -gt 0 ]; do\n'
+                    '  [ "$1" = "-comp" ] && comp=$2\n'
+                    '  shift\n'
+                    'done\n'
+                    'case "$comp" in\n'
+                    '  gzip) size=300 ;;\n'
+                    '  xz) size=100 ;;\n'
+                    '  *) size=500 ;;\n'
+                    'esac\n'
+                    'printf "%${size}s" "" > $image\n')
+        with open(bindir + '/unsquashfs', 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'case "$4" in\n'
+                    '  *xz*) /bin/sleep 1 ;;\n'
+                    'esac\n')
+        os.chmod(bindir + '/mksquashfs', 0755)
+        os.chmod(bindir + '/unsquashfs', 0755)
+        path = self.make_fake()
+        profile = {'compressor': 'auto', 'candidates': ['gzip', 'xz', 'lz4']}
+        orig_path = os.environ['PATH']
+        os.environ['PATH'] = bindir + ':' + orig_path
+        try:
+            (choice, report) = converters.choose_compressor(path, profile,
+                                                            self.outdir)
+            self.assertEquals(choice, 'xz')
+            self.assertEquals(report['objective'], 'smallest')
+            self.assertEquals(report['sample_bytes'], 4)
+            self.assertEquals(report['results']['gzip']['size'], 300)
+            self.assertEquals(sorted(report['results'].keys()),
+                              ['gzip', 'lz4', 'xz'])
+
+            profile['objective'] = 'fastestRead'
+            (choice, report) = converters.choose_compressor(path, profile,
+                                                            self.outdir)
+            self.assertEquals(choice, 'gzip')
+
+            profile['objective'] = 'bogus'
+            with self.assertRaises(ValueError):
+                converters.choose_compressor(path, profile, self.outdir)
+
+            output = '%s/auto.squashfs' % (self.outdir)
+            if os.path.exists(output):
+                os.unlink(output)
+            stats = {}
+            profile['objective'] = 'smallest'
+            resp = converters.convert('squashfs', path, output,
+                                      profile=profile, stats=stats)
+            self.assertTrue(resp)
+            self.assertEquals(stats['compressor'], 'xz')
+            self.assertIn('benchmark', stats)
+            os.unlink(output)
+
+            # without unsquashfs, the known fastest decompressor wins
+            profile['objective'] = 'fastestRead'
+            os.unlink(bindir + '/unsquashfs')
+            os.environ['PATH'] = bindir
+            (choice, report) = converters.choose_compressor(path, profile,
+                                                            self.outdir)
+            self.assertEquals(choice, 'lz4')
+            self.assertIsNone(report['results']['lz4']['read_seconds'])
+        finally:
+            os.environ['PATH'] = orig_path
+            for fname in os.listdir(bindir):
+                os.unlink(os.path.join(bindir, fname))
+            os.rmdir(bindir)
+
     def test_writemeta(self):
         """
         Test Write meta function
@@ -77,6 +202,7 @@ class ConvertersTestCase(unittest.TestCase):
                 'private': True,
                 'userACL': [1000, 1001],
                 'groupACL': [1002, 1003],
+                'replicas': ['/images2', '/images3'],
                 }
         output = '%s/test.meta' % (self.outdir)
         resp = converters.writemeta('squashfs', meta, output)
@@ -98,10 +224,70 @@ class ConvertersTestCase(unittest.TestCase):
             self.assertEquals(meta['USERACL'].find("["), -1)
             self.assertEquals(meta['USERACL'].find("]"), -1)
         self.assertGreater(len(meta['ENV']), 0)
+        self.assertEquals(meta['REPLICAS'], '/images2,/images3')
 
+    @unittest.skipUnless(converters.mke2fs_populates(),
+                         'mke2fs does not support -d')
     def test_ext4(self):
-        with self.assertRaises(NotImplementedError):
-            converters.generate_ext4_image('/tmp', '/tmp')
+        path = tempfile.mkdtemp(dir=self.outdir)
+        with open(path + '/a', 'w') as f:
+            f.write('blah')
+        os.makedirs(path + '/sub/dir')
+        os.symlink('a', path + '/link')
+        with open(path + '/sub/dir/"odd name"', 'w') as f:
+            f.write('odd')
+        if os.geteuid() == 0:
+            # otherwise the files already belong to the unprivileged user
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                for name in dirnames + filenames:
+                    os.lchown(os.path.join(dirpath, name), 1000, 1000)
+        output = '%s/test.ext4' % (self.outdir)
+        stats = {}
+        resp = converters.generate_ext4_image(path, output, stats)
+        self.assertTrue(resp)
+        self.assertFalse(os.path.exists(path))
+        fstat = os.stat(output)
+        self.assertEquals(fstat.st_size, stats['estimated_size'])
+        self.assertEquals(stats['attempts'], 1)
+        # sparse output
+        self.assertLess(fstat.st_blocks * 512, fstat.st_size)
+        proc = subprocess.Popen(['debugfs', '-R', 'cat /a', output],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        self.assertEquals(proc.communicate()[0], 'blah')
+        # everything is owned by root, like in squashfs images
+        for target in ('/a', '/sub/dir', '/link', '/sub/dir/"""odd name"""'):
+            proc = subprocess.Popen(['debugfs', '-R', 'stat %s' % target,
+                                     output], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            owner = re.search(r'User:\s*(\d+)\s+Group:\s*(\d+)',
+                              proc.communicate()[0])
+            self.assertIsNotNone(owner)
+            self.assertEquals(owner.groups(), ('0', '0'))
+        os.remove(output)
+
+    def test_ext4_old_mke2fs(self):
+        """
+        Test that a mke2fs without -d is reported as such
+        """
+        bindir = tempfile.mkdtemp(dir=self.outdir)
+        with open(bindir + '/mke2fs', 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "Usage: mke2fs [-b block-size]" >&2\n'
+                    'exit 1\n')
+        os.chmod(bindir + '/mke2fs', 0755)
+        path = self.make_fake()
+        orig_path = os.environ['PATH']
+        os.environ['PATH'] = bindir + ':' + orig_path
+        try:
+            self.assertFalse(converters.mke2fs_populates())
+            with self.assertRaises(OSError) as ctx:
+                converters.generate_ext4_image(path, self.outdir + '/old.ext4')
+            self.assertIn('1.43', str(ctx.exception))
+        finally:
+            os.environ['PATH'] = orig_path
+            os.unlink(bindir + '/mke2fs')
+            os.rmdir(bindir)
 
     def test_cramfs(self):
         converters.generate_cramfs_image('/tmp/b', '/tmp/blah')
@@ -16,11 +16,237 @@
 #
 # See LICENSE for full text.
 
+import json
 import os
 from shifter_imagegw import dockerv2
 import unittest
 import tempfile
 import shutil
+import stat
+import threading
+import hashlib
+import tarfile
+import StringIO
+import time
+import BaseHTTPServer
+import SocketServer
+import socket
+from subprocess import Popen
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal HTTP/1.1 handler that keeps connections open."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'hello'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve blobs out of the class-level blobs dictionary.  Range requests are
+    honored; drop_after (bytes sent before hanging up) and unavailable
+    (number of 503 responses, with a Retry-After of retry_after, to send
+    first) inject failures.  Manifests
+    are served out of manifests, which maps a tag or digest to the media
+    type and body.  If tokens is a list, requests need a bearer token from
+    it, which /token hands out.  Manifest requests are answered after stall
+    seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+    blobs = {}
+    manifests = {}
+    tokens = None
+    drop_after = None
+    unavailable = 0
+    retry_after = '0'
+    stall = 0
+    requests = []
+
+    def send_token(self):
+        FakeRegistryHandler.requests.append(('token', self.path))
+        token = 'token%d' % len(self.tokens)
+        self.tokens.append(token)
+        body = json.dumps({'token': token, 'expires_in': 300})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        """Check the bearer token, answering with a 401 if it is wrong."""
+        if self.tokens is None:
+            return True
+        auth = self.headers.getheader('authorization', '')
+        if auth.startswith('Bearer ') and auth[7:] in self.tokens:
+            return True
+        FakeRegistryHandler.requests.append((401, self.path))
+        self.send_response(401)
+        self.send_header('WWW-Authenticate',
+                         'Bearer realm="http://%s:%d/token",service=fake,'
+                         'scope=repository:test/layers:pull'
+                         % self.server.server_address)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def do_GET(self):
+        if self.path.startswith('/token'):
+            self.send_token()
+            return
+        if not self.authorized():
+            return
+        if '/manifests/' in self.path:
+            self.send_manifest(True)
+            return
+        digest = self.path.split('/')[-1]
+        rng = self.headers.getheader('range')
+        FakeRegistryHandler.requests.append((digest, rng))
+        if FakeRegistryHandler.unavailable > 0:
+            FakeRegistryHandler.unavailable -= 1
+            self.send_response(503)
+            self.send_header('Retry-After', self.retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if digest not in self.blobs:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.blobs[digest]
+        start = 0
+        if rng is not None:
+            start = int(rng.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                             % (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        body = body[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if FakeRegistryHandler.drop_after is not None:
+            self.wfile.write(body[0:FakeRegistryHandler.drop_after])
+            FakeRegistryHandler.drop_after = None
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        if self.authorized():
+            self.send_manifest(False)
+
+    def send_manifest(self, with_body):
+        ref = self.path.split('/')[-1]
+        FakeRegistryHandler.requests.append((self.command, ref))
+        time.sleep(self.stall)
+        if ref not in self.manifests:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        (media_type, body) = self.manifests[ref]
+        self.send_response(200)
+        self.send_header('Content-Type', media_type)
+        self.send_header('Docker-Content-Digest', make_blob(body))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_blob(content):
+    """Return the registry digest for content."""
+    return 'sha256:%s' % hashlib.sha256(content).hexdigest()
+
+
+def make_layer_chain(digests):
+    """Build an eldest->youngest linked list of layers for digests."""
+    eldest = None
+    prev = None
+    for digest in digests:
+        layer = {'fsLayer': {'blobSum': digest}, 'child': None}
+        if prev is None:
+            eldest = layer
+        else:
+            prev['child'] = layer
+        prev = layer
+    return eldest
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """HTTP server handling each (keep-alive) connection in a thread."""
+    daemon_threads = True
+
+
+def make_layer_tar(cachedir, entries):
+    """
+    Write a gzipped layer tar holding entries to cachedir and return its
+    digest.  entries is a list of (name, content, mode) where a content of
+    None makes a directory and a tuple of ('link', target) a hard link.
+    """
+    buff = StringIO.StringIO()
+    tfp = tarfile.open(fileobj=buff, mode='w:gz')
+    for (name, content, mode) in entries:
+        info = tarfile.TarInfo(name)
+        info.mode = mode
+        if content is None:
+            info.type = tarfile.DIRTYPE
+            tfp.addfile(info)
+        elif isinstance(content, tuple):
+            info.type = tarfile.LNKTYPE
+            info.linkname = content[1]
+            tfp.addfile(info)
+        else:
+            info.size = len(content)
+            tfp.addfile(info, StringIO.StringIO(content))
+    tfp.close()
+    data = buff.getvalue()
+    digest = make_blob(data)
+    with open(os.path.join(cachedir, '%s.tar' % digest), 'w') as fp:
+        fp.write(data)
+    return digest
+
+
+def make_members(names):
+    """Build TarInfo objects for names; names ending in / are dirs."""
+    members = []
+    for name in names:
+        info = tarfile.TarInfo(name.rstrip('/'))
+        if name.endswith('/'):
+            info.type = tarfile.DIRTYPE
+        members.append(info)
+    return members
+
+
+def planned_names(layers):
+    """Run the merge planner over lists of names and return kept names."""
+    filtered = [dockerv2._filter_layer_members(make_members(x))
+                for x in layers]
+    plan = dockerv2._plan_layer_merge(filtered)
+    return [sorted([x.name for x in members]) for members in plan]
+
+
+def start_http_server(handler):
+    """Start a local http server in a thread and return it."""
+    server = ThreadedHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
 
 
 class Dockerv2TestCase(unittest.TestCase):
@@ -32,11 +258,36 @@ class Dockerv2TestCase(unittest.TestCase):
         if 'LOCALREGISTRY' in os.environ:
             self.options = {'baseUrl': os.environ['LOCALREGISTRY']}
         self.cleanpaths = []
+        self.servers = []
+        # every test starts with an empty registry that behaves
+        FakeRegistryHandler.blobs = {}
+        FakeRegistryHandler.manifests = {}
+        FakeRegistryHandler.tokens = None
+        FakeRegistryHandler.drop_after = None
+        FakeRegistryHandler.unavailable = 0
+        FakeRegistryHandler.retry_after = '0'
+        FakeRegistryHandler.stall = 0
+        FakeRegistryHandler.requests = []
 
     def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+        dockerv2.CONNECTION_POOL.clear()
+        dockerv2.TOKEN_CACHE.clear()
         for path in self.cleanpaths:
             shutil.rmtree(path)
 
+    def start_registry(self):
+        """
+        Serve FakeRegistryHandler for the rest of the test.  Returns its
+        base URL and a layer cache directory.
+        """
+        server = start_http_server(FakeRegistryHandler)
+        self.servers.append(server)
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        return ('http://127.0.0.1:%d' % server.server_port, cache)
+
     def test_whiteout(self):
         cache = tempfile.mkdtemp()
         expand = tempfile.mkdtemp()
@@ -75,6 +326,599 @@ class Dockerv2TestCase(unittest.TestCase):
             assert(data == 'blah\n')
         return
 
+    def test_connection_pool(self):
+        server = start_http_server(KeepAliveHandler)
+        url = 'http://127.0.0.1:%d' % server.server_port
+        pool = dockerv2.ConnectionPool(max_idle=2, idle_timeout=60)
+        orig_pool = dockerv2.CONNECTION_POOL
+        dockerv2.CONNECTION_POOL = pool
+        try:
+            for _ in range(3):
+                (conn, resp) = dockerv2._pooled_request(url, 'GET', '/a', {})
+                self.assertEquals(resp.read(), 'hello')
+                pool.release(conn, resp)
+            stats = pool.get_stats()
+            self.assertEquals(stats['misses'], 1)
+            self.assertEquals(stats['hits'], 2)
+            self.assertEquals(stats['idle'], 1)
+
+            # a timeout does not stick to the pooled connection
+            (conn, resp) = dockerv2._pooled_request(url, 'GET', '/a', {},
+                                                    timeout=5)
+            self.assertEquals(conn.sock.gettimeout(), 5)
+            resp.read()
+            pool.release(conn, resp)
+            (conn, resp) = dockerv2._pooled_request(url, 'GET', '/a', {})
+            self.assertTrue(conn.pool_reused)
+            self.assertEquals(conn.sock.gettimeout(),
+                              socket.getdefaulttimeout())
+            resp.read()
+            pool.release(conn, resp)
+
+            # a connection that has sat idle too long is evicted
+            pool.idle_timeout = -1
+            (conn, resp) = dockerv2._pooled_request(url, 'GET', '/a', {})
+            resp.read()
+            stats = pool.get_stats()
+            self.assertEquals(stats['misses'], 2)
+            self.assertEquals(stats['evictions'], 1)
+            pool.discard(conn)
+        finally:
+            dockerv2.CONNECTION_POOL = orig_pool
+            pool.clear()
+            server.shutdown()
+
+    def test_pull_layers_concurrent(self):
+        blobs = {}
+        for idx in range(8):
+            content = 'layer %d ' % idx * 1000
+            blobs[make_blob(content)] = content
+        FakeRegistryHandler.blobs = blobs
+        (url, cache) = self.start_registry()
+        options = {'baseUrl': url, 'maxConcurrentDownloads': 3}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        digests = sorted(blobs.keys())
+        # repeated layers should only be fetched once
+        handle.eldest = make_layer_chain(digests + digests[0:2])
+        self.assertTrue(handle.pull_layers(None, cache))
+        for digest in digests:
+            path = os.path.join(cache, '%s.tar' % digest)
+            with open(path) as fp:
+                self.assertEquals(fp.read(), blobs[digest])
+        tars = [x for x in os.listdir(cache) if x.endswith('.tar')]
+        self.assertEquals(len(tars), len(digests))
+
+    def test_pull_layers_concurrent_failure(self):
+        content = 'good layer'
+        FakeRegistryHandler.blobs = {make_blob(content): content}
+        (url, cache) = self.start_registry()
+        options = {'baseUrl': url, 'maxConcurrentDownloads': 2}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        # a corrupt blob fails the digest check and leaves no partial
+        bad = make_blob('something else')
+        FakeRegistryHandler.blobs[bad] = 'not what was promised'
+        handle.eldest = make_layer_chain([make_blob(content), bad])
+        with self.assertRaises(ValueError):
+            handle.pull_layers(None, cache)
+        self.assertFalse(os.path.exists(os.path.join(cache,
+                                                     '%s.tar' % bad)))
+        partials = [x for x in os.listdir(cache)
+                    if x.endswith('.partial')]
+        self.assertEquals(partials, [])
+
+    def test_check_layer_checksum_marker(self):
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        content = 'some layer content'
+        digest = make_blob(content)
+        filename = os.path.join(cache, '%s.tar' % digest)
+        with open(filename, 'w') as fp:
+            fp.write(content)
+        os.utime(filename, (1000000, 1000000))
+        handle = dockerv2.DockerV2Handle('test/layers:latest',
+                                         {'baseUrl': 'http://localhost'})
+        self.assertTrue(handle.check_layer_checksum(digest, filename))
+        self.assertTrue(os.path.exists('%s.verified' % filename))
+
+        # same size and mtime: trusted without re-hashing
+        with open(filename, 'w') as fp:
+            fp.write(content.upper())
+        os.utime(filename, (1000000, 1000000))
+        self.assertTrue(handle.check_layer_checksum(digest, filename))
+
+        # a changed mtime invalidates the marker and forces a re-hash
+        os.utime(filename, (1000000, 999990))
+        with self.assertRaises(ValueError):
+            handle.check_layer_checksum(digest, filename)
+
+    def test_save_layer_resume(self):
+        content = '0123456789' * 1000
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        FakeRegistryHandler.drop_after = 4000
+        FakeRegistryHandler.unavailable = 1
+        (url, cache) = self.start_registry()
+        options = {'baseUrl': url, 'retryBackoff': 0}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertTrue(handle.save_layer(digest, cache))
+        with open(os.path.join(cache, '%s.tar' % digest)) as fp:
+            self.assertEquals(fp.read(), content)
+        ranges = [x[1] for x in FakeRegistryHandler.requests]
+        # 503, dropped full request, then a resumed range request
+        self.assertEquals(ranges, [None, None, 'bytes=4000-'])
+        self.assertFalse(os.path.exists(
+            os.path.join(cache, '%s.tar.partial' % digest)))
+
+    def test_save_layer_retry_after_cap(self):
+        content = 'patience' * 100
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        FakeRegistryHandler.unavailable = 1
+        FakeRegistryHandler.retry_after = '36000'
+        (url, cache) = self.start_registry()
+        delays = []
+        orig_sleep = dockerv2.sleep
+        dockerv2.sleep = delays.append
+        try:
+            options = {'baseUrl': url, 'maxRetryDelay': 30}
+            handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+            self.assertTrue(handle.save_layer(digest, cache))
+            self.assertEquals(delays, [30])
+        finally:
+            dockerv2.sleep = orig_sleep
+
+    def test_save_layer_sharded(self):
+        content = 'sharded' * 100
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        (url, cache) = self.start_registry()
+        options = {'baseUrl': url, 'shardedCache': True}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertTrue(handle.save_layer(digest, cache))
+        value = digest.split(':')[1]
+        filename = os.path.join(cache, value[0:2], value[2:4],
+                                '%s.tar' % digest)
+        self.assertEquals(handle.layer_filename(digest, cache), filename)
+        self.assertTrue(os.path.exists(filename))
+        self.assertTrue(handle.save_layer(digest, cache))
+        self.assertEquals(handle.layer_stats,
+                          {'hits': 1, 'misses': 1,
+                           'bytes_hit': len(content),
+                           'bytes_downloaded': len(content),
+                           'duplicates_avoided': 0})
+        self.assertEquals(len(FakeRegistryHandler.requests), 1)
+
+    def test_head_manifest_digest(self):
+        digest = make_blob('manifest')
+        FakeRegistryHandler.manifests = {'latest': ('text/plain', 'manifest')}
+        (url, _) = self.start_registry()
+        options = {'baseUrl': url}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertEquals(handle.head_manifest_digest(), digest)
+        self.assertEquals(FakeRegistryHandler.requests,
+                          [('HEAD', 'latest')])
+        handle = dockerv2.DockerV2Handle('test/layers:gone', options)
+        with self.assertRaises(ValueError):
+            handle.head_manifest_digest()
+        # a registry that does not answer is given up on
+        FakeRegistryHandler.stall = 1
+        options['requestTimeout'] = 0.2
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        start = time.time()
+        with self.assertRaises(socket.timeout):
+            handle.head_manifest_digest()
+        self.assertLess(time.time() - start, 1)
+
+    def test_schema2_manifest_list(self):
+        config = json.dumps({'config': {'Env': ['PATH=/bin'],
+                                        'Entrypoint': ['/bin/sh'],
+                                        'WorkingDir': '/work'}})
+        config_digest = make_blob(config)
+        layers = ['eldest' * 1000, 'youngest' * 1000]
+        digests = [make_blob(x) for x in layers]
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': dockerv2._MEDIA_MANIFEST_V2,
+            'config': {'digest': config_digest, 'size': len(config)},
+            'layers': [{'mediaType': 'application/vnd.docker.image.'
+                                     'rootfs.diff.tar.gzip',
+                        'digest': x, 'size': len(y)}
+                       for (x, y) in zip(digests, layers)]
+        }
+        manifest_body = json.dumps(manifest)
+        manifest_list = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': dockerv2._MEDIA_MANIFEST_LIST,
+            'manifests': [
+                {'digest': make_blob('arm'),
+                 'platform': {'os': 'linux', 'architecture': 'arm64',
+                              'variant': 'v8'}},
+                {'digest': make_blob(manifest_body),
+                 'platform': {'os': 'linux', 'architecture': 'amd64'}}
+            ]
+        })
+        FakeRegistryHandler.manifests = {
+            'latest': (dockerv2._MEDIA_MANIFEST_LIST, manifest_list),
+            make_blob(manifest_body): (dockerv2._MEDIA_MANIFEST_V2,
+                                       manifest_body)
+        }
+        FakeRegistryHandler.blobs = dict(zip(digests, layers))
+        FakeRegistryHandler.blobs[config_digest] = config
+        (url, cache) = self.start_registry()
+        messages = []
+
+        class Updater(object):
+            def update_status(self, state, message):
+                messages.append(message)
+
+        options = {'baseUrl': url}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options,
+                                         updater=Updater())
+        self.assertEquals(handle.get_image_manifest(), manifest)
+        self.assertEquals(handle.manifest_digest,
+                          make_blob(manifest_list))
+        meta = handle.examine_manifest(manifest)
+        self.assertEquals(meta['id'], config_digest.split(':')[1])
+        self.assertEquals(meta['env'], ['PATH=/bin'])
+        self.assertEquals(meta['entrypoint'], ['/bin/sh'])
+        self.assertEquals(meta['workdir'], '/work')
+        self.assertEquals(handle.layer_blobsums(), digests)
+        self.assertTrue(handle.pull_layers(manifest, cache))
+        for digest in digests:
+            self.assertTrue(os.path.exists(handle.layer_filename(digest,
+                                                                 cache)))
+        self.assertTrue(messages[-1].endswith('(100%)'))
+        # a pull that cannot fit is refused before downloading
+        handle.layer_sizes[make_blob('huge')] = 2 ** 62
+        with self.assertRaises(OSError):
+            handle.check_disk_space([make_blob('huge')], cache)
+        platform = {'platform': 'linux/arm64'}
+        handle = dockerv2.DockerV2Handle('test/layers:latest',
+                                         dict(options, **platform))
+        with self.assertRaises(ValueError):
+            handle.get_image_manifest()
+        manifest['layers'][0]['mediaType'] = \
+            'application/vnd.oci.image.layer.v1.tar+zstd'
+        with self.assertRaises(ValueError):
+            dockerv2._construct_image_metadata(manifest)
+
+    def test_token_cache(self):
+        content = 'token' * 100
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        FakeRegistryHandler.manifests = {'latest': ('text/plain', 'manifest')}
+        FakeRegistryHandler.tokens = []
+        (url, cache) = self.start_registry()
+        options = {'baseUrl': url}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertEquals(handle.head_manifest_digest(),
+                          make_blob('manifest'))
+        self.assertEquals(len(FakeRegistryHandler.tokens), 1)
+        # another handle (i.e., pull) reuses the token up front
+        FakeRegistryHandler.requests = []
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertTrue(handle.save_layer(digest, cache))
+        self.assertEquals(FakeRegistryHandler.requests, [(digest, None)])
+        self.assertEquals(dockerv2.TOKEN_CACHE.get_stats()['hits'], 1)
+        # a refused token is replaced
+        FakeRegistryHandler.tokens[0] = 'revoked'
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertEquals(handle.head_manifest_digest(),
+                          make_blob('manifest'))
+        self.assertEquals(handle.token, 'token1')
+        self.assertEquals(dockerv2.TOKEN_CACHE.get_stats()
+                          ['invalidations'], 1)
+        # credentialed tokens are kept apart from public ones
+        creds = {'username': 'user', 'password': 'secret'}
+        handle = dockerv2.DockerV2Handle('test/layers:latest',
+                                         dict(options, **creds))
+        challenge = dockerv2.TOKEN_CACHE.get_challenge(handle.url,
+                                                       handle.repo)
+        key = handle._token_key(dockerv2._parse_challenge(challenge),
+                                True)
+        self.assertIsNone(dockerv2.TOKEN_CACHE.get(key))
+        self.assertTrue(handle._use_cached_token())
+        self.assertEquals(handle.token, 'token1')
+        self.assertFalse(handle.private)
+        # the public token refused to it (a private repository) moves
+        # the handle on to its credentials, leaving the token cached
+        handle.allow_authenticated = True
+        handle.do_token_auth(challenge)
+        self.assertEquals(handle.token, 'token2')
+        self.assertTrue(handle.private)
+        self.assertEquals(dockerv2.TOKEN_CACHE.get(key), 'token2')
+        public_key = handle._token_key(
+            dockerv2._parse_challenge(challenge), False)
+        self.assertEquals(dockerv2.TOKEN_CACHE.get(public_key), 'token1')
+        self.assertEquals(dockerv2.TOKEN_CACHE.get_stats()
+                          ['invalidations'], 1)
+
+    def test_token_cache_expiry(self):
+        cache = dockerv2.TokenCache()
+        cache.put(('realm', 'service', 'scope', None), 'public', 300)
+        cache.put(('realm', 'service', 'scope', 'user'), 'private', 0)
+        self.assertEquals(cache.get(('realm', 'service', 'scope', None)),
+                          'public')
+        self.assertIsNone(cache.get(('realm', 'service', 'scope', 'user')))
+        self.assertIsNone(cache.get(('realm', 'service', 'scope', 'other')))
+        cache.invalidate(('realm', 'service', 'scope', None), 'stale')
+        self.assertEquals(cache.get(('realm', 'service', 'scope', None)),
+                          'public')
+        cache.invalidate(('realm', 'service', 'scope', None), 'public')
+        self.assertIsNone(cache.get(('realm', 'service', 'scope', None)))
+
+    def test_save_layer_locked(self):
+        content = 'shared' * 100
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        (url, cache) = self.start_registry()
+        filename = os.path.join(cache, '%s.tar' % digest)
+        # another worker (this process, so it looks alive) is downloading
+        with open('%s.lock' % filename, 'w') as lock_fp:
+            lock_fp.write('%s:%d:0' % (socket.gethostname(), os.getpid()))
+
+        def finish_download():
+            with open(filename, 'w') as layer_fp:
+                layer_fp.write(content)
+            os.unlink('%s.lock' % filename)
+
+        timer = threading.Timer(1.5, finish_download)
+        timer.start()
+        try:
+            options = {'baseUrl': url}
+            handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+            self.assertTrue(handle.save_layer(digest, cache))
+            self.assertEquals(len(FakeRegistryHandler.requests), 0)
+            self.assertEquals(handle.layer_stats['duplicates_avoided'], 1)
+            self.assertEquals(handle.layer_stats['hits'], 1)
+            self.assertFalse(os.path.exists('%s.lock' % filename))
+        finally:
+            timer.cancel()
+
+    def test_save_layer_stale_lock(self):
+        content = 'stale' * 100
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        (url, cache) = self.start_registry()
+        filename = os.path.join(cache, '%s.tar' % digest)
+        # left behind by a worker that died
+        proc = Popen(['true'])
+        proc.wait()
+        with open('%s.lock' % filename, 'w') as lock_fp:
+            lock_fp.write('%s:%d:0' % (socket.gethostname(), proc.pid))
+        options = {'baseUrl': url}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        self.assertTrue(handle.save_layer(digest, cache))
+        self.assertEquals(len(FakeRegistryHandler.requests), 1)
+        self.assertEquals(handle.layer_stats['misses'], 1)
+        self.assertEquals(handle.layer_stats['duplicates_avoided'], 0)
+        self.assertFalse(os.path.exists('%s.lock' % filename))
+        # a lock nobody refreshed is stale too
+        os.unlink(filename)
+        with open('%s.lock' % filename, 'w') as lock_fp:
+            lock_fp.write('otherhost:1:0')
+        os.utime('%s.lock' % filename, (0, 0))
+        handle.download_lock_timeout = 60
+        self.assertTrue(handle.save_layer(digest, cache))
+        self.assertEquals(len(FakeRegistryHandler.requests), 2)
+
+    def test_save_layer_retries_exhausted(self):
+        content = 'abc' * 100
+        digest = make_blob(content)
+        FakeRegistryHandler.blobs = {digest: content}
+        FakeRegistryHandler.unavailable = 3
+        (url, cache) = self.start_registry()
+        options = {'baseUrl': url, 'retryBackoff': 0, 'maxRetries': 2}
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        with self.assertRaises(dockerv2.RegistryRetryError):
+            handle.save_layer(digest, cache)
+        self.assertEquals(len(FakeRegistryHandler.requests), 3)
+
+    def test_parse_retry_after(self):
+        self.assertEquals(dockerv2._parse_retry_after('7'), 7)
+        self.assertIsNone(dockerv2._parse_retry_after(None))
+        self.assertIsNone(dockerv2._parse_retry_after('soon'))
+        delay = dockerv2._parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEquals(delay, 0)
+
+    def test_plan_layer_merge(self):
+        layers = [
+            ['etc/', 'etc/passwd', 'usr/', 'usr/local/', 'usr/local/bin',
+             'opt/', 'opt/a', 'opt/b/', 'opt/b/c', 'lib/', 'lib/x',
+             'dev/null', '/etc/shadow', 'etc/../../x'],
+            ['etc/', 'etc/passwd', 'usr/.wh.local', 'opt/.wh..wh..opq',
+             'opt/new', 'lib']
+        ]
+        plan = planned_names(layers)
+        # usr/local is whited out, opt is opaque, lib was replaced by a file
+        self.assertEquals(plan[0], ['etc', 'opt', 'usr'])
+        self.assertEquals(plan[1], ['etc', 'etc/passwd', 'lib', 'opt/new'])
+
+    def test_plan_layer_merge_scaling(self):
+        # synthetic image with many files per layer: each layer rewrites and
+        # whites out part of the layer below it
+        def make_layers(nfiles, nlayers=10):
+            layers = []
+            for lidx in range(nlayers):
+                names = ['d%d/' % x for x in range(100)]
+                names.extend(['d%d/f%d' % (x % 100, x)
+                              for x in range(nfiles)])
+                if lidx > 0:
+                    names.extend(['d%d/.wh.f%d' % (x % 100, x)
+                                  for x in range(lidx, nfiles, 10)])
+                layers.append(
+                    dockerv2._filter_layer_members(make_members(names)))
+            return layers
+
+        def time_plan(layers):
+            best = None
+            for _ in range(3):
+                start = time.time()
+                plan = dockerv2._plan_layer_merge(layers)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            return (plan, best)
+
+        nfiles = 5000
+        (plan, small) = time_plan(make_layers(nfiles))
+        # every file is provided again by the youngest layer
+        self.assertEquals(len(plan[-1]), nfiles + 100)
+        for members in plan[:-1]:
+            self.assertEquals(len(members), 100)
+        (plan, large) = time_plan(make_layers(4 * nfiles))
+        self.assertEquals(len(plan[-1]), 4 * nfiles + 100)
+        # four times the members takes about four times as long, not 16
+        self.assertLess(large, 8 * max(small, 0.01))
+
+    def check_extract_docker_layers(self, options):
+        cache = tempfile.mkdtemp()
+        expand = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        self.cleanpaths.append(expand)
+        base = make_layer_tar(cache, [
+            ('usr', None, 0755), ('usr/local', None, 0755),
+            ('usr/local/a', 'a', 0644), ('tmp', None, 0777),
+            ('tmp/b', 'old', 0444), ('opt', None, 0755),
+            ('opt/old', 'old', 0644), ('ro', None, 0555),
+            ('ro/file', 'old', 0444)])
+        top = make_layer_tar(cache, [
+            ('usr', None, 0755), ('usr/.wh.local', '', 0644),
+            ('tmp/b', 'blah\n', 0444), ('opt/.wh..wh..opq', '', 0644),
+            ('opt/new', 'new', 0644), ('ro', None, 0555),
+            ('ro/other', 'new', 0444), ('implicit/dir/file', 'new', 0644)])
+        options['baseUrl'] = 'http://localhost'
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        # directories the layers do not list must not depend on the umask
+        umask = os.umask(0077)
+        try:
+            handle.extract_docker_layers(expand,
+                                         make_layer_chain([base, top]),
+                                         cachedir=cache)
+        finally:
+            os.umask(umask)
+        self.assertTrue(os.path.exists(os.path.join(expand, 'usr')))
+        self.assertFalse(os.path.exists(os.path.join(expand, 'usr/local')))
+        self.assertFalse(os.path.exists(os.path.join(expand, 'opt/old')))
+        self.assertTrue(os.path.exists(os.path.join(expand, 'opt/new')))
+        self.assertTrue(os.path.exists(os.path.join(expand, 'ro/file')))
+        self.assertTrue(os.path.exists(os.path.join(expand, 'ro/other')))
+        with open(os.path.join(expand, 'tmp/b')) as fp:
+            self.assertEquals(fp.read(), 'blah\n')
+        # modes are final (a+rX,u+w) without a recursive chmod
+        for (path, mode) in (('', 0755), ('ro', 0755), ('ro/file', 0644),
+                             ('tmp/b', 0644), ('implicit', 0755),
+                             ('implicit/dir', 0755),
+                             ('implicit/dir/file', 0644)):
+            fstat = os.stat(os.path.join(expand, path))
+            self.assertEquals(stat.S_IMODE(fstat.st_mode), mode)
+        self.assertGreater(handle.extract_stats['members'], 0)
+        self.assertGreater(handle.extract_stats['peak_rss_kb'], 0)
+
+    def test_extract_docker_layers(self):
+        self.check_extract_docker_layers({})
+
+    def test_extract_docker_layers_streaming(self):
+        self.check_extract_docker_layers({'mergeMode': 'streaming'})
+
+    def test_extract_docker_layers_concurrent(self):
+        self.check_extract_docker_layers({'extractWorkers': 4})
+        with self.assertRaises(ValueError):
+            dockerv2.DockerV2Handle('test/layers:latest',
+                                    {'baseUrl': 'http://localhost',
+                                     'extractWorkers': 0})
+
+    def test_extract_docker_layers_decompressor(self):
+        # gzip stands in for pigz/igzip
+        self.check_extract_docker_layers({'decompressor': 'gzip'})
+        handle = dockerv2.DockerV2Handle('test/layers:latest',
+                                         {'baseUrl': 'http://localhost',
+                                          'decompressor': 'nosuchinflater'})
+        self.assertEquals(handle.decompressor, 'python')
+
+    def test_write_merged_tar(self):
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        base = make_layer_tar(cache, [
+            ('etc', None, 0700), ('etc/a', 'old', 0600),
+            ('etc/b', ('link', 'etc/a'), 0600), ('opt', None, 0755),
+            ('opt/old', 'old', 0644)])
+        top = make_layer_tar(cache, [
+            ('etc', None, 0555), ('etc/a', 'new', 0644),
+            ('opt/.wh.old', '', 0644), ('bin', None, 0755),
+            ('bin/sh', 'sh', 0711)])
+        handle = dockerv2.DockerV2Handle('test/layers:latest',
+                                         {'baseUrl': 'http://localhost'})
+        buff = StringIO.StringIO()
+        count = handle.write_merged_tar(buff, make_layer_chain([base, top]),
+                                        cachedir=cache)
+        buff.seek(0)
+        tfp = tarfile.open(fileobj=buff, mode='r')
+        members = dict((x.name, x) for x in tfp.getmembers())
+        self.assertEquals(count, len(tfp.getmembers()))
+        self.assertEquals(sorted(members.keys()),
+                          ['bin', 'bin/sh', 'etc', 'etc/a', 'etc/b', 'opt'])
+        # directories appear once, with the youngest attributes
+        self.assertEquals(len(tfp.getmembers()), len(members))
+        self.assertEquals(members['etc'].mode, 0755)
+        self.assertEquals(members['bin/sh'].mode, 0755)
+        self.assertEquals(members['etc/a'].uid, 0)
+        self.assertEquals(tfp.extractfile(members['etc/a']).read(), 'new')
+        self.assertEquals(tfp.extractfile(members['etc/b']).read(), 'old')
+        self.assertEquals(handle.extract_stats['mode'], 'stream')
+
+    def test_layer_index(self):
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        digest = make_layer_tar(cache, [
+            ('etc', None, 0755), ('etc/a', 'a', 0644),
+            ('etc/b', ('link', 'etc/a'), 0644)])
+        tfname = os.path.join(cache, '%s.tar' % digest)
+        handle = dockerv2.DockerV2Handle('test/layers:latest',
+                                         {'baseUrl': 'http://localhost'})
+        index = handle._layer_index(tfname)
+        self.assertEquals([x.name for x in index], ['etc', 'etc/a', 'etc/b'])
+        self.assertTrue(index[0].isdir())
+        self.assertTrue(index[2].islnk())
+        self.assertEquals(index[2].linkname, 'etc/a')
+        self.assertTrue(os.path.exists('%s.index' % tfname))
+        cached = dockerv2._read_layer_index(tfname)
+        self.assertEquals([x.name for x in cached], ['etc', 'etc/a', 'etc/b'])
+        # a changed tar invalidates the index
+        os.utime(tfname, (1000000, 1000000))
+        self.assertIsNone(dockerv2._read_layer_index(tfname))
+
+    def check_extract_link_targets(self, options):
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        base = make_layer_tar(cache, [
+            ('etc', None, 0755), ('etc/a', 'old', 0644),
+            ('etc/b', ('link', 'etc/a'), 0644),
+            ('etc/c', ('link', 'etc/a'), 0644),
+            ('opt', None, 0755), ('opt/x', 'x', 0644),
+            ('opt/y', ('link', 'opt/x'), 0644)])
+        # etc/a is replaced and opt/x removed by the younger layer
+        top = make_layer_tar(cache, [('etc/a', 'new', 0644),
+                                     ('opt/.wh.x', '', 0644)])
+        options['baseUrl'] = 'http://localhost'
+        expand = tempfile.mkdtemp()
+        self.cleanpaths.append(expand)
+        handle = dockerv2.DockerV2Handle('test/layers:latest', options)
+        handle.extract_docker_layers(expand, make_layer_chain([base, top]),
+                                     cachedir=cache)
+        for (name, content) in (('etc/a', 'new'), ('etc/b', 'old'),
+                                ('etc/c', 'old'), ('opt/y', 'x')):
+            with open(os.path.join(expand, name)) as fp:
+                self.assertEquals(fp.read(), content)
+        self.assertFalse(os.path.exists(os.path.join(expand, 'opt/x')))
+        self.assertEquals(os.stat(os.path.join(expand, 'etc/b')).st_ino,
+                          os.stat(os.path.join(expand, 'etc/c')).st_ino)
+
+    def test_extract_link_targets(self):
+        self.check_extract_link_targets({})
+
+    def test_extract_link_targets_streaming(self):
+        self.check_extract_link_targets({'mergeMode': 'streaming'})
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,94 @@
+# Shifter, Copyright (c) 2015, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from shifter_imagegw.imagecache import ImageCache
+
+
+class ImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_image(self, name, size):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write('x' * size)
+        return path
+
+    def test_key(self):
+        key = ImageCache.key('abc', 'squashfs', {'compressor': 'xz'})
+        self.assertTrue(key.endswith('.squashfs'))
+        self.assertEquals(key, ImageCache.key('abc', 'squashfs',
+                                              {'compressor': 'xz'}))
+        self.assertNotEquals(key, ImageCache.key('abc', 'squashfs'))
+        self.assertNotEquals(key, ImageCache.key('abc', 'ext4',
+                                                 {'compressor': 'xz'}))
+
+    def test_fetch_store(self):
+        cache = ImageCache(self.cachedir, 1024)
+        key = ImageCache.key('abc', 'squashfs')
+        dest = os.path.join(self.tmpdir, 'abc.squashfs')
+        self.assertFalse(cache.fetch(key, dest))
+        self.assertFalse(os.path.exists(dest))
+
+        cache.store(key, self.make_image('image', 100))
+        self.assertTrue(cache.fetch(key, dest))
+        with open(dest) as fp:
+            self.assertEquals(len(fp.read()), 100)
+        stats = cache.get_stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['stores'], 1)
+        self.assertEquals(stats['entries'], 1)
+        self.assertEquals(stats['bytes'], 100)
+
+    def test_eviction(self):
+        cache = ImageCache(self.cachedir, 1000)
+        keys = [ImageCache.key(str(x), 'squashfs') for x in range(3)]
+        for (idx, key) in enumerate(keys):
+            cache.store(key, self.make_image('image%d' % idx, 400))
+            # make the use order unambiguous
+            entry = cache._entry(key)
+            os.utime(entry, (1000 + idx, 1000 + idx))
+        # the first one went when the third was added
+        self.assertFalse(os.path.exists(cache._entry(keys[0])))
+        self.assertEquals(cache.get_stats()['evictions'], 1)
+
+        # using the second makes the third the least recently used
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertTrue(cache.fetch(keys[1], dest))
+        cache.store(ImageCache.key('3', 'squashfs'),
+                    self.make_image('image3', 400))
+        self.assertTrue(os.path.exists(cache._entry(keys[1])))
+        self.assertFalse(os.path.exists(cache._entry(keys[2])))
+        stats = cache.get_stats()
+        self.assertEquals(stats['evictions'], 2)
+        self.assertLessEqual(stats['bytes'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
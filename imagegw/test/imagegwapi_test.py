@@ -50,6 +50,8 @@ class GWTestCase(unittest.TestCase):
         self.images.drop()
         self.metrics = client[db].metrics
         self.metrics.remove({})
+        self.counters = client[db].counters
+        self.counters.drop()
         api.config['TESTING'] = True
         self.app = api.app.test_client()
         self.url = "/api"
@@ -250,5 +252,25 @@ class GWTestCase(unittest.TestCase):
         self.assertEquals(len(data), 20)
         self.assertEquals(data[19]['time'], last_time)
 
+    def test_layercache(self):
+        uri = '%s/layercache/%s/' % (self.url, self.system)
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.authadmin})
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data), {})
+        # reported through another API process
+        stats = {'hits': 3, 'misses': 1, 'blobs': 2}
+        self.counters.insert({'_id': 'layer_cache:%s' % self.system,
+                              'stats': stats})
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.authadmin})
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data), stats)
+
+    def test_pullstats(self):
+        uri = '%s/pullstats/%s/' % (self.url, self.system)
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.authadmin})
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data),
+                          {'manifest_checks': 0, 'short_circuited': 0})
+
 if __name__ == '__main__':
     unittest.main()
@@ -39,6 +39,7 @@ class ImageMngrTestCase(unittest.TestCase):
         self.images = client[db].images
         self.metrics = client[db].metrics
         self.images.drop()
+        client[db].counters.drop()
         self.m = ImageMngr(self.config)
         self.system = 'systema'
         self.itype = 'docker'
@@ -590,6 +591,86 @@ class ImageMngrTestCase(unittest.TestCase):
         assert state == 'FAILURE'
         self.stop_worker()
 
+    def test_pull_unchanged_tag(self):
+        """
+        Re-pulls of a READY image whose tag did not move are skipped
+        """
+        import shifter_imagegw.imagemngr
+        digests = []
+
+        def fake_digest(request):
+            digests.append(request['tag'])
+            return 'sha256:aaaa'
+
+        record = self.good_record()
+        record['manifest_digest'] = 'sha256:aaaa'
+        record['last_pull'] = record['last_pull'] - 36000
+        pr = {
+            'system': record['system'],
+            'itype': record['itype'],
+            'tag': record['tag'][0],
+            'remotetype': 'dockerv2',
+        }
+        orig = shifter_imagegw.imagemngr.get_manifest_digest
+        shifter_imagegw.imagemngr.get_manifest_digest = fake_digest
+        try:
+            id = self.images.insert(record)
+            session = self.m.new_session(self.auth, self.system)
+            rec = self.m.pull(session, pr)
+            self.assertEquals(rec['_id'], id)
+            self.assertEquals(rec['status'], 'READY')
+            self.assertEquals(digests, [self.tag])
+            self.assertEquals(self.m._pull_stats(),
+                              {'manifest_checks': 1, 'short_circuited': 1})
+            mrec = self.images.find_one({'_id': id})
+            self.assertGreater(mrec['last_pull'], record['last_pull'])
+            # the tag moved, so it is pulled again
+            self.images.remove({})
+            record['manifest_digest'] = 'sha256:bbbb'
+            self.images.insert(record)
+            rec = self.m.pull(session, pr)
+            self.assertEquals(rec['status'], 'INIT')
+            self.assertEquals(self.m._pull_stats()['short_circuited'], 1)
+            # the counters are shared with the other API processes
+            from shifter_imagegw.imagemngr import ImageMngr
+            other = ImageMngr(self.config)
+            self.assertEquals(other._pull_stats(),
+                              {'manifest_checks': 2, 'short_circuited': 1})
+        finally:
+            shifter_imagegw.imagemngr.get_manifest_digest = orig
+
+    def test_pull_fanout(self):
+        """
+        Pulls of the same image for two systems share one conversion
+        """
+        self.m.config['FanOutTransfers'] = True
+        self.m.config['ImageCacheDirectory'] = '/tmp/imagegw/imagecache'
+        pra = {
+            'system': self.system,
+            'itype': self.itype,
+            'tag': self.tag,
+            'remotetype': 'dockerv2',
+            'userACL': [],
+            'groupAcl': []
+        }
+        prb = dict(pra, system='systemb')
+        key = self.m._fanout_key(dict(pra, pulltag=self.tag))
+        self.assertIsNotNone(key)
+        self.assertEquals(key,
+                          self.m._fanout_key(dict(prb, pulltag=self.tag)))
+        # Only the worker of systema runs, the transfer to systemb is
+        # dispatched to it
+        self.start_worker()
+        session = self.m.new_session(self.auth, self.system)
+        reca = self.m.pull(session, pra, testmode=1)
+        sessionb = self.m.new_session(self.auth, 'systemb')
+        recb = self.m.pull(sessionb, prb, testmode=1)
+        self.assertEquals(len(self.m.fanout_leaders), 1)
+        self.assertEquals(self.time_wait(reca['_id']), 'READY')
+        self.assertEquals(self.time_wait(recb['_id']), 'READY')
+        self.assertEquals(len(self.m.fanout_leaders), 0)
+        self.stop_worker()
+
     def test_pull2(self):
         """
         Test pulling two different images
@@ -17,6 +17,7 @@
 # See LICENSE for full text.
 
 import os
+import socket
 import unittest
 import json
 
@@ -139,6 +140,8 @@ class ImageWorkerTestCase(unittest.TestCase):
         self.assertTrue(status)
         status = self.imageworker.convert_image(request)
         self.assertTrue(status)
+        self.assertIn('conversion', request['meta'])
+        self.assertGreater(request['meta']['conversion']['size'], 0)
 
     def test_transfer_image(self):
         request = {
@@ -153,6 +156,63 @@ class ImageWorkerTestCase(unittest.TestCase):
         status = self.imageworker.transfer_image(request)
         self.assertTrue(status)
 
+    def test_write_metadata_per_system(self):
+        platforms = self.imageworker.CONFIG['Platforms']
+        platforms['systemb']['replicaDirs'] = ['/tmp/systemb/replica']
+        platforms['systemb']['replication'] = 2
+        request = {
+            'system': 'systemb',
+            'id': self.hash,
+            'format': 'squashfs',
+            'meta': {'id': self.hash}
+        }
+        try:
+            self.assertTrue(self.imageworker.write_metadata(request))
+            self.assertEquals(request['meta']['replicas'],
+                              ['/tmp/systemb/replica'])
+            self.assertEquals(request['meta']['replication'], '2')
+            request['meta']['ostcount'] = '4'
+            request['meta']['stripe_size'] = '4M'
+            # a fan-out follower starts from the response of the source
+            follower = {
+                'system': 'systema',
+                'id': self.hash,
+                'format': 'squashfs',
+                'meta': dict(request['meta'])
+            }
+            self.assertTrue(self.imageworker.write_metadata(follower))
+            for key in ('replicas', 'ostcount', 'stripe_size'):
+                self.assertNotIn(key, follower['meta'])
+            self.assertEquals(follower['meta']['replication'], '1')
+            with open(follower['metafile']) as meta_file:
+                self.assertNotIn('REPLICAS', meta_file.read())
+        finally:
+            del platforms['systemb']['replicaDirs']
+            del platforms['systemb']['replication']
+            if os.path.exists(request.get('metafile', '')):
+                os.remove(request['metafile'])
+
+    def test_get_manifest_digest_timeout(self):
+        seen = []
+
+        class StalledHandle(object):
+            def __init__(self, image, options):
+                seen.append(options)
+
+            def head_manifest_digest(self):
+                raise socket.timeout('timed out')
+
+        orig_handle = self.imageworker.dockerv2.DockerV2Handle
+        self.imageworker.dockerv2.DockerV2Handle = StalledHandle
+        try:
+            request = {'system': self.system, 'itype': self.itype,
+                       'tag': self.tag}
+            # a registry that does not answer in time skips the check
+            self.assertIsNone(self.imageworker.get_manifest_digest(request))
+            self.assertEquals(seen[0]['requestTimeout'], 2)
+        finally:
+            self.imageworker.dockerv2.DockerV2Handle = orig_handle
+
     def test_pull_docker(self):
         request = {
             'system': self.system,
@@ -0,0 +1,121 @@
+# Shifter, Copyright (c) 2015, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from shifter_imagegw.layercache import LayerCache, layer_path
+
+DIGESTS = ['sha256:%s' % (x * 64) for x in 'abcd']
+
+
+class LayerCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def add_blob(self, digest, size, atime):
+        path = layer_path(self.cachedir, digest)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write('x' * size)
+        with open(path + '.verified', 'w') as fp:
+            fp.write('{}')
+        os.utime(path, (atime, 1000))
+        return path
+
+    def test_layer_path(self):
+        path = layer_path('/cache', DIGESTS[0])
+        self.assertEquals(path, '/cache/aa/aa/%s.tar' % DIGESTS[0])
+
+    def test_evict(self):
+        cache = LayerCache(self.cachedir, 2500)
+        paths = [self.add_blob(x, 1000, 2000 + idx)
+                 for (idx, x) in enumerate(DIGESTS)]
+        # the oldest blob is pinned and the second referenced by an image
+        pin = cache.pin([DIGESTS[0]])
+        cache.add_refs('image1', [DIGESTS[1]])
+        os.utime(paths[0], (1000, 1000))
+        self.assertEquals(cache.evict(), 2)
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[2]))
+        self.assertFalse(os.path.exists(paths[2] + '.verified'))
+        self.assertFalse(os.path.exists(paths[3]))
+        pin.release()
+        stats = cache.get_stats()
+        self.assertEquals(stats['evictions'], 2)
+        self.assertEquals(stats['blobs'], 2)
+        self.assertEquals(cache.evict(), 0)
+
+    def test_remove_refs(self):
+        cache = LayerCache(self.cachedir, 1500)
+        paths = [self.add_blob(x, 1000, 2000 + idx)
+                 for (idx, x) in enumerate(DIGESTS[:2])]
+        cache.add_refs('image1', [DIGESTS[0]])
+        cache.add_refs('image2', [DIGESTS[1]])
+        # image2 expired, so its more recently used blob goes first
+        cache.remove_refs('image2')
+        cache.remove_refs('image3')
+        self.assertEquals(cache.evict(), 1)
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+
+    def test_stale_pin(self):
+        cache = LayerCache(self.cachedir, 0)
+        path = self.add_blob(DIGESTS[0], 10, 1000)
+        pin = cache.pin([DIGESTS[0]])
+        # a pin nobody holds a lock on anymore does not count
+        os.close(pin.fdesc)
+        pin.fdesc = None
+        self.assertEquals(cache.evict(), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals(os.listdir(cache.pins_dir), [])
+
+    def test_migrate_and_stats(self):
+        cache = LayerCache(self.cachedir, 10000)
+        flat = os.path.join(self.cachedir, '%s.tar' % DIGESTS[0])
+        with open(flat, 'w') as fp:
+            fp.write('flat')
+        with open(flat + '.index', 'w') as fp:
+            fp.write('idx')
+        pin = cache.pin([DIGESTS[0]])
+        pin.release()
+        path = layer_path(self.cachedir, DIGESTS[0])
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + '.index'))
+        self.assertFalse(os.path.exists(flat))
+        cache.record({'hits': 3, 'misses': 1, 'bytes_hit': 300,
+                      'bytes_downloaded': 100})
+        cache.record({'hits': 1, 'misses': 0, 'bytes_hit': 100,
+                      'bytes_downloaded': 0, 'duplicates_avoided': 1})
+        stats = cache.get_stats()
+        self.assertEquals(stats['hit_rate'], 0.8)
+        self.assertEquals(stats['bytes_saved'], 400)
+        self.assertEquals(stats['duplicates_avoided'], 1)
+        self.assertEquals(stats['bytes'], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -72,6 +72,61 @@ class TransferTestCase(unittest.TestCase):
         assert cmd is None
 
 
+    def test_ssh_cmd_multiplex(self):
+        control_dir = tempfile.mkdtemp()
+        self.system['ssh']['multiplex'] = True
+        self.system['ssh']['controlDir'] = control_dir
+        self.system['ssh']['controlMaxAge'] = 60
+        sessions = transfer.SshSessions()
+        orig_sessions = transfer.SSH_SESSIONS
+        orig_exec = transfer._exec_and_log
+        closed = []
+        transfer.SSH_SESSIONS = sessions
+        transfer._exec_and_log = lambda cmd, logger: closed.append(cmd)
+        try:
+            path = sessions.control_path(self.system, 'localhost')
+            cmd = transfer._ssh_cmd(self.system, 'echo', 'test')
+            assert '|'.join(cmd) == 'ssh|-i|somefile|-o|ControlMaster=auto' \
+                '|-o|ControlPath=%s|-o|ControlPersist=300' \
+                '|nobody@localhost|echo|test' % path
+            cmd = transfer._scp_cmd(self.system, 'a', 'b')
+            assert cmd[-1] == 'nobody@localhost:b'
+            assert 'ControlPath=%s' % path in cmd
+            # nothing ran, so no master was opened
+            stats = sessions.get_stats()['nobody@localhost']
+            self.assertEquals(stats['opened'], 0)
+            # pretend the first command left a master behind
+            open(path, 'w').close()
+            transfer._ssh_cmd(self.system, 'ls')
+            transfer._ssh_cmd(self.system, 'ls')
+            stats = sessions.get_stats()['nobody@localhost']
+            self.assertEquals(stats['opened'], 1)
+            self.assertEquals(stats['reused'], 2)
+            self.assertEquals(closed, [])
+            # an old master is closed (once) and replaced
+            os.utime(path, (0, 0))
+            transfer._ssh_cmd(self.system, 'ls')
+            transfer._ssh_cmd(self.system, 'ls')
+            self.assertEquals(len(closed), 1)
+            assert '-O' in closed[0]
+            stats = sessions.get_stats()['nobody@localhost']
+            self.assertEquals(stats['recycled'], 1)
+            self.assertEquals(stats['opened'], 1)
+            # the next master is counted once its socket shows up
+            os.unlink(path)
+            open(path, 'w').close()
+            stats = sessions.get_stats()['nobody@localhost']
+            self.assertEquals(stats['opened'], 2)
+        finally:
+            transfer.SSH_SESSIONS = orig_sessions
+            transfer._exec_and_log = orig_exec
+            del self.system['ssh']['multiplex']
+            del self.system['ssh']['controlDir']
+            del self.system['ssh']['controlMaxAge']
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rmdir(control_dir)
+
     def test_cp_cmd(self):
         cmd = transfer._cp_cmd(self.system, 'a', 'b')
         assert len(cmd) == 3
@@ -201,6 +256,223 @@ class TransferTestCase(unittest.TestCase):
         os.unlink(meta_path)
         os.rmdir(tmp_path)
 
+    def test_host_selection(self):
+        pool = transfer.HostPool()
+        self.system['host'] = ['dtn1', 'dtn2', 'dtn3']
+        self.system['ssh']['hostSelection'] = 'roundRobin'
+        self.assertEquals(pool.candidates(self.system),
+                          ['dtn1', 'dtn2', 'dtn3'])
+        self.assertEquals(pool.candidates(self.system),
+                          ['dtn2', 'dtn3', 'dtn1'])
+        # busy hosts go last
+        self.system['ssh']['hostSelection'] = 'leastLoaded'
+        pool.start('dtn1')
+        pool.start('dtn3')
+        self.assertEquals(pool.candidates(self.system)[0], 'dtn2')
+        pool.finish('dtn1', 1000, 2.0)
+        pool.finish('dtn3', 0, 1.0)
+        stats = pool.get_stats()
+        self.assertEquals(stats['dtn1']['throughput'], 500)
+        self.assertEquals(stats['dtn3']['transfers'], 0)
+        # failed hosts are skipped, then probed
+        self.system['ssh']['hostSelection'] = 'first'
+        pool.failed(self.system, 'dtn1')
+        self.assertEquals(pool.candidates(self.system),
+                          ['dtn2', 'dtn3', 'dtn1'])
+        self.assertFalse(pool.get_stats()['dtn1']['up'])
+        probes = []
+        orig_exec = transfer._exec_and_log
+        transfer._exec_and_log = lambda cmd, logger: probes.append(cmd) or 0
+        try:
+            self.system['ssh']['hostRetryInterval'] = 0
+            pool.failed(self.system, 'dtn1')
+            self.assertEquals(pool.candidates(self.system),
+                              ['dtn1', 'dtn2', 'dtn3'])
+            self.assertEquals(len(probes), 1)
+            assert 'nobody@dtn1' in probes[0]
+        finally:
+            transfer._exec_and_log = orig_exec
+            del self.system['ssh']['hostSelection']
+            del self.system['ssh']['hostRetryInterval']
+
+    def test_copyfile_failover(self):
+        tmp_path = tempfile.mkdtemp()
+        self.system['ssh']['imageDir'] = tmp_path
+        self.system['accesstype'] = 'remote'
+        self.system['host'] = ['downhost', 'localhost']
+        self.system['ssh']['hostSelection'] = 'first'
+        orig_pool = transfer.HOST_POOL
+        transfer.HOST_POOL = transfer.HostPool()
+        try:
+            self.assertTrue(transfer.copy_file(__file__, self.system))
+            fname = os.path.split(__file__)[1]
+            assert os.path.exists(os.path.join(tmp_path, fname))
+            stats = transfer.HOST_POOL.get_stats()
+            self.assertEquals(stats['downhost']['failures'], 1)
+            self.assertEquals(stats['localhost']['transfers'], 1)
+            self.assertTrue(transfer.check_file(__file__, self.system))
+            transfer.remove_file(__file__, self.system)
+            assert not os.path.exists(os.path.join(tmp_path, fname))
+        finally:
+            transfer.HOST_POOL = orig_pool
+            del self.system['ssh']['hostSelection']
+            for fname in os.listdir(tmp_path):
+                os.unlink(os.path.join(tmp_path, fname))
+            os.rmdir(tmp_path)
+
+    def test_copyfile_no_failover(self):
+        tmp_path = tempfile.mkdtemp()
+        self.system['ssh']['imageDir'] = tmp_path
+        self.system['accesstype'] = 'remote'
+        self.system['host'] = ['localhost', 'downhost']
+        self.system['ssh']['hostSelection'] = 'first'
+        self.system['ssh']['transferStripes'] = 2
+        self.system['ssh']['stripeMinBytes'] = 0
+        orig_pool = transfer.HOST_POOL
+        orig_copy = transfer._striped_copy
+        transfer.HOST_POOL = transfer.HostPool()
+        # e.g., a checksum mismatch, which is no fault of the host
+        transfer._striped_copy = lambda *args, **kwargs: 1
+        try:
+            self.assertFalse(transfer.copy_file(__file__, self.system))
+            stats = transfer.HOST_POOL.get_stats()
+            self.assertEquals(stats['localhost']['failures'], 0)
+            self.assertTrue(transfer.HOST_POOL.is_up('localhost'))
+            # and the copy was not tried on the next host
+            self.assertEquals(stats['downhost']['failures'], 0)
+        finally:
+            transfer.HOST_POOL = orig_pool
+            transfer._striped_copy = orig_copy
+            del self.system['ssh']['hostSelection']
+            del self.system['ssh']['transferStripes']
+            del self.system['ssh']['stripeMinBytes']
+            for fname in os.listdir(tmp_path):
+                os.unlink(os.path.join(tmp_path, fname))
+            os.rmdir(tmp_path)
+
+    def test_copyfile_striped(self):
+        tmp_path = tempfile.mkdtemp()
+        (fdesc, src) = tempfile.mkstemp()
+        data = os.urandom(3 * 1024 * 1024 + 12345)
+        os.write(fdesc, data)
+        os.close(fdesc)
+        self.system['ssh']['imageDir'] = tmp_path
+        self.system['accesstype'] = 'remote'
+        self.system['ssh']['transferStripes'] = 3
+        self.system['ssh']['stripeMinBytes'] = 0
+        try:
+            self.assertEquals(transfer._stripe_ranges(len(data), 3),
+                              [(0, 2 * 1024 * 1024),
+                               (2 * 1024 * 1024, 1024 * 1024 + 12345)])
+            self.assertTrue(transfer.copy_file(src, self.system))
+            target = os.path.join(tmp_path, os.path.split(src)[1])
+            with open(target, 'rb') as fp:
+                self.assertTrue(fp.read() == data)
+            self.inodes = 0
+            os.path.walk(tmp_path, self.inode_counter, None)
+            assert self.inodes == 1
+        finally:
+            del self.system['ssh']['transferStripes']
+            del self.system['ssh']['stripeMinBytes']
+            os.unlink(src)
+            for fname in os.listdir(tmp_path):
+                os.unlink(os.path.join(tmp_path, fname))
+            os.rmdir(tmp_path)
+
+    def test_stripe_layout(self):
+        gib = 1024 * 1024 * 1024
+        self.assertIsNone(transfer.stripe_layout(self.system, gib, 0))
+        self.assertEquals(transfer.stripe_layout(self.system, gib, '16'),
+                          (1, '1M'))
+        self.assertEquals(transfer.stripe_layout(self.system, 5 * gib + 1, 16),
+                          (6, '1M'))
+        self.assertEquals(transfer.stripe_layout(self.system, 40 * gib, 16),
+                          (16, '1M'))
+        self.system['ostCount'] = 0
+        try:
+            self.assertIsNone(transfer.stripe_layout(self.system, gib, 16))
+        finally:
+            del self.system['ostCount']
+
+    def test_copyfile_lustre(self):
+        self.system['lustreBytesPerOst'] = 1024
+        self.system['lustreStripeSize'] = '4M'
+        try:
+            for (prefix, expected) in [
+                    ('lustre', {'ostcount': '4', 'stripe_size': '4M'}),
+                    ('nolustre', {'ostcount': '0'})]:
+                tmp_path = tempfile.mkdtemp(prefix=prefix)
+                self.system['local']['imageDir'] = tmp_path
+                layout = {}
+                try:
+                    self.assertTrue(transfer.copy_file(__file__, self.system,
+                                                       ostcount=4,
+                                                       layout=layout))
+                    self.assertEquals(layout, expected)
+                    fname = os.path.split(__file__)[1]
+                    with open(os.path.join(tmp_path, fname)) as fp:
+                        self.assertEquals(fp.read(), open(__file__).read())
+                    self.inodes = 0
+                    os.path.walk(tmp_path, self.inode_counter, None)
+                    assert self.inodes == 1
+                    # the reserved file is kept either way
+                    temp_fn = transfer.pre_create_tempfile(
+                        tmp_path, fname, transfer._sh_cmd, self.system)
+                    self.assertEquals(transfer._set_stripe(
+                        temp_fn, (4, '4M'), transfer._sh_cmd, self.system),
+                                      prefix == 'lustre')
+                    self.assertEquals(os.listdir(tmp_path).count(
+                        os.path.basename(temp_fn)), 1)
+                    assert len(os.listdir(tmp_path)) == 2
+                finally:
+                    for fname in os.listdir(tmp_path):
+                        os.unlink(os.path.join(tmp_path, fname))
+                    os.rmdir(tmp_path)
+        finally:
+            del self.system['lustreBytesPerOst']
+            del self.system['lustreStripeSize']
+
+    def test_transfer_replicas(self):
+        tmp_path = tempfile.mkdtemp()
+        replica_path = tempfile.mkdtemp()
+        self.system['local']['imageDir'] = tmp_path
+        self.system['replicaDirs'] = [replica_path, '/nonexistent']
+        fname = os.path.split(__file__)[1]
+        try:
+            self.assertEquals(transfer.replica_dirs(self.system, 1), [])
+            replicas = transfer.replica_dirs(self.system, 2)
+            self.assertEquals(replicas, [replica_path])
+            self.assertEquals(transfer.replica_base_paths(self.system,
+                                                          replicas),
+                              [replica_path])
+            self.system['replicaBasePaths'] = ['/images2']
+            self.assertEquals(transfer.replica_base_paths(self.system,
+                                                          replicas),
+                              ['/images2'])
+            with self.assertRaises(ValueError):
+                transfer.replica_base_paths(self.system, ['/a', '/b'])
+            self.assertTrue(transfer.transfer(self.system, __file__,
+                                              replicas=replicas))
+            assert os.path.exists(os.path.join(replica_path, fname))
+            self.assertTrue(transfer.imagevalid(self.system, __file__,
+                                                replicas=replicas))
+            os.unlink(os.path.join(replica_path, fname))
+            self.assertFalse(transfer.imagevalid(self.system, __file__,
+                                                 replicas=replicas))
+            self.assertTrue(transfer.transfer(self.system, __file__,
+                                              replicas=replicas))
+            self.assertTrue(transfer.remove(self.system, __file__,
+                                            replicas=replicas))
+            self.assertEquals(os.listdir(tmp_path), [])
+            self.assertEquals(os.listdir(replica_path), [])
+        finally:
+            del self.system['replicaDirs']
+            self.system.pop('replicaBasePaths', None)
+            for path in (tmp_path, replica_path):
+                for fname in os.listdir(path):
+                    os.unlink(os.path.join(path, fname))
+                os.rmdir(path)
+
     def test_remove_local(self):
         (fdesc, tmp_path) = tempfile.mkstemp()
         os.close(fdesc)
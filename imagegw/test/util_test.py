@@ -0,0 +1,72 @@
+# Shifter, Copyright (c) 2015, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+import os
+import shutil
+import tempfile
+import unittest
+from shifter_imagegw import util
+
+
+class UtilTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_cpu_budget(self):
+        lockdir = os.path.join(self.tmpdir, 'budget')
+        first = util.CpuBudget(lockdir, 4)
+        second = util.CpuBudget(lockdir, 4, poll=0.01)
+        self.assertEquals(first.acquire(3), 3)
+        # only one core is left for the second worker
+        self.assertEquals(second.acquire(4), 1)
+        first.release()
+        second.release()
+        self.assertEquals(second.acquire(8), 4)
+        second.release()
+        with self.assertRaises(ValueError):
+            util.CpuBudget(lockdir, 0)
+
+    def test_rmtree(self):
+        path = os.path.join(self.tmpdir, 'tree')
+        os.makedirs(os.path.join(path, 'a/b'))
+        with open(os.path.join(path, 'a/b/file'), 'w') as fp:
+            fp.write('data')
+        os.chmod(os.path.join(path, 'a/b'), 0500)
+        util.rmtree(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_preallocate(self):
+        path = os.path.join(self.tmpdir, 'download')
+        with open(path, 'wb') as fp:
+            fp.write('data')
+            fp.flush()
+            if util.preallocate(fp.fileno(), 1024 * 1024):
+                self.assertGreaterEqual(os.fstat(fp.fileno()).st_blocks * 512,
+                                        1024 * 1024)
+            self.assertFalse(util.preallocate(fp.fileno(), 0))
+        # the reservation does not change what was written
+        self.assertEquals(os.path.getsize(path), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -68,6 +68,7 @@ static const char *allowedImageTypes[] = {
 
 uid_t * _Convert_to_list(const char *text);
 int _ImageData_assign(const char *key, const char *value, void *t_imageData);
+char *_ImageData_pickReplica(const char *replicas, const char *imageName, const char *hostname);
 char *_ImageData_filterString(const char *input, int allowSlash);
 
 /*! Contact image gateway to lookup mapping between tag/type and identifier */
@@ -237,6 +238,21 @@ int parse_ImageData(char *type, char *identifier, UdiRootConfig *config, ImageDa
     }
     snprintf(image->filename, fname_len, "%s/%s.%s", config->imageBasePath, identifier, extension);
 
+    /* spread the nodes over the copies of the image, if there are any */
+    if (image->replicas != NULL) {
+        char hostname[HOST_NAME_MAX + 1];
+        char *replica = NULL;
+        memset(hostname, 0, sizeof(hostname));
+        if (gethostname(hostname, HOST_NAME_MAX) == 0) {
+            replica = _ImageData_pickReplica(image->replicas,
+                    strrchr(image->filename, '/') + 1, hostname);
+        }
+        if (replica != NULL) {
+            free(image->filename);
+            image->filename = replica;
+        }
+    }
+
     image->identifier = strdup(identifier);
 
     return 0;
@@ -258,6 +274,9 @@ void free_ImageData(ImageData *image, int freeStruct) {
     if (image->entryPoint != NULL) {
         free(image->entryPoint);
     }
+    if (image->replicas != NULL) {
+        free(image->replicas);
+    }
     if (image->volume != NULL) {
         char **volPtr = NULL;
         for (volPtr = image->volume; *volPtr != NULL; volPtr++) {
@@ -318,6 +337,7 @@ size_t fprint_ImageData(FILE *fp, ImageData *image) {
         nWrite += fprintf(fp, "    %s\n", *tptr);
     }
     nWrite += fprintf(fp, "EntryPoint: %s\n", (image->entryPoint != NULL ? image->entryPoint : ""));
+    nWrite += fprintf(fp, "Replicas: %s\n", (image->replicas != NULL ? image->replicas : ""));
     nWrite += fprintf(fp, "Volume Mounts: %lu mount points\n", image->volume_size);
     for (tptr = image->volume; tptr && *tptr; tptr++) {
         nWrite += fprintf(fp, "    %s\n", *tptr);
@@ -376,6 +396,11 @@ int _ImageData_assign(const char *key, const char *value, void *t_image) {
         if (image->workdir == NULL) {
             return 1;
         }
+    } else if (strcmp(key, "REPLICAS") == 0) {
+        image->replicas = strdup(value);
+        if (image->replicas == NULL) {
+            return 1;
+        }
     } else if (strcmp(key, "USERACL") == 0) {
         image->uids = _Convert_to_list(value);
     } else if (strcmp(key, "GROUPACL") == 0) {
@@ -392,6 +417,63 @@ int _ImageData_assign(const char *key, const char *value, void *t_image) {
     return 0;
 }
 
+/**
+ * _ImageData_pickReplica - choose the copy of an image this node reads
+ *
+ * The image in imageBasePath and its replicas are spread over the nodes by a
+ * hash of the hostname.
+ *
+ * Parameters:
+ * replicas - comma separated directories holding extra copies of the image
+ * imageName - file name of the image
+ * hostname - name of this node
+ *
+ * Returns:
+ * newly allocated path of the replica picked for hostname; NULL if the copy
+ * in imageBasePath was picked, the replica is missing or none can be picked
+ */
+char *_ImageData_pickReplica(const char *replicas, const char *imageName, const char *hostname) {
+    const char *ptr = NULL;
+    const char *end = NULL;
+    unsigned long hash = 5381;
+    size_t count = 0;
+    size_t idx = 0;
+    char *replica = NULL;
+    struct stat st;
+
+    if (replicas == NULL || imageName == NULL || hostname == NULL) {
+        return NULL;
+    }
+    if (strlen(replicas) == 0 || strlen(imageName) == 0) {
+        return NULL;
+    }
+    for (ptr = hostname; *ptr != 0; ptr++) {
+        hash = hash * 33 + (unsigned char) *ptr;
+    }
+    /* the copy in imageBasePath is candidate 0 */
+    for (ptr = replicas, count = 2; (ptr = strchr(ptr, ',')) != NULL; ptr++) {
+        count++;
+    }
+    idx = hash % count;
+    if (idx == 0) {
+        return NULL;
+    }
+    for (ptr = replicas; idx > 1; idx--) {
+        ptr = strchr(ptr, ',') + 1;
+    }
+    end = strchr(ptr, ',');
+    if (end == NULL) {
+        end = ptr + strlen(ptr);
+    }
+    replica = alloc_strgenf("%.*s/%s", (int) (end - ptr), ptr, imageName);
+    if (replica == NULL || stat(replica, &st) != 0) {
+        /* not (yet) there, use the copy in imageBasePath */
+        free(replica);
+        return NULL;
+    }
+    return replica;
+}
+
 uid_t * _Convert_to_list(const char *text){
   uid_t *ids=NULL;
   const char *ptr;
@@ -46,6 +46,7 @@
 
 extern "C" {
 extern int _ImageData_assign(const char *key, const char *value, void *t_image);
+extern char *_ImageData_pickReplica(const char *replicas, const char *imageName, const char *hostname);
 }
 
 TEST_GROUP(ImageDataTestGroup) {
@@ -66,6 +67,75 @@ TEST(ImageDataTestGroup, ConfigAssign_basic) {
 
 }
 
+TEST(ImageDataTestGroup, ConfigAssign_replicas) {
+    ImageData image;
+    memset(&image, 0, sizeof(ImageData));
+
+    CHECK(_ImageData_assign("REPLICAS", "/images2,/images3", &image) == 0);
+    CHECK(image.replicas != NULL);
+    CHECK(strcmp(image.replicas, "/images2,/images3") == 0);
+
+    free_ImageData(&image, 0);
+}
+
+TEST(ImageDataTestGroup, PickReplica_basic) {
+    char tmpdir[] = "/tmp/shifter.replica.XXXXXX";
+    char hostname[128];
+    char *replicas = NULL;
+    char *imagefile = NULL;
+    char *replica = NULL;
+    char *first = NULL;
+    int picked = 0;
+    int primary = 0;
+    int i = 0;
+    FILE *fp = NULL;
+
+    CHECK(mkdtemp(tmpdir) != NULL);
+    replicas = alloc_strgenf("/nonexistent,%s", tmpdir);
+    imagefile = alloc_strgenf("%s/abcdef.squashfs", tmpdir);
+    fp = fopen(imagefile, "w");
+    CHECK(fp != NULL);
+    fclose(fp);
+
+    CHECK(_ImageData_pickReplica(NULL, "abcdef.squashfs", "node0") == NULL);
+    CHECK(_ImageData_pickReplica("", "abcdef.squashfs", "node0") == NULL);
+
+    /* nodes spread over the image in imageBasePath and the replica that
+     * exists; the missing replica falls back to imageBasePath */
+    for (i = 0; i < 64; i++) {
+        snprintf(hostname, 128, "node%d", i);
+        replica = _ImageData_pickReplica(replicas, "abcdef.squashfs", hostname);
+        if (replica == NULL) {
+            primary++;
+            continue;
+        }
+        CHECK(strcmp(replica, imagefile) == 0);
+        picked++;
+        free(replica);
+    }
+    CHECK(picked > 0);
+    CHECK(primary > picked);
+
+    /* the choice is stable for a node */
+    for (i = 0; first == NULL && i < 64; i++) {
+        snprintf(hostname, 128, "node%d", i);
+        first = _ImageData_pickReplica(replicas, "abcdef.squashfs", hostname);
+    }
+    CHECK(first != NULL);
+    replica = _ImageData_pickReplica(replicas, "abcdef.squashfs", hostname);
+    CHECK(replica != NULL && strcmp(replica, first) == 0);
+    free(replica);
+    free(first);
+
+    /* once the replica is gone every node uses imageBasePath */
+    unlink(imagefile);
+    CHECK(_ImageData_pickReplica(replicas, "abcdef.squashfs", hostname) == NULL);
+
+    rmdir(tmpdir);
+    free(imagefile);
+    free(replicas);
+}
+
 TEST(ImageDataTestGroup, FilterString_basic) {
     CHECK(imageDesc_filterString(NULL, NULL) == NULL);
     char *output = imageDesc_filterString("echo test; rm -rf thing1", NULL);